@@ -12,7 +12,16 @@ logger = getLogger(__name__)
 task_service = LazyService("BACKGROUND_TASK_SERVICE")
 
 
-def task_decorator(task_name=""):
+def task_decorator(task_name="", priority=None, max_attempts=1):
+    """Turn a function into a background task.
+
+    `priority` is the priority class of the queued Task (see `iaso.models.base.TASK_PRIORITY_CHOICES`), it defaults to
+    NORMAL_PRIORITY. Use HIGH_PRIORITY for short interactive tasks and LOW_PRIORITY for large bulk jobs.
+
+    `max_attempts` is how many times the task is run if its worker crashes (see `reap_expired_tasks`). Only raise it
+    for tasks that can safely be restarted, ideally resuming from `task.checkpoint`.
+    """
+
     def inner_task(func):
         assert func.__name__ == func.__qualname__, f"{func.__qualname__} is not a global"
 
@@ -58,6 +67,8 @@ def task_decorator(task_name=""):
                 task.account = user.iaso_profile.account
                 task.launcher = user
                 task.name = task_name
+                if priority is not None:
+                    task.priority = priority
                 task.params = {"args": args, "kwargs": kwargs, "module": func.__module__, "method": func.__name__}
                 # Save it here so we can have the id
                 task.save()
@@ -67,6 +78,7 @@ def task_decorator(task_name=""):
                 return task
 
         wrapper._is_task = True
+        wrapper._max_attempts = max_attempts
         return wrapper
 
     return inner_task
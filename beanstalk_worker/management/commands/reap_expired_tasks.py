@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from beanstalk_worker import task_service
+
+
+class Command(BaseCommand):
+    help = """Requeue or mark as errored the RUNNING tasks whose worker stopped sending heartbeats
+
+    The tasks_worker command already does it periodically, this is for deployments using SQS."""
+
+    def handle(self, *args, **kwargs):
+        requeued, errored = task_service.reap_expired_tasks()
+        self.stdout.write(f"Requeued {requeued} tasks, marked {errored} tasks as errored")
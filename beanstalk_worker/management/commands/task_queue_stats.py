@@ -0,0 +1,27 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from beanstalk_worker import task_service
+from iaso.models.base import TASK_PRIORITY_CHOICES
+
+
+class Command(BaseCommand):
+    help = """Print the queue wait time of background tasks per priority class"""
+
+    def add_arguments(self, parser):
+        parser.add_argument("--hours", type=int, default=24, help="Window for tasks already started")
+
+    def handle(self, *args, hours, **kwargs):
+        stats = task_service.queue_stats(since=timezone.now() - timedelta(hours=hours))
+        labels = dict(TASK_PRIORITY_CHOICES)
+        for priority in sorted(stats, reverse=True):
+            queued = stats[priority].get("queued", {"count": 0, "max_wait": 0})
+            started = stats[priority].get("started", {"count": 0, "avg_wait": 0, "max_wait": 0})
+            self.stdout.write(
+                f"{labels.get(priority, priority)}: "
+                f"{queued['count']} queued (oldest waiting {queued['max_wait']:.0f}s), "
+                f"{started['count']} started in the last {hours}h "
+                f"(avg wait {started['avg_wait']:.0f}s, max wait {started['max_wait']:.0f}s)"
+            )
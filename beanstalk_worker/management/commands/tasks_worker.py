@@ -1,3 +1,4 @@
+import threading
 from logging import getLogger
 
 from django.core.management.base import BaseCommand
@@ -14,11 +15,36 @@ import select
 
 class Command(BaseCommand):
     help = """Permanently listen for new background task and execute them
-    
-    For local and dev, don't run more than one as it is not designed for concurrency"""
 
-    def handle(self, *args, **kwargs):
+    Tasks are claimed with `SELECT ... FOR UPDATE SKIP LOCKED`, so several workers (on one or more nodes) can safely
+    run at the same time. Use --concurrency to run multiple tasks in parallel within this process."""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=1,
+            help="Number of tasks executed in parallel by this process, each in its own thread and DB connection",
+        )
+
+    def handle(self, *args, concurrency=1, **kwargs):
+        if concurrency <= 1:
+            self.listen_and_run()
+            return
+
+        threads = [
+            threading.Thread(target=self.listen_and_run, name=f"tasks_worker-{i}", daemon=True)
+            for i in range(concurrency)
+        ]
+        for thread in threads:
+            thread.start()
+        print(f"Started {concurrency} worker threads .... Press ^C to stop")
+        for thread in threads:
+            thread.join()
+
+    def listen_and_run(self):
         # see `Worker connection` in services.py
+        # Django connections are per thread, so each worker thread LISTEN on its own connection.
         connection = connections["worker"]
 
         cur = connection.cursor()
@@ -27,15 +53,19 @@ class Command(BaseCommand):
 
         print(f"Listening for task on {pg_conn.dsn} .... Press ^C to stop")
 
-        while True:
-            task_service.run_all()
-            # queue is empty, wait till we receive a new notification
-            if select.select([pg_conn], [], [], LISTEN_TIMEOUT) == ([], [], []):
-                print("Listen Timeout, check if there is a task anyway")
-            else:
-                pg_conn.poll()
-                print(pg_conn.notifies)
-                while pg_conn.notifies:
-                    notify = pg_conn.notifies.pop(0)
-                    print(notify)
-            continue
+        try:
+            while True:
+                task_service.reap_expired_tasks()
+                task_service.run_all()
+                # queue is empty, wait till we receive a new notification
+                if select.select([pg_conn], [], [], LISTEN_TIMEOUT) == ([], [], []):
+                    print("Listen Timeout, check if there is a task anyway")
+                else:
+                    pg_conn.poll()
+                    print(pg_conn.notifies)
+                    while pg_conn.notifies:
+                        notify = pg_conn.notifies.pop(0)
+                        print(notify)
+                continue
+        finally:
+            connections.close_all()
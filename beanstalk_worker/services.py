@@ -1,16 +1,20 @@
 import decimal
 import importlib
 import json
-from datetime import datetime
+import random
+import threading
+from datetime import datetime, timedelta
 from logging import getLogger
 
 import boto3
 import dateparser
 from django.conf import settings
-from django.db import connection
+from django.db import connection, connections, transaction
+from django.db.models import Avg, Count, F, IntegerField, Max, Min, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 
-from iaso.models.base import Task, RUNNING, QUEUED, KILLED
+from iaso.models.base import Task, RUNNING, QUEUED, KILLED, ERRORED, HIGH_PRIORITY, NORMAL_PRIORITY, LOW_PRIORITY
 
 logger = getLogger(__name__)
 
@@ -47,6 +51,108 @@ def json_load(obj):
         return obj
 
 
+class FairShareScheduler:
+    """Decide which queued task a worker should run next.
+
+    1. A priority class is drawn at random among the classes that have queued tasks, weighted by `weights`. Higher
+       classes are picked more often but lower ones are never starved by a flood of more urgent tasks.
+    2. Inside that class, accounts with the fewest tasks currently RUNNING go first, then task names with the fewest
+       RUNNING tasks, so one account launching a huge bulk update doesn't monopolise the workers.
+    3. Ties are resolved in FIFO order.
+    """
+
+    DEFAULT_WEIGHTS = {HIGH_PRIORITY: 8, NORMAL_PRIORITY: 3, LOW_PRIORITY: 1}
+
+    def __init__(self, weights=None, rng=None):
+        self.weights = weights if weights is not None else self.DEFAULT_WEIGHTS
+        self.rng = rng or random.Random()
+
+    def pick_priority(self, queryset):
+        priorities = sorted(
+            queryset.filter(status=QUEUED).order_by().values_list("priority", flat=True).distinct(), reverse=True
+        )
+        if not priorities:
+            return None
+        weights = [self.weights.get(p, 1) for p in priorities]
+        if not any(weights):
+            return priorities[0]
+        return self.rng.choices(priorities, weights=weights)[0]
+
+    def order(self, queryset, priority):
+        running = Task.objects.filter(status=RUNNING).order_by()
+        running_for_account = running.filter(account=OuterRef("account")).values("account").annotate(c=Count("id"))
+        running_for_name = running.filter(name=OuterRef("name")).values("name").annotate(c=Count("id"))
+        return (
+            queryset.filter(status=QUEUED, priority=priority)
+            .annotate(
+                account_running=Coalesce(
+                    Subquery(running_for_account.values("c")), Value(0), output_field=IntegerField()
+                ),
+                name_running=Coalesce(Subquery(running_for_name.values("c")), Value(0), output_field=IntegerField()),
+            )
+            .order_by("account_running", "name_running", "created_at", "id")
+        )
+
+    @staticmethod
+    def queue_stats(queryset, since=None):
+        """Queue wait time (created -> started) per priority class, in seconds.
+
+        `queued` describes tasks still waiting, `started` tasks picked by a worker after `since` (default: last 24h).
+        """
+        now = timezone.now()
+        since = since or now - timedelta(hours=24)
+        stats = {}
+        waiting = queryset.filter(status=QUEUED).order_by().values("priority")
+        for row in waiting.annotate(count=Count("id"), oldest=Min("created_at")):
+            stats.setdefault(row["priority"], {})["queued"] = {
+                "count": row["count"],
+                "max_wait": (now - row["oldest"]).total_seconds(),
+            }
+        started = queryset.filter(started_at__gte=since).order_by().values("priority")
+        started = started.annotate(count=Count("id"), avg=Avg(F("started_at") - F("created_at")))
+        for row in started.annotate(max=Max(F("started_at") - F("created_at"))):
+            stats.setdefault(row["priority"], {})["started"] = {
+                "count": row["count"],
+                "avg_wait": row["avg"].total_seconds(),
+                "max_wait": row["max"].total_seconds(),
+            }
+        return stats
+
+
+class Heartbeat:
+    """Renew the lease of a running task from a background thread while it is executed
+
+    The lease doesn't depend on the progress reports of the task: a task busy in a long transaction or query keeps it
+    as long as its worker is alive. Used as a context manager around the execution of the task.
+    """
+
+    def __init__(self, queryset, task_id, interval):
+        self.queryset = queryset
+        self.task_id = task_id
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name=f"task-{task_id}-heartbeat", daemon=True)
+
+    def run(self):
+        try:
+            while not self.stopped.wait(self.interval):
+                try:
+                    self.queryset.filter(id=self.task_id, status=RUNNING).update(heartbeat_at=timezone.now())
+                except Exception:
+                    logger.exception(f"Could not renew the lease of task {self.task_id}")
+        finally:
+            # the connections opened by this thread
+            connections.close_all()
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+
 class _TaskServiceBase:
     def get_queryset(self):
         # This allows overriding in test. Since all test are run in transactions, the newly created task were not visible
@@ -59,22 +165,78 @@ class _TaskServiceBase:
 
     def run(self, module_name, method_name, task_id, args, kwargs):
         """run a task, called by the view that receives them from the queue"""
-        kwargs["_immediate"] = True
         #  for the using() see Worker connection above
-        task = self.get_queryset().get(id=task_id)
-        if task.status == QUEUED:  # ensure a task is only run once
-            task.status = RUNNING
-            task.started_at = timezone.now()
-            task.save()
-            module = importlib.import_module(module_name)
-            method = getattr(module, method_name)
-            assert method._is_task
+        # Compare and swap the status in a single UPDATE, so a task is only run once even if it is delivered to
+        # multiple workers at the same time.
+        now = timezone.now()
+        claimed = (
+            self.get_queryset()
+            .filter(id=task_id, status=QUEUED)
+            .update(status=RUNNING, started_at=now, heartbeat_at=now, attempts=F("attempts") + 1)
+        )
+        if claimed:
+            task = self.get_queryset().get(id=task_id)
+            self.execute(task, module_name, method_name, args, kwargs)
 
+    def execute(self, task, module_name, method_name, args, kwargs):
+        """execute a task that has already been marked as RUNNING by this worker"""
+        kwargs["_immediate"] = True
+        module = importlib.import_module(module_name)
+        method = getattr(module, method_name)
+        assert method._is_task
+
+        with Heartbeat(self.get_queryset(), task.id, settings.TASK_HEARTBEAT_SECONDS):
             method(*args, task=task, **kwargs)
 
-            task.refresh_from_db()
-            if task.status == RUNNING:
-                logger.warning(f"Task {task} still in status RUNNING after execution")
+        task.refresh_from_db()
+        if task.status == RUNNING:
+            logger.warning(f"Task {task} still in status RUNNING after execution")
+
+    def reap_expired_tasks(self):
+        """Handle RUNNING tasks whose lease expired, i.e. their worker died without finishing them.
+
+        The task is requeued if it has attempts left (see `max_attempts` in task_decorator), otherwise it is marked as
+        ERRORED. Returns the number of (requeued, errored) tasks.
+        """
+        now = timezone.now()
+        cutoff = now - timedelta(seconds=settings.TASK_LEASE_SECONDS)
+        expired = (
+            self.get_queryset()
+            .filter(status=RUNNING)
+            .filter(Q(heartbeat_at__lt=cutoff) | Q(heartbeat_at__isnull=True, started_at__lt=cutoff))
+        )
+        requeued = errored = 0
+        for task in expired:
+            # Only touch the task if nobody renewed the lease or reaped it in the meantime
+            unchanged = self.get_queryset().filter(id=task.id, status=RUNNING, heartbeat_at=task.heartbeat_at)
+            # tasks started before attempts were counted have been run at least once
+            if max(task.attempts, 1) < self.max_attempts(task):
+                if unchanged.update(status=QUEUED, started_at=None, heartbeat_at=None):
+                    logger.warning(f"Requeuing task {task}: lease expired (attempt {task.attempts})")
+                    params = task.params
+                    self.enqueue(params["module"], params["method"], params["args"], params["kwargs"], task.id)
+                    requeued += 1
+            else:
+                message = f"Worker stopped responding after {task.attempts} attempt(s)"
+                result = {"result": ERRORED, "message": message, "last_progress_message": task.progress_message}
+                if unchanged.update(status=ERRORED, ended_at=now, result=result, progress_message=message):
+                    logger.error(f"Task {task} errored: {message}")
+                    errored += 1
+        return requeued, errored
+
+    @staticmethod
+    def max_attempts(task):
+        params = task.params or {}
+        try:
+            method = getattr(importlib.import_module(params["module"]), params["method"])
+        except (KeyError, ImportError, AttributeError):
+            # old task or code that is not there anymore, don't retry
+            return 0
+        return getattr(method, "_max_attempts", 1)
+
+    def queue_stats(self, since=None):
+        """see FairShareScheduler.queue_stats"""
+        return FairShareScheduler.queue_stats(self.get_queryset(), since)
 
     def enqueue(self, module_name, method_name, args, kwargs, task_id):
         body = json.dumps(
@@ -90,7 +252,38 @@ class PostgresTaskService(_TaskServiceBase):
         cursor.execute("NOTIFY NEW_TASK, ''")
         return {"result": "recorded into DB"}
 
+    scheduler = FairShareScheduler()
+
+    def claim_next(self):
+        """Pick the next queued task and mark it as RUNNING, atomically.
+
+        The order is decided by `scheduler`, see `FairShareScheduler`. The row is selected with
+        `SELECT ... FOR UPDATE SKIP LOCKED`, so when several workers (processes or threads) poll the queue at the same
+        time, each of them gets a different task and none of them blocks on the others.
+        Returns None if the queue is empty.
+        """
+        queryset = self.get_queryset()
+        with transaction.atomic(using=queryset.db):
+            priority = self.scheduler.pick_priority(queryset)
+            if priority is None:
+                return None
+            lockable = queryset.select_for_update(skip_locked=True)
+            task = self.scheduler.order(lockable, priority).first()
+            if task is None:
+                # every task of that class is being claimed by another worker, take any other one
+                task = lockable.filter(status=QUEUED).order_by("-priority", "created_at", "id").first()
+            if task is None:
+                return None
+            task.status = RUNNING
+            task.started_at = task.heartbeat_at = timezone.now()
+            task.attempts += 1
+            task.save(update_fields=["status", "started_at", "heartbeat_at", "attempts"])
+        wait = task.started_at - task.created_at
+        logger.info(f"Claimed task {task.id} {task.name} (priority {task.priority}) after waiting {wait}")
+        return task
+
     def run_task(self, task):
+        """run a task already claimed via `claim_next`"""
         params = task.params
 
         if not (params and "module" in params and "method" in params):
@@ -99,10 +292,12 @@ class PostgresTaskService(_TaskServiceBase):
             task.status = KILLED
             task.save()
             return
-        self.run(params["module"], params["method"], task.id, params["args"], params["kwargs"])
+        self.execute(task, params["module"], params["method"], params["args"], params["kwargs"])
 
     def run_all(self):
-        """run everything in the queue"""
+        """run everything in the queue
+
+        Safe to call from several workers concurrently, see `claim_next`."""
         # clear on_commit stuff
 
         if connection.in_atomic_block:
@@ -110,12 +305,12 @@ class PostgresTaskService(_TaskServiceBase):
                 sids, func = connection.run_on_commit.pop(0)
                 func()
         count = 0
-        task = self.get_queryset().filter(status=QUEUED).first()
+        task = self.claim_next()
         while task:
             self.run_task(task)
             logger.info("=" * 20 + " End task exec " + "=" * 20)
             # Fetch next task
-            task = self.get_queryset().filter(status=QUEUED).first()
+            task = self.claim_next()
             count += 1
         return count
 
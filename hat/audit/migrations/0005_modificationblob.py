@@ -0,0 +1,22 @@
+# Generated by Django 4.2.11 on 2026-10-18 11:20
+
+from django.db import migrations, models
+
+import hat.audit.models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("audit", "0004_alter_modification_object_id"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ModificationBlob",
+            fields=[
+                ("hash", models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ("value", models.JSONField(encoder=hat.audit.models.IasoJsonEncoder)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
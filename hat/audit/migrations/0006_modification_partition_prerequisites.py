@@ -0,0 +1,61 @@
+# Generated by Django 4.2.11 on 2026-10-18 13:50
+
+from django.db import migrations
+
+# Prepares the attachment of audit_modification as a partition by the next migration, without blocking the writes:
+# the unique index becomes its primary key (id, created_at) and the validated check constraint proves its rows are
+# within the bounds of the partition, so neither is built or checked while the table is locked.
+# The boundary is the one used by the next migration, run right after. If the month changes in between, the
+# constraint is still implied by the later boundary.
+
+ADD_PARTITION_RANGE = """
+DO $$
+BEGIN
+    -- the migration isn't atomic, it may be run again after a failure
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'audit_modification_partition_range') THEN
+        EXECUTE format(
+            'ALTER TABLE audit_modification ADD CONSTRAINT audit_modification_partition_range CHECK (created_at < %L) '
+            'NOT VALID',
+            date_trunc('month', now()) + interval '1 month'
+        );
+    END IF;
+END $$
+"""
+
+VALIDATE_PARTITION_RANGE = "ALTER TABLE audit_modification VALIDATE CONSTRAINT audit_modification_partition_range"
+
+
+def create_partition_key_index(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        # an index left invalid by an interrupted build is built again
+        cursor.execute(
+            "SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass('audit_modification_partition_key')"
+        )
+        invalid = cursor.fetchone()
+        if invalid and invalid[0]:
+            cursor.execute("DROP INDEX CONCURRENTLY audit_modification_partition_key")
+        cursor.execute(
+            "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS audit_modification_partition_key "
+            "ON audit_modification (id, created_at)"
+        )
+
+
+def drop_partition_key_index(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("DROP INDEX CONCURRENTLY IF EXISTS audit_modification_partition_key")
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ("audit", "0005_modificationblob"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_partition_key_index, drop_partition_key_index),
+        migrations.RunSQL(
+            [ADD_PARTITION_RANGE, VALIDATE_PARTITION_RANGE],
+            reverse_sql="ALTER TABLE audit_modification DROP CONSTRAINT IF EXISTS audit_modification_partition_range",
+        ),
+    ]
@@ -0,0 +1,93 @@
+# Generated by Django 4.2.11 on 2026-10-18 14:05
+
+from django.db import migrations
+
+# The existing table is attached as is, without copying its rows, as the partition of everything before next month.
+# Its id sequence is replaced by one owned by the partitioned table, so the old partition can be dropped once archived.
+# The table is locked until the migration is committed. Nothing here reads the whole table: its primary key
+# (id, created_at) reuses the unique index and the attachment relies on the check constraint, both built and validated
+# by the previous migration without blocking the writes. The new indexes are built concurrently by the next migration.
+PARTITION_MODIFICATION = """
+DO $$
+DECLARE
+    boundary timestamptz := date_trunc('month', now()) + interval '1 month';
+    month_start timestamptz;
+    max_id integer;
+BEGIN
+    ALTER TABLE audit_modification RENAME TO audit_modification_legacy;
+    -- The primary key of a partition must match the one of the partitioned table
+    ALTER TABLE audit_modification_legacy DROP CONSTRAINT audit_modification_pkey;
+    ALTER TABLE audit_modification_legacy ADD CONSTRAINT audit_modification_legacy_pkey
+        PRIMARY KEY USING INDEX audit_modification_partition_key;
+    ALTER TABLE audit_modification_legacy ALTER COLUMN id DROP IDENTITY IF EXISTS;
+    ALTER TABLE audit_modification_legacy ALTER COLUMN id DROP DEFAULT;
+    DROP SEQUENCE IF EXISTS audit_modification_id_seq;
+
+    CREATE SEQUENCE audit_modification_id_seq;
+    SELECT max(id) INTO max_id FROM audit_modification_legacy;
+    IF max_id IS NOT NULL THEN
+        PERFORM setval('audit_modification_id_seq', max_id);
+    END IF;
+
+    CREATE TABLE audit_modification (LIKE audit_modification_legacy) PARTITION BY RANGE (created_at);
+    ALTER TABLE audit_modification ALTER COLUMN id SET DEFAULT nextval('audit_modification_id_seq');
+    ALTER SEQUENCE audit_modification_id_seq OWNED BY audit_modification.id;
+    ALTER TABLE audit_modification ADD CONSTRAINT audit_modification_pkey PRIMARY KEY (id, created_at);
+    ALTER TABLE audit_modification ADD CONSTRAINT audit_modification_content_type_id_fk
+        FOREIGN KEY (content_type_id) REFERENCES django_content_type (id) DEFERRABLE INITIALLY DEFERRED;
+    ALTER TABLE audit_modification ADD CONSTRAINT audit_modification_user_id_fk
+        FOREIGN KEY (user_id) REFERENCES auth_user (id) DEFERRABLE INITIALLY DEFERRED;
+    -- Same definitions as the indexes of the old table, which are reused when it is attached
+    CREATE INDEX audit_modification_object_id_idx ON audit_modification (object_id);
+    CREATE INDEX audit_modification_content_type_id_idx ON audit_modification (content_type_id);
+    CREATE INDEX audit_modification_user_id_idx ON audit_modification (user_id);
+
+    -- The check constraint audit_modification_partition_range spares the scan of the old table when it is attached
+    EXECUTE format(
+        'ALTER TABLE audit_modification ATTACH PARTITION audit_modification_legacy FOR VALUES FROM (MINVALUE) TO (%L)',
+        boundary
+    );
+    CREATE TABLE audit_modification_default PARTITION OF audit_modification DEFAULT;
+
+    FOR i IN 0..2 LOOP
+        month_start := boundary + i * interval '1 month';
+        EXECUTE format(
+            'CREATE TABLE %I PARTITION OF audit_modification FOR VALUES FROM (%L) TO (%L)',
+            'audit_modification_p' || to_char(month_start, 'YYYYMM'),
+            month_start,
+            month_start + interval '1 month'
+        );
+    END LOOP;
+END $$;
+"""
+
+
+# Back to a single table: the rows of the partitions still attached are copied into it, the detached partitions are
+# left as they are. Slow on a large table.
+UNPARTITION_MODIFICATION = """
+ALTER TABLE audit_modification RENAME TO audit_modification_partitioned;
+ALTER TABLE audit_modification_partitioned RENAME CONSTRAINT audit_modification_pkey TO audit_modification_partitioned_pkey;
+CREATE TABLE audit_modification (LIKE audit_modification_partitioned INCLUDING DEFAULTS);
+INSERT INTO audit_modification SELECT * FROM audit_modification_partitioned;
+ALTER SEQUENCE audit_modification_id_seq OWNED BY audit_modification.id;
+DROP TABLE audit_modification_partitioned;
+
+ALTER TABLE audit_modification ADD CONSTRAINT audit_modification_pkey PRIMARY KEY (id);
+ALTER TABLE audit_modification ADD CONSTRAINT audit_modification_content_type_id_fk
+    FOREIGN KEY (content_type_id) REFERENCES django_content_type (id) DEFERRABLE INITIALLY DEFERRED;
+ALTER TABLE audit_modification ADD CONSTRAINT audit_modification_user_id_fk
+    FOREIGN KEY (user_id) REFERENCES auth_user (id) DEFERRABLE INITIALLY DEFERRED;
+CREATE INDEX audit_modification_object_id_idx ON audit_modification (object_id);
+CREATE INDEX audit_modification_content_type_id_idx ON audit_modification (content_type_id);
+CREATE INDEX audit_modification_user_id_idx ON audit_modification (user_id);
+"""
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("audit", "0006_modification_partition_prerequisites"),
+    ]
+
+    operations = [
+        migrations.RunSQL(PARTITION_MODIFICATION, reverse_sql=UNPARTITION_MODIFICATION),
+    ]
@@ -0,0 +1,81 @@
+# Generated by Django 4.2.11 on 2026-10-18 20:55
+
+from django.db import migrations, models
+
+# CREATE INDEX CONCURRENTLY is not supported on a partitioned table: the index is created on the partitioned table
+# only (invalid until it has an index on every partition), then built concurrently on each partition and attached.
+# The partitions created later get the index automatically.
+INDEXES = {
+    "audit_mod_object_created_idx": ("object_created", "content_type_id, object_id, created_at DESC"),
+    "audit_mod_source_created_idx": ("source_created", "source, created_at DESC"),
+    "audit_mod_user_created_idx": ("user_created", "user_id, created_at DESC"),
+    "audit_mod_created_idx": ("created", "created_at DESC"),
+}
+
+LIST_PARTITIONS = """
+    SELECT child.relname
+    FROM pg_inherits
+    JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+    JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+    WHERE parent.relname = 'audit_modification' AND parent.relnamespace = to_regnamespace(current_schema())
+"""
+
+
+def create_indexes(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(LIST_PARTITIONS)
+        partitions = [row[0] for row in cursor.fetchall()]
+        for name, (suffix, columns) in INDEXES.items():
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON ONLY audit_modification ({columns})")
+            for partition in partitions:
+                partition_index = f"{partition}_{suffix}_idx"
+                # an index left invalid by an interrupted build is built again
+                cursor.execute(
+                    "SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)", [partition_index]
+                )
+                invalid = cursor.fetchone()
+                if invalid and invalid[0]:
+                    cursor.execute(f"DROP INDEX CONCURRENTLY {partition_index}")
+                cursor.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {partition_index} ON {partition} ({columns})")
+                cursor.execute(f"ALTER INDEX {name} ATTACH PARTITION {partition_index}")
+
+
+def drop_indexes(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        for name in INDEXES:
+            cursor.execute(f"DROP INDEX IF EXISTS {name}")
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY cannot run in a transaction
+    atomic = False
+
+    dependencies = [
+        ("audit", "0007_partition_modification"),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[migrations.RunPython(create_indexes, drop_indexes)],
+            state_operations=[
+                migrations.AddIndex(
+                    model_name="modification",
+                    index=models.Index(
+                        fields=["content_type", "object_id", "-created_at"], name="audit_mod_object_created_idx"
+                    ),
+                ),
+                migrations.AddIndex(
+                    model_name="modification",
+                    index=models.Index(fields=["source", "-created_at"], name="audit_mod_source_created_idx"),
+                ),
+                migrations.AddIndex(
+                    model_name="modification",
+                    index=models.Index(fields=["user", "-created_at"], name="audit_mod_user_created_idx"),
+                ),
+                migrations.AddIndex(
+                    model_name="modification",
+                    index=models.Index(fields=["-created_at"], name="audit_mod_created_idx"),
+                ),
+            ],
+        ),
+    ]
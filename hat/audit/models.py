@@ -57,6 +57,16 @@ class Modification(models.Model):
     user = models.ForeignKey(User, null=True, blank=True, on_delete=models.DO_NOTHING)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        # The table is partitioned by month on created_at, see `hat.audit.partitions`
+        indexes = [
+            # history of an object, as listed by the logs API
+            models.Index(fields=["content_type", "object_id", "-created_at"], name="audit_mod_object_created_idx"),
+            models.Index(fields=["source", "-created_at"], name="audit_mod_source_created_idx"),
+            models.Index(fields=["user", "-created_at"], name="audit_mod_user_created_idx"),
+            models.Index(fields=["-created_at"], name="audit_mod_created_idx"),
+        ]
+
     def __str__(self):
         return "%s - %s - %s - %s" % (
             self.content_type,
@@ -66,6 +76,7 @@ class Modification(models.Model):
         )
 
     def as_dict(self):
+        resolve_blob_refs([self])
         return {
             "id": self.id,
             "content_type": self.content_type.app_label,
@@ -105,7 +116,49 @@ class Modification(models.Model):
         return dict_compare(past_fields, new_fields)
 
 
-def log_modification(v1, v2, source, user=None):
+def is_blob_ref(value):
+    return isinstance(value, dict) and set(value) == {"$blob"}
+
+
+def blob_refs(values):
+    """The blob hashes referenced in the serialized values of a modification"""
+    for value in values or []:
+        for field_value in (value.get("fields") or {}).values():
+            if is_blob_ref(field_value):
+                yield field_value["$blob"]
+
+
+def resolve_blob_refs(modifications):
+    """Replace in place the {"$blob": hash} references of the modifications by their values, in a single query"""
+    hashes = {key for modification in modifications for key in blob_refs(modification.past_value)}
+    hashes.update(key for modification in modifications for key in blob_refs(modification.new_value))
+    if not hashes:
+        return
+    blobs = dict(ModificationBlob.objects.filter(hash__in=hashes).values_list("hash", "value"))
+    for modification in modifications:
+        for values in (modification.past_value, modification.new_value):
+            for value in values or []:
+                fields = value.get("fields") or {}
+                for name, field_value in fields.items():
+                    if is_blob_ref(field_value):
+                        fields[name] = blobs.get(field_value["$blob"])
+
+
+class ModificationBlob(models.Model):
+    """Large field values of the modifications written by `hat.audit.writer.AuditWriter`, stored once per content.
+
+    The modifications reference them as {"$blob": hash} in place of the value."""
+
+    hash = models.CharField(max_length=64, primary_key=True)
+    value = models.JSONField(encoder=IasoJsonEncoder)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.hash
+
+
+def build_modification(v1, v2, source, user=None):
+    """Build, without saving it, the Modification recording the change from v1 to v2"""
     modification = Modification()
     modification.past_value = []
     modification.new_value = []
@@ -121,5 +174,10 @@ def log_modification(v1, v2, source, user=None):
         modification.content_object = v1
     modification.source = source
     modification.user = user
+    return modification
+
+
+def log_modification(v1, v2, source, user=None):
+    modification = build_modification(v1, v2, source, user)
     modification.save()
     return modification
@@ -0,0 +1,158 @@
+import gzip
+import os
+import re
+from datetime import datetime, timezone as dt_timezone
+from typing import List, NamedTuple, Optional
+
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from hat.audit.models import Modification
+
+"""
+Management of the monthly partitions of the audit_modification table (see migration 0007_partition_modification).
+
+Each month is stored in its own partition, named audit_modification_pYYYYMM. The rows older than the partitioning are
+in audit_modification_legacy, the rows outside of any monthly partition in audit_modification_default. The partitions
+of the coming months have to be created in advance (`create_partitions`, run monthly by the `create_audit_partitions`
+task scheduled in cron.yaml, or by the `audit_partitions` command), the old ones can be detached from the table, then
+archived to a compressed CSV file and dropped.
+
+The `ModificationBlob` rows referenced by the archived modifications (`{"$blob": hash}` values) are not archived nor
+deleted: they are shared with the modifications still attached, and are never pruned.
+"""
+
+TABLE = Modification._meta.db_table
+DEFAULT_PARTITION = f"{TABLE}_default"
+PARTITION_NAME = re.compile(rf"^{TABLE}_(p\d{{6}}|legacy)$")
+
+LIST_PARTITIONS = """
+    SELECT child.relname, pg_get_expr(child.relpartbound, child.oid)
+    FROM pg_inherits
+    JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+    JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+    WHERE parent.relname = %s AND parent.relnamespace = to_regnamespace(current_schema())
+"""
+
+LIST_DETACHED_PARTITIONS = """
+    SELECT relname FROM pg_class
+    WHERE relkind = 'r' AND NOT relispartition AND relname ~ %s
+    AND relnamespace = to_regnamespace(current_schema())
+    ORDER BY relname
+"""
+
+BOUND = re.compile(r"FROM \((?:MINVALUE|'([^']+)')\) TO \('([^']+)'\)")
+
+
+class Partition(NamedTuple):
+    name: str
+    # None for the legacy partition
+    start: Optional[datetime]
+    end: Optional[datetime]
+    is_default: bool
+
+
+def month_start(date: datetime) -> datetime:
+    return date.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def add_months(date: datetime, months: int) -> datetime:
+    year, month = divmod(date.month - 1 + months, 12)
+    return date.replace(year=date.year + year, month=month + 1)
+
+
+def parse_partition(name: str, bound: str) -> Partition:
+    if bound == "DEFAULT":
+        return Partition(name, None, None, True)
+    start, end = BOUND.search(bound).groups()
+    return Partition(name, parse_datetime(start) if start else None, parse_datetime(end), False)
+
+
+def is_partitioned() -> bool:
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT EXISTS (SELECT FROM pg_partitioned_table WHERE partrelid = to_regclass(%s))", [TABLE])
+        return cursor.fetchone()[0]
+
+
+def list_partitions() -> List[Partition]:
+    """The partitions attached to the table, ordered by start date, the default partition last"""
+    with connection.cursor() as cursor:
+        cursor.execute(LIST_PARTITIONS, [TABLE])
+        partitions = [parse_partition(name, bound) for name, bound in cursor.fetchall()]
+    return sorted(partitions, key=lambda p: (p.is_default, p.start is not None, p.start.timestamp() if p.start else 0))
+
+
+def list_detached_partitions() -> List[str]:
+    with connection.cursor() as cursor:
+        cursor.execute(LIST_DETACHED_PARTITIONS, [PARTITION_NAME.pattern])
+        return [name for (name,) in cursor.fetchall()]
+
+
+def create_partition(start: datetime, end: datetime) -> str:
+    """Create the partition from start to end, moving in it the rows of this range stored in the default partition"""
+    name = f"{TABLE}_p{start:%Y%m}"
+    quote = connection.ops.quote_name
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f"CREATE TABLE {quote(name)} (LIKE {quote(TABLE)} INCLUDING DEFAULTS)")
+        cursor.execute(
+            f"""
+            WITH moved AS (
+                DELETE FROM {quote(DEFAULT_PARTITION)} WHERE created_at >= %s AND created_at < %s RETURNING *
+            )
+            INSERT INTO {quote(name)} SELECT * FROM moved
+            """,
+            [start, end],
+        )
+        cursor.execute(
+            f"ALTER TABLE {quote(TABLE)} ATTACH PARTITION {quote(name)} FOR VALUES FROM (%s) TO (%s)", [start, end]
+        )
+    return name
+
+
+def create_partitions(months: int, now: Optional[datetime] = None) -> List[str]:
+    """Create the missing monthly partitions, from the end of the last one up to `months` after the current month"""
+    current_month = month_start((now or timezone.now()).astimezone(dt_timezone.utc))
+    ends = [partition.end for partition in list_partitions() if not partition.is_default]
+    start = min(max(ends), current_month) if ends else current_month
+    last = add_months(current_month, months)
+    created = []
+    while start <= last:
+        end = add_months(start, 1)
+        if not ends or start >= max(ends):
+            created.append(create_partition(start, end))
+        start = end
+    return created
+
+
+def detach_partitions(before: datetime) -> List[str]:
+    """Detach from the table the partitions ending before `before`, their rows are no longer visible in the logs"""
+    detached = []
+    quote = connection.ops.quote_name
+    with transaction.atomic(), connection.cursor() as cursor:
+        for partition in list_partitions():
+            if not partition.is_default and partition.end <= before:
+                cursor.execute(f"ALTER TABLE {quote(TABLE)} DETACH PARTITION {quote(partition.name)}")
+                detached.append(partition.name)
+    return detached
+
+
+def archive_partition(name: str, directory: str) -> str:
+    """Dump a detached partition to <directory>/<name>.csv.gz, then drop it. Returns the path of the archive.
+
+    The archive keeps the `{"$blob": hash}` references of the values, the ModificationBlob rows are left in place."""
+    if name not in list_detached_partitions():
+        raise ValueError(f"{name} is not a detached partition of {TABLE}")
+    path = os.path.join(directory, f"{name}.csv.gz")
+    quote = connection.ops.quote_name
+    # "x": never overwrite a previous archive
+    archive = gzip.open(path, "xb")
+    try:
+        with archive, connection.cursor() as cursor:
+            cursor.copy_expert(f"COPY {quote(name)} TO STDOUT WITH (FORMAT csv, HEADER)", archive)
+    except Exception:
+        os.remove(path)
+        raise
+    with connection.cursor() as cursor:
+        cursor.execute(f"DROP TABLE {quote(name)}")
+    return path
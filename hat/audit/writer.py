@@ -0,0 +1,191 @@
+import atexit
+import hashlib
+import json
+import logging
+import queue
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+from django.core import serializers
+from django.db import close_old_connections, connection, transaction
+
+from hat.audit.models import INSTANCE_API, IasoJsonEncoder, Modification, ModificationBlob
+
+logger = logging.getLogger(__name__)
+
+"""
+Buffered writer of the audit log, for the code paths saving many modifications (bulk tasks, imports, form uploads).
+
+Contrary to `log_modification`, which stores the full serialization of both versions of the object, the writer only
+stores the fields which changed, in the same format (`[{"model": ..., "pk": ..., "fields": {...}}]`) so
+`Modification.field_diffs` and the logs API work the same. The modifications of FULL_SNAPSHOT_SOURCES keep all the
+fields, as the submission history screen compares the whole snapshots. Values larger than LARGE_VALUE_SIZE (geometries,
+submission json, ...) are stored once in `ModificationBlob` and replaced by {"$blob": hash}, which
+`Modification.as_dict` and the logs API resolve when reading.
+
+The entries logged in a transaction are buffered and inserted with bulk_create when it is committed, or when
+BATCH_SIZE entries are pending. `flush()` writes the pending entries of the current transaction immediately, for the
+callers that want the audit in the same transaction. With the AUDIT_WRITER_ASYNC setting, the entries are written by a
+background thread once the transaction is committed, so the committing request doesn't wait for them.
+"""
+
+BATCH_SIZE = 500
+LARGE_VALUE_SIZE = 1024
+FULL_SNAPSHOT_SOURCES = {INSTANCE_API}
+
+Entry = Tuple[Modification, Dict[str, object]]
+
+
+def serialize(obj) -> dict:
+    return json.loads(serializers.serialize("json", [obj]))[0]
+
+
+def blob_hash(value) -> str:
+    return hashlib.sha256(json.dumps(value, cls=IasoJsonEncoder, sort_keys=True).encode()).hexdigest()
+
+
+def externalize_large_values(serialized: dict, blobs: Dict[str, object]) -> dict:
+    """Replace the large field values of serialized by a reference to their blob, collected in blobs"""
+    fields = {}
+    for name, value in serialized["fields"].items():
+        if isinstance(value, (str, list, dict)) and len(json.dumps(value, cls=IasoJsonEncoder)) > LARGE_VALUE_SIZE:
+            key = blob_hash(value)
+            blobs[key] = value
+            value = {"$blob": key}
+        fields[name] = value
+    return {**serialized, "fields": fields}
+
+
+def build_diff_modification(v1, v2, source, user=None) -> Entry:
+    """Build, without saving it, the Modification with the fields changed from v1 to v2, and the blobs it references"""
+    past = serialize(v1) if v1 else None
+    new = serialize(v2) if v2 else None
+    if past and new and source not in FULL_SNAPSHOT_SOURCES:
+        changed = {
+            name for name in {*past["fields"], *new["fields"]} if past["fields"].get(name) != new["fields"].get(name)
+        }
+        past["fields"] = {name: value for name, value in past["fields"].items() if name in changed}
+        new["fields"] = {name: value for name, value in new["fields"].items() if name in changed}
+
+    blobs: Dict[str, object] = {}
+    modification = Modification(source=source, user=user)
+    modification.past_value = [externalize_large_values(past, blobs)] if past else []
+    modification.new_value = [externalize_large_values(new, blobs)] if new else []
+    modification.object_id = (v1 or v2).id
+    modification.content_object = v2 or v1
+    return modification, blobs
+
+
+def write_entries(entries: List[Entry]) -> None:
+    blobs: Dict[str, object] = {}
+    for _modification, entry_blobs in entries:
+        blobs.update(entry_blobs)
+    ModificationBlob.objects.bulk_create(
+        [ModificationBlob(hash=key, value=value) for key, value in blobs.items()],
+        batch_size=BATCH_SIZE,
+        ignore_conflicts=True,
+    )
+    Modification.objects.bulk_create([modification for modification, _blobs in entries], batch_size=BATCH_SIZE)
+
+
+class PendingBatch:
+    """Entries logged in a transaction (or savepoint), written when it is committed"""
+
+    def __init__(self, writer: "AuditWriter"):
+        self.entries: List[Entry] = []
+        self.savepoint_ids = list(connection.savepoint_ids)
+        self.on_commit = lambda: writer.write(self.entries, background=writer.async_mode)
+
+    def is_pending(self) -> bool:
+        # The callbacks of a rolled back transaction or savepoint are discarded by Django, with their entries
+        return any(callback[1] is self.on_commit for callback in connection.run_on_commit)
+
+
+class AuditWriter:
+    def __init__(self, async_mode: Optional[bool] = None, batch_size: int = BATCH_SIZE):
+        self._async_mode = async_mode
+        self.batch_size = batch_size
+        self._local = threading.local()
+        self._queue: "queue.Queue[List[Entry]]" = queue.Queue()
+        self._worker: Optional[threading.Thread] = None
+        self._worker_lock = threading.Lock()
+
+    @property
+    def async_mode(self) -> bool:
+        return settings.AUDIT_WRITER_ASYNC if self._async_mode is None else self._async_mode
+
+    def pending_batches(self) -> List[PendingBatch]:
+        """The batches of this thread waiting for the commit of the current transaction"""
+        batches = [batch for batch in getattr(self._local, "batches", []) if batch.is_pending()]
+        self._local.batches = batches
+        return batches
+
+    def log(self, v1, v2, source, user=None) -> None:
+        """Same as `log_modification`, but buffered and storing only the changed fields"""
+        entry = build_diff_modification(v1, v2, source, user)
+        if not connection.in_atomic_block:
+            self.write([entry], background=self.async_mode)
+            return
+
+        batches = self.pending_batches()
+        if batches and batches[-1].savepoint_ids == connection.savepoint_ids:
+            batch = batches[-1]
+        else:
+            batch = PendingBatch(self)
+            batches.append(batch)
+            transaction.on_commit(batch.on_commit)
+        batch.entries.append(entry)
+        if len(batch.entries) >= self.batch_size:
+            self.flush()
+
+    def log_many(self, pairs: Iterable[tuple], source, user=None) -> None:
+        for v1, v2 in pairs:
+            self.log(v1, v2, source, user)
+
+    def flush(self) -> None:
+        """Write now, in the current transaction, the entries pending in it
+
+        Only the entries logged in the current savepoint are written: the ones of the outer savepoints would be lost
+        with it if it were rolled back, they are written when their own savepoint is flushed or committed."""
+        if not connection.in_atomic_block:
+            return
+        for batch in self.pending_batches():
+            if batch.savepoint_ids == connection.savepoint_ids:
+                self.write(batch.entries, background=False)
+                batch.entries.clear()
+
+    def write(self, entries: List[Entry], background: bool) -> None:
+        if not entries:
+            return
+        if not background:
+            write_entries(entries)
+            return
+        # Copy, the batch may be cleared by the caller
+        self._queue.put(list(entries))
+        self._start_worker()
+
+    def wait(self) -> None:
+        """Block until the entries queued for the background thread are written"""
+        self._queue.join()
+
+    def _start_worker(self) -> None:
+        with self._worker_lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._work, name="audit-writer", daemon=True)
+                self._worker.start()
+
+    def _work(self) -> None:
+        while True:
+            entries = self._queue.get()
+            try:
+                close_old_connections()
+                write_entries(entries)
+            except Exception:
+                logger.exception("Could not write %d audit entries", len(entries))
+            finally:
+                self._queue.task_done()
+
+
+audit_writer = AuditWriter()
+atexit.register(audit_writer.wait)
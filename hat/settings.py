@@ -561,6 +561,31 @@ elif BACKGROUND_BACKEND == "SQS":
 else:
     raise Exception("BACKGROUND_TASK_SERVICE needs to one of: POSTGRES, SQS")
 
+# A RUNNING task whose heartbeat is older than this is considered abandoned by a crashed worker and is requeued or
+# marked as errored, see `reap_expired_tasks` in beanstalk_worker/services.py
+TASK_LEASE_SECONDS = int(os.environ.get("TASK_LEASE_SECONDS", 3600))
+# The worker updates the heartbeat of the task it is running at this interval, see `Heartbeat`
+TASK_HEARTBEAT_SECONDS = int(os.environ.get("TASK_HEARTBEAT_SECONDS", TASK_LEASE_SECONDS // 4))
+
+# Read the submission counts of the completeness stats from the precomputed CompletenessRollup table, populate it
+# with the refresh_completeness_rollup management command before enabling.
+COMPLETENESS_STATS_USE_ROLLUP = os.environ.get("COMPLETENESS_STATS_USE_ROLLUP", "false").lower() == "true"
+
+# Duration for which the org unit vector tiles (/api/orgunits/tiles/) are cached, server side and by the browsers
+ORG_UNIT_TILES_CACHE_SECONDS = int(os.environ.get("ORG_UNIT_TILES_CACHE_SECONDS", 300))
+
+# Local directory where the files shared by the mobile app setup bundles (form versions, attachments, reports) are
+# kept between exports, and the number of days an unused file is kept
+MOBILE_SETUP_ARTIFACTS_DIR = os.environ.get("MOBILE_SETUP_ARTIFACTS_DIR", "/tmp/mobile-app-setup-artifacts")
+MOBILE_SETUP_ARTIFACTS_MAX_AGE_DAYS = int(os.environ.get("MOBILE_SETUP_ARTIFACTS_MAX_AGE_DAYS", 7))
+
+# Number of pages of submissions posted to DHIS2 concurrently by the data value exporter
+DHIS2_EXPORT_CONCURRENCY = int(os.environ.get("DHIS2_EXPORT_CONCURRENCY", 4))
+
+# Write the audit entries buffered by `hat.audit.writer.audit_writer` from a background thread once the transaction
+# is committed, instead of in the committing thread
+AUDIT_WRITER_ASYNC = os.environ.get("AUDIT_WRITER_ASYNC", "false").lower() == "true"
+
 DISABLE_SSL_REDIRECT = bool(os.environ.get("DISABLE_SSL_REDIRECT", False))
 SSL_ON = not (DEBUG or BEANSTALK_WORKER or DISABLE_SSL_REDIRECT)
 if SSL_ON:
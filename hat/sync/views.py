@@ -8,7 +8,8 @@ from django.http.request import HttpRequest
 from django.views.decorators.csrf import csrf_exempt
 from rest_framework.decorators import api_view, permission_classes, authentication_classes
 
-from hat.audit.models import log_modification, INSTANCE_API
+from hat.audit.models import INSTANCE_API
+from hat.audit.writer import audit_writer
 from hat.settings import SECRET_KEY
 from iaso.models import Instance, InstanceFile, FeatureFlag
 
@@ -69,6 +70,6 @@ def form_upload(request: HttpRequest) -> HttpResponse:
     if i.project and i.project.has_feature(FeatureFlag.INSTANT_EXPORT):
         i.export()
 
-    log_modification(i, i, source=INSTANCE_API, user=user)
+    audit_writer.log(None, i, source=INSTANCE_API, user=user)
 
     return JsonResponse({"result": "success"}, status=201)
@@ -31,11 +31,12 @@ This endpoint is used to display the completeness stats in the dashboard. Comple
 """
 
 from typing import Optional, Any
-from typing import TypedDict, Mapping, List, Union
+from typing import TypedDict, Mapping, List, Union, Set, Dict, Iterable
 
 import rest_framework.fields
 import rest_framework.renderers
 import rest_framework_csv.renderers
+from django.conf import settings
 from django.core.paginator import Paginator
 from django.db import models
 from django.db.models import QuerySet, OrderBy, Q
@@ -52,7 +53,7 @@ from rest_framework.response import Response
 from rest_framework.serializers import ModelSerializer
 from typing_extensions import Annotated
 
-from iaso.models import OrgUnit, Form, OrgUnitType, Instance, Group
+from iaso.models import OrgUnit, Form, OrgUnitType, Instance, Group, CompletenessRollup
 from .common import HasPermission
 from ..models.microplanning import Planning, Team
 from ..models.org_unit import OrgUnitQuerySet
@@ -218,9 +219,16 @@ class ParamSerializer(serializers.Serializer):
         return Form.objects.filter(id__in=[f.id for f in forms])
 
 
-def has_children(row_ou):
-    children_count = row_ou.descendants().exclude(pk=row_ou.id).count()
-    return True if children_count > 0 else False
+def get_ids_with_children(org_unit_ids: List[int]) -> Set[int]:
+    """Ids of the given org units that have at least one child, in one query for a whole page of results"""
+    return set(OrgUnit.objects.filter(parent_id__in=org_unit_ids).values_list("parent_id", flat=True).distinct())
+
+
+def get_simplified_geo_jsons(org_unit_ids: List[int]) -> Dict[int, dict]:
+    """Simplified shape of each of the given org units, as returned by geojson_queryset but in one query"""
+    collection = geojson_queryset(OrgUnit.objects.filter(id__in=org_unit_ids), geometry_field="simplified_geom")
+    features = collection.pop("features")
+    return {feature["id"]: {**collection, "features": [feature]} for feature in features}
 
 
 class CompletenessStatsV2ViewSet(viewsets.ViewSet):
@@ -341,9 +349,16 @@ class CompletenessStatsV2ViewSet(viewsets.ViewSet):
             # Pass by the ids to avoid strange effects.
             planning_orgunit_ids = list(assigned_orgunits.distinct().values_list("id", flat=True))
             orgunit_qs = orgunit_qs.filter(id__in=planning_orgunit_ids)
+        # The precomputed counts can be used if the instances are not filtered on anything else than the period
+        rollup_qs = None
+        if settings.COMPLETENESS_STATS_USE_ROLLUP and not (planning or teams or users):
+            rollup_qs = CompletenessRollup.objects.all()
+            if period:
+                rollup_qs = rollup_qs.filter(period=period)
+
         # Annotate the query with the form info
         ou_with_stats = get_annotated_queryset(
-            root_qs=top_ous, form_qs=form_qs, instance_qs=instance_qs, orgunit_qs=orgunit_qs
+            root_qs=top_ous, form_qs=form_qs, instance_qs=instance_qs, orgunit_qs=orgunit_qs, rollup_qs=rollup_qs
         )
 
         # Ordering
@@ -386,7 +401,7 @@ class CompletenessStatsV2ViewSet(viewsets.ViewSet):
                     ),
                 )
 
-        def to_dict(row_ou: OrgUnitWithFormStat):
+        def to_dict(row_ou: OrgUnitWithFormStat, ids_with_children: Set[int]):
             return {
                 "name": row_ou.name,
                 "id": row_ou.id,
@@ -394,10 +409,10 @@ class CompletenessStatsV2ViewSet(viewsets.ViewSet):
                 "form_stats": row_ou.form_stats,
                 "org_unit_type": row_ou.org_unit_type.as_minimal_dict() if row_ou.org_unit_type else {},
                 "parent_org_unit": row_ou.parent.as_minimal_dict_with_parent() if row_ou.parent else None,
-                "has_children": has_children(row_ou),
+                "has_children": row_ou.id in ids_with_children,
             }
 
-        def to_map(row_ou: OrgUnitWithFormStat):
+        def to_map(row_ou: OrgUnitWithFormStat, ids_with_children: Set[int], geo_jsons: Dict[int, dict]):
             temp_org_unit = {
                 "name": row_ou.name,
                 "id": row_ou.id,
@@ -409,23 +424,31 @@ class CompletenessStatsV2ViewSet(viewsets.ViewSet):
                 "altitude": row_ou.location.z if row_ou.location else None,
                 "org_unit_type": row_ou.org_unit_type.as_minimal_dict() if row_ou.org_unit_type else {},
                 "parent_org_unit": row_ou.parent.as_minimal_dict_with_parent() if row_ou.parent else None,
-                "has_children": has_children(row_ou),
+                "has_children": row_ou.id in ids_with_children,
             }
             if temp_org_unit["has_geo_json"] == True:
-                shape_queryset = OrgUnit.objects.all().filter(id=temp_org_unit["id"])
-                temp_org_unit["geo_json"] = geojson_queryset(shape_queryset, geometry_field="simplified_geom")
+                temp_org_unit["geo_json"] = geo_jsons.get(row_ou.id)
             return temp_org_unit
 
+        def to_rows(org_units: Iterable[OrgUnitWithFormStat], is_map: bool) -> List[dict]:
+            # children and shapes are fetched for all the rows at once, not per row
+            org_units = list(org_units)
+            ids_with_children = get_ids_with_children([ou.id for ou in org_units])
+            if not is_map:
+                return [to_dict(ou, ids_with_children) for ou in org_units]
+            geo_jsons = get_simplified_geo_jsons([ou.id for ou in org_units if ou.simplified_geom])
+            return [to_map(ou, ids_with_children, geo_jsons) for ou in org_units]
+
         def with_parent(list_objects, is_map):
             # If a particular parent is requested we calculate its own stats
             #  and put it on the top of the list
             temp_list = list_objects
             if parent_ou and not params.get("without_submissions"):
                 ou_qs = OrgUnit.objects.filter(id=parent_ou.id)
-                ou_qs = get_annotated_queryset(ou_qs, orgunit_qs, instance_qs, form_qs)
+                ou_qs = get_annotated_queryset(ou_qs, orgunit_qs, instance_qs, form_qs, rollup_qs)
 
                 if ou_qs.count() > 0:
-                    top_row_ou = to_dict(ou_qs[0]) if not is_map else to_map(ou_qs[0])
+                    top_row_ou = to_rows(ou_qs[:1], is_map)[0]
                     top_row_ou["is_root"] = True
                     temp_list.insert(0, top_row_ou)
 
@@ -446,7 +469,7 @@ class CompletenessStatsV2ViewSet(viewsets.ViewSet):
             if paginator.count <= 0:
                 object_list = []
             else:
-                object_list = [to_dict(ou) for ou in page.object_list]
+                object_list = to_rows(page.object_list, False)
             object_list = with_parent(object_list, False)
 
             paginated_res = {
@@ -473,10 +496,10 @@ class CompletenessStatsV2ViewSet(viewsets.ViewSet):
         if as_location:
             ou_with_stats = ou_with_stats.filter(Q(location__isnull=False) | Q(simplified_geom__isnull=False))
             if ou_with_stats.count() > 0:
-                object_list = with_parent([to_map(ou) for ou in ou_with_stats], True)
+                object_list = with_parent(to_rows(ou_with_stats, True), True)
         else:
             if ou_with_stats.count() > 0:
-                object_list = with_parent([to_dict(ou) for ou in ou_with_stats], True)
+                object_list = with_parent(to_rows(ou_with_stats, False), True)
         return Response({"results": object_list})
 
     @action(methods=["GET"], detail=False)
@@ -544,6 +567,22 @@ OU_COUNT_QUERY = """
     GROUP BY "iaso_orgunit"."path", "iaso_form"."id"
     """
 
+# Same as OU_COUNT_QUERY but with the counts precomputed in CompletenessRollup
+OU_COUNT_ROLLUP_QUERY = """
+    SELECT "iaso_orgunit"."path",
+        "iaso_form"."id" AS "form_id",
+        COALESCE(SUM("rollup"."instances_count"), 0) AS "instances_count"
+    FROM "filtered_forms" AS "iaso_form"
+    JOIN "iaso_form_org_unit_types"
+    ON "iaso_form"."id" = "iaso_form_org_unit_types"."form_id"
+    LEFT OUTER JOIN "filtered_orgunit" AS "iaso_orgunit"
+    ON ("iaso_orgunit"."org_unit_type_id" = "iaso_form_org_unit_types"."orgunittype_id")
+    LEFT OUTER JOIN "filtered_rollup" AS "rollup"
+    ON ("iaso_orgunit"."id" = "rollup"."org_unit_id"
+    AND "iaso_form"."id" = "rollup"."form_id")
+    GROUP BY "iaso_orgunit"."path", "iaso_form"."id"
+    """
+
 COUNT_PER_ROOT_QUERY = """
     SELECT root.id,
         "ou_count"."form_id",
@@ -563,7 +602,11 @@ COUNT_PER_ROOT_QUERY = """
 
 
 def get_annotated_queryset(
-    root_qs: QuerySet[OrgUnit], orgunit_qs: QuerySet[OrgUnit], instance_qs: QuerySet[Instance], form_qs: QuerySet[Form]
+    root_qs: QuerySet[OrgUnit],
+    orgunit_qs: QuerySet[OrgUnit],
+    instance_qs: QuerySet[Instance],
+    form_qs: QuerySet[Form],
+    rollup_qs: Optional[QuerySet[CompletenessRollup]] = None,
 ):
     """Annotate the form stats via CTE. Add a form_stat annotation
 
@@ -574,6 +617,8 @@ def get_annotated_queryset(
     :param orgunit_qs: OrgUnit on which we count the instances. to be used for filtering
     :param form_qs: Form for which we count the instance. Each "column" in the json
     :param instance_qs: Instance to count. to be used for filter. eg on a period
+    :param rollup_qs: If provided, read the number of instances from these precomputed counts instead of counting
+      the instances of instance_qs.
 
 
     """
@@ -581,7 +626,12 @@ def get_annotated_queryset(
     # Name are referenced by the other cte query so don't modify them
     root_ou_cte = With(root_qs, name="filtered_roots")
     form_cte = With(form_qs.only("id", "name", "legend_threshold"), name="filtered_forms")
-    instances_cte = With(instance_qs.only("id", "org_unit_id", "form_id", "file", "deleted"), name="filtered_instance")
+    if rollup_qs is not None:
+        instances_cte = With(rollup_qs.only("org_unit_id", "form_id", "instances_count"), name="filtered_rollup")
+    else:
+        instances_cte = With(
+            instance_qs.only("id", "org_unit_id", "form_id", "file", "deleted"), name="filtered_instance"
+        )
     filter_ou_cte = With(orgunit_qs.only("id", "org_unit_type_id", "path"), name="filtered_orgunit")
 
     pivot_cte = raw_cte_sql(
@@ -594,7 +644,7 @@ def get_annotated_queryset(
     )
     pivot_with = With(pivot_cte, name="pivot")
     ou_count_cte = raw_cte_sql(
-        OU_COUNT_QUERY,
+        OU_COUNT_ROLLUP_QUERY if rollup_qs is not None else OU_COUNT_QUERY,
         [],
         {
             "path": models.CharField(),
@@ -26,3 +26,20 @@ def finalize_from_task(the_task: Task, potential_duplicates: List[PotentialDupli
 
     eda.finished_at = now()
     eda.save()
+
+
+def save_potential_duplicates(eda, potential_duplicates: List[PotentialDuplicate]):
+    """Save a batch of potential duplicates found by the analyzis `eda`, the pairs already known are ignored"""
+    ed_model = apps.get_model("iaso", "EntityDuplicate")
+    ed_model.objects.bulk_create(
+        [
+            ed_model(
+                entity1_id=int(pot_dup["entity1_id"]),
+                entity2_id=int(pot_dup["entity2_id"]),
+                analyze=eda,
+                similarity_score=pot_dup["score"],
+            )
+            for pot_dup in potential_duplicates
+        ],
+        ignore_conflicts=True,
+    )
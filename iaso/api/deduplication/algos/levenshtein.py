@@ -1,19 +1,24 @@
 from typing import List
 
+from django.apps import apps
 from django.db import connection
+from django.utils.timezone import now
 
 from ..common import PotentialDuplicate  # type: ignore
 from .base import DeduplicationAlgorithm
-from .finalize import finalize_from_task
+from .finalize import finalize_from_task, save_potential_duplicates
 
 LEVENSHTEIN_MAX_DISTANCE = 3
 ABOVE_SCORE_DISPLAY = 50
+STREAMING_BATCH_SIZE = 5000
+# temporary table of the phonetic keys of the entities, computed once by run_streaming for all the batches
+ENTITY_KEYS_TABLE = "levenshtein_entity_keys"
 
 # We need to make sure the extension is loaded in the database
 # CREATE EXTENSION fuzzystrmatch;
 
 
-def _build_query(params):
+def _build_query(params, since=None, entity1_range=None, entity_keys_table=None):
     the_fields = params.get("fields", [])
     custom_params = params.get("parameters", {})
     levenshtein_max_distance = custom_params.get("levenshtein_max_distance", LEVENSHTEIN_MAX_DISTANCE)
@@ -43,42 +48,176 @@ def _build_query(params):
 
     fields_comparison = " + ".join(fc_arr)
 
-    query_params.append(params.get("entity_type_id"))
-    query_params.append(params.get("entity_type_id"))
+    entity_type_id = params.get("entity_type_id")
+    extra_filters = ""
+    since_params = []
+    if since is not None:
+        # Only compare pairs where one of the entities is new or was modified since the previous analyzis
+        extra_filters = "AND (entity1.created_at > %s OR instance1.updated_at > %s OR instance2.updated_at > %s)"
+        since_params = [since, since, since]
+
+    if entity1_range is not None:
+        extra_filters += " AND entity1.id BETWEEN %s AND %s"
+        since_params += list(entity1_range)
+
+    text_fields = _blocking_fields(params)
+    if text_fields:
+        blocking_params, candidates = _build_candidates_query(
+            text_fields, entity_type_id, entity1_range, entity_keys_table
+        )
+        # The candidate pairs are computed first so the (slow) scoring below only runs on them
+        query_params = blocking_params + query_params
+        from_clause = """candidates
+        JOIN iaso_entity entity1 ON entity1.id = candidates.entity1_id
+        JOIN iaso_entity entity2 ON entity2.id = candidates.entity2_id
+        JOIN iaso_instance instance1 ON entity1.attributes_id = instance1.id
+        JOIN iaso_instance instance2 ON entity2.attributes_id = instance2.id
+        WHERE TRUE"""
+    else:
+        candidates = ""
+        from_clause = """iaso_entity entity1, iaso_entity entity2, iaso_instance instance1, iaso_instance instance2
+        WHERE entity1.id != entity2.id
+        AND entity1.attributes_id = instance1.id
+        AND entity2.attributes_id = instance2.id
+        AND entity1.created_at > entity2.created_at"""
+
+    query_params.append(entity_type_id)
+    query_params.append(entity_type_id)
+    query_params.extend(since_params)
     query_params.append(above_score_display)
 
     return (
         query_params,
         f"""
+    {candidates}
     SELECT * FROM (
         SELECT
         entity1.id,
         entity2.id,
         cast (({fields_comparison}) / {n} * 100 as smallint) as score
-        FROM iaso_entity entity1, iaso_entity entity2, iaso_instance instance1, iaso_instance instance2
-        WHERE entity1.id != entity2.id
-        AND entity1.attributes_id = instance1.id
-        AND entity2.attributes_id = instance2.id
-        AND entity1.created_at > entity2.created_at
+        FROM {from_clause}
         AND entity1.entity_type_id = %s
         AND entity2.entity_type_id = %s
         AND entity1.deleted_at IS NULL
         AND entity2.deleted_at IS NULL
+        {extra_filters}
         AND NOT EXISTS (SELECT id FROM iaso_entityduplicate WHERE iaso_entityduplicate.entity1_id = entity1.id AND iaso_entityduplicate.entity2_id = entity2.id)
     ) AS subquery_high_score WHERE score > %s ORDER BY score DESC
     """,
     )
 
 
+def _blocking_fields(params):
+    """The text fields used for blocking, none if it is disabled"""
+    if not params.get("parameters", {}).get("blocking", False):
+        return []
+    return [field.get("name") for field in params.get("fields", []) if field.get("type") == "text"]
+
+
+def _build_entity_keys_query(text_fields, entity_type_id):
+    """The phonetic keys of the entities, one row per (entity, key)"""
+    keys = []
+    query_params = []
+    for index, f_name in enumerate(text_fields):
+        for function in ("dmetaphone", "dmetaphone_alt"):
+            keys.append(f"('{index}:' || NULLIF({function}(instance.json->>%s), ''))")
+            query_params.append(f_name)
+    query_params.append(entity_type_id)
+    entity_keys = ", ".join(keys)
+
+    return (
+        query_params,
+        f"""
+        SELECT DISTINCT entity.id AS entity_id, entity.created_at, entity_key.value AS key
+        FROM iaso_entity entity
+        JOIN iaso_instance instance ON entity.attributes_id = instance.id
+        CROSS JOIN LATERAL (VALUES {entity_keys}) AS entity_key(value)
+        WHERE entity.entity_type_id = %s
+        AND entity.deleted_at IS NULL
+        AND entity_key.value IS NOT NULL""",
+    )
+
+
+def _build_candidates_query(text_fields, entity_type_id, entity1_range=None, entity_keys_table=None):
+    """Blocking: only the pairs of entities sharing a phonetic key (double metaphone) on one of the text fields are
+    candidates. Each entity gets a few keys, so joining on them is linear in the number of entities instead of
+    comparing all the pairs.
+
+    Pairs where all the text fields differ phonetically (e.g. typos on the first letters of every field) are missed,
+    which is why it is only used with the `blocking: true` parameter.
+
+    The keys are read from entity_keys_table when given (see `_create_entity_keys_table`), else computed in the query.
+    """
+    if entity_keys_table:
+        query_params = []
+        entity_keys = f"entity_keys AS (SELECT * FROM {entity_keys_table})"
+    else:
+        query_params, keys_query = _build_entity_keys_query(text_fields, entity_type_id)
+        entity_keys = f"entity_keys AS ({keys_query}\n    )"
+    range_filter = ""
+    if entity1_range is not None:
+        range_filter = "WHERE keys1.entity_id BETWEEN %s AND %s"
+        query_params += list(entity1_range)
+
+    return (
+        query_params,
+        f"""
+    WITH {entity_keys}, candidates AS (
+        SELECT DISTINCT keys1.entity_id AS entity1_id, keys2.entity_id AS entity2_id
+        FROM entity_keys keys1
+        JOIN entity_keys keys2 ON keys1.key = keys2.key AND keys1.created_at > keys2.created_at
+        {range_filter}
+    )""",
+    )
+
+
+def _create_entity_keys_table(cursor, text_fields, entity_type_id):
+    """Compute the phonetic keys of the entities once, in a temporary table of the connection"""
+    query_params, keys_query = _build_entity_keys_query(text_fields, entity_type_id)
+    cursor.execute(f"DROP TABLE IF EXISTS {ENTITY_KEYS_TABLE}")
+    cursor.execute(f"CREATE TEMPORARY TABLE {ENTITY_KEYS_TABLE} AS {keys_query}", query_params)
+    cursor.execute(f"CREATE INDEX ON {ENTITY_KEYS_TABLE} (key)")
+    cursor.execute(f"CREATE INDEX ON {ENTITY_KEYS_TABLE} (entity_id)")
+    cursor.execute(f"ANALYZE {ENTITY_KEYS_TABLE}")
+
+
+def _get_previous_analyzis_date(params, task):
+    """Start date of the last finished analyzis of the same entity type and fields, used by the incremental mode"""
+    current = task.entity_duplicate_analyzis.first() if task else None
+    previous = (
+        apps.get_model("iaso", "EntityDuplicateAnalyzis")
+        .objects.filter(metadata__entity_type_id=params.get("entity_type_id"), finished_at__isnull=False)
+        .exclude(id=current.id if current else None)
+        .order_by("-created_at")
+    )
+    field_names = [field.get("name") for field in params.get("fields", [])]
+    for analyzis in previous:
+        if analyzis.metadata.get("fields") == field_names:
+            return analyzis.created_at
+    return None
+
+
 @DeduplicationAlgorithm.register("levenshtein")
 class InverseAlgorithm(DeduplicationAlgorithm):
     """
     This algorithm has the following custom parameters:
     levenshtein_max_distance: the maximum distance for the levenshtein algorithm (defaults to LEVENSHTEIN_MAX_DISTANCE)
     above_score_display: the minimum score to display (defaults to ABOVE_SCORE_DISPLAY)
+    blocking: only score the pairs sharing a phonetic key on a text field (defaults to False), faster on large entity
+        types but some pairs may be missed, see _build_candidates_query
+    incremental: only compare the entities created or modified since the previous analyzis of the same entity type
+        and fields (defaults to False)
+    streaming: save the duplicates by batches instead of all at the end, for large entity types (defaults to False),
+        see run_streaming
     """
 
     def run(self, params, task=None) -> List[PotentialDuplicate]:
+        since = None
+        if params.get("parameters", {}).get("incremental", False):
+            since = _get_previous_analyzis_date(params, task)
+        if params.get("parameters", {}).get("streaming", False):
+            return self.run_streaming(params, task, since)
+
         count = 100
 
         task.report_progress_and_stop_if_killed(
@@ -90,7 +229,7 @@ class InverseAlgorithm(DeduplicationAlgorithm):
         cursor = connection.cursor()
         potential_duplicates = []
         try:
-            the_params, the_query = _build_query(params)
+            the_params, the_query = _build_query(params, since)
             cursor.execute(the_query, the_params)
 
             while True:
@@ -113,3 +252,70 @@ class InverseAlgorithm(DeduplicationAlgorithm):
         finalize_from_task(task, potential_duplicates)
 
         return potential_duplicates
+
+    def run_streaming(self, params, task, since=None) -> List[PotentialDuplicate]:
+        """Compare the entities by batches of STREAMING_BATCH_SIZE and save the duplicates found after each batch.
+
+        The results are not kept in memory nor returned (they are in the EntityDuplicate table), the progress is
+        reported per batch and the task checkpoints the last batch done: if the task is requeued after a crash it
+        resumes from there. If it is killed, the duplicates already found are kept and are skipped by the next analyzis.
+
+        With blocking, the phonetic keys of the entities are computed once in a temporary table used by all the batches.
+        """
+        eda = task.entity_duplicate_analyzis.first()
+        if not eda:
+            raise Exception("No entity duplicate analyze found for task %s" % task)
+
+        entity_ids = list(
+            apps.get_model("iaso", "Entity")
+            .objects.filter(entity_type_id=params.get("entity_type_id"), deleted_at__isnull=True)
+            .order_by("id")
+            .values_list("id", flat=True)
+        )
+        last_entity_id = (task.checkpoint or {}).get("last_entity_id")
+        batches = [
+            entity_ids[start : start + STREAMING_BATCH_SIZE]
+            for start in range(0, len(entity_ids), STREAMING_BATCH_SIZE)
+        ]
+
+        text_fields = _blocking_fields(params)
+        entity_keys_table = ENTITY_KEYS_TABLE if text_fields else None
+        found = 0
+        try:
+            if entity_keys_table:
+                with connection.cursor() as cursor:
+                    _create_entity_keys_table(cursor, text_fields, params.get("entity_type_id"))
+            for index, batch in enumerate(batches):
+                if last_entity_id is not None and batch[-1] <= last_entity_id:
+                    continue
+                task.report_progress_and_stop_if_killed(
+                    progress_value=index,
+                    end_value=len(batches),
+                    progress_message=f"Levenshtein Algorithm: {found} potential duplicates found",
+                )
+                the_params, the_query = _build_query(
+                    params, since, entity1_range=(batch[0], batch[-1]), entity_keys_table=entity_keys_table
+                )
+                with connection.cursor() as cursor:
+                    cursor.execute(the_query, the_params)
+                    while True:
+                        records = cursor.fetchmany(size=1000)
+                        if not records:
+                            break
+                        save_potential_duplicates(eda, [PotentialDuplicate(*record) for record in records])
+                        found += len(records)
+                task.save_checkpoint({"last_entity_id": batch[-1]})
+        finally:
+            if entity_keys_table:
+                with connection.cursor() as cursor:
+                    cursor.execute(f"DROP TABLE IF EXISTS {entity_keys_table}")
+
+        task.report_progress_and_stop_if_killed(
+            progress_value=len(batches),
+            end_value=len(batches),
+            progress_message=f"Ended Levenshtein Algorithm: {found} potential duplicates found",
+        )
+        eda.finished_at = now()
+        eda.save()
+
+        return []
@@ -250,6 +250,8 @@ class EntityDuplicateAnalyzisViewSet(viewsets.GenericViewSet):
             "fields": String[],
             "parameters": {}, #vary for each algorithm
         }
+        The levenshtein parameters (levenshtein_max_distance, above_score_display, blocking, incremental, streaming)
+        are described in iaso.api.deduplication.algos.levenshtein.
         Provides an API to launch a duplicate analyzes
         Needs iaso_entity_duplicates_write permission
         """
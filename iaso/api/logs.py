@@ -11,7 +11,7 @@ from rest_framework.authentication import BasicAuthentication
 from rest_framework.response import Response
 
 from hat.api.authentication import CsrfExemptSessionAuthentication
-from hat.audit.models import Modification
+from hat.audit.models import Modification, resolve_blob_refs
 from iaso.models import OrgUnit, Instance, Form
 from hat.menupermissions import models as permission
 from iaso.models.org_unit import OrgUnitChangeRequest
@@ -135,7 +135,9 @@ class LogsViewSet(viewsets.ViewSet):
                 page_offset = paginator.num_pages
             page = paginator.page(page_offset)
 
-            res["list"] = map(lambda x: x.as_list(fields), page.object_list)
+            modifications = list(page.object_list)
+            resolve_blob_refs(modifications)
+            res["list"] = map(lambda x: x.as_list(fields), modifications)
             res["has_next"] = page.has_next()
             res["has_previous"] = page.has_previous()
             res["page"] = page_offset
@@ -143,7 +145,9 @@ class LogsViewSet(viewsets.ViewSet):
             res["limit"] = limit
             return Response(res)
         else:
-            return Response(map(lambda x: x.as_list(fields), queryset))
+            modifications = list(queryset)
+            resolve_blob_refs(modifications)
+            return Response(map(lambda x: x.as_list(fields), modifications))
 
     def retrieve(self, request, pk=None):
         log = get_object_or_404(Modification, pk=pk)
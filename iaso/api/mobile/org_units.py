@@ -1,27 +1,36 @@
+import hashlib
+
 import django_filters
 from typing import Dict, Any
-from typing import Optional
+from datetime import timedelta
+from typing import Iterable, Iterator, List, Optional
 
 from django.contrib.gis.db.models import GeometryField
 from django.contrib.gis.db.models.aggregates import Extent
 from django.contrib.gis.db.models.functions import GeomOutputGeoFunc
 from django.contrib.gis.geos import Point
-from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Count, Max, Q
 from django.db.models.expressions import RawSQL
 from django.db.models.functions import Cast
-from django.http import HttpResponseNotFound
+from django.http import HttpResponse, HttpResponseNotFound, HttpResponseNotModified, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.http import parse_etags
 from django.shortcuts import get_object_or_404
 from rest_framework import permissions
 from rest_framework.fields import SerializerMethodField
 from rest_framework.response import Response
 from rest_framework.decorators import action
 from rest_framework import serializers
+from rest_framework.renderers import JSONRenderer
 
 from hat.api.export_utils import timestamp_to_utc_datetime
 from iaso.api.common import get_timestamp, TimestampField, ModelViewSet, Paginator, safe_api_import
-from iaso.api.query_params import APP_ID, LIMIT, PAGE, IDS
+from iaso.api.query_params import APP_ID, LIMIT, PAGE, IDS, LAST_SYNC, ROOTS_HASH
 from iaso.api.serializers import AppIdSerializer
-from iaso.models import Instance, OrgUnit, Project, FeatureFlag
+from iaso.models import Instance, OrgUnit, Project, FeatureFlag, MobileOrgUnitSnapshot, OrgUnitTombstone
+from iaso.models.org_unit_snapshot import STREAM_CHUNK_SIZE
+from iaso.models.org_unit_tombstone import TOMBSTONE_RETENTION
 from hat.menupermissions import models as permission
 
 
@@ -42,6 +51,16 @@ class ReferenceInstancesFilter(django_filters.rest_framework.FilterSet):
         fields = []
 
 
+class LastSyncSerializer(serializers.Serializer):
+    last_sync = serializers.DateTimeField()
+    # hash of the roots the device got with its last sync, see get_roots_hash
+    roots_hash = serializers.CharField(required=False)
+
+
+def get_roots_hash(roots: List[int]) -> str:
+    return hashlib.sha1(",".join(map(str, roots)).encode()).hexdigest()
+
+
 class ReferenceInstancesSerializer(serializers.ModelSerializer):
     created_at = TimestampField()
     updated_at = TimestampField()
@@ -142,6 +161,10 @@ class HasOrgUnitPermission(permissions.BasePermission):
         return user_account.id in account_ids
 
 
+SYNC_CURSOR_MARGIN = timedelta(minutes=5)
+STREAM_BATCH_SIZE = 2000
+COORDINATES_PRECISION = 10**6  # around 10cm at the equator
+
 BUFFER_FOR_POINT = 0.008 * 3  # 0.008 degrees is around 3km at the equator
 
 
@@ -177,6 +200,17 @@ class MobileOrgUnitViewSet(ModelViewSet):
 
     GET /api/mobile/orgunits?shapes=1
 
+    Low bandwidth devices can ask for a compact encoding of the org units, by batches of columns with the org unit
+    types names in a separate dictionary (see `encode_compact_batch`).
+
+    GET /api/mobile/orgunits?compact=true
+
+    Devices that already downloaded the org units can only fetch what changed since their last sync by passing the
+    `sync_cursor` returned by the previous call as `last_sync`. The first page then also lists, in `deleted`, the ids
+    of the org units to remove (see `list_changes`).
+
+    GET /api/mobile/orgunits?last_sync=2024-01-01T00:00:00Z
+
     You can also list the reference instances of a given `OrgUnit` ID.
 
     GET /api/mobile/orgunits/ID or UUID/reference_instances/?app_id={APP_ID}
@@ -193,23 +227,27 @@ class MobileOrgUnitViewSet(ModelViewSet):
     def pagination_class(self):
         return MobileOrgUnitsSetPagination(self.results_key)
 
-    def get_queryset(self):
+    def limit_download_to_roots(self, app_id):
         user = self.request.user
-        app_id = AppIdSerializer(data=self.request.query_params).get_app_id(raise_exception=True)
-
-        limit_download_to_roots = False
-
         if user and not user.is_anonymous:
-            limit_download_to_roots = Project.objects.get_for_user_and_app_id(user, app_id).has_feature(
+            return Project.objects.get_for_user_and_app_id(user, app_id).has_feature(
                 FeatureFlag.LIMIT_OU_DOWNLOAD_TO_ROOTS
             )
+        return False
 
-        if limit_download_to_roots:
+    def get_visible_org_units(self, app_id):
+        """Org units downloaded by the devices: the valid ones of the project, limited to the user's roots if needed"""
+        if self.limit_download_to_roots(app_id):
             org_units = OrgUnit.objects.filter_for_user_and_app_id(self.request.user, app_id)
         else:
             org_units = OrgUnit.objects.filter_for_user_and_app_id(None, app_id)
+        return org_units.filter(validation_status=OrgUnit.VALIDATION_VALID)
+
+    def get_queryset(self):
+        app_id = AppIdSerializer(data=self.request.query_params).get_app_id(raise_exception=True)
+
         queryset = (
-            org_units.filter(validation_status=OrgUnit.VALIDATION_VALID)
+            self.get_visible_org_units(app_id)
             .order_by("path")
             .prefetch_related("parent", "org_unit_type", "groups")
             .select_related("org_unit_type")
@@ -227,6 +265,9 @@ class MobileOrgUnitViewSet(ModelViewSet):
     def check_include_geo_json(self):
         return self.request.query_params.get("shapes", "") == "true"
 
+    def check_compact(self):
+        return self.request.query_params.get("compact", "") == "true"
+
     def list(self, request, *args, **kwargs):
         app_id = AppIdSerializer(data=self.request.query_params).get_app_id(raise_exception=False)
         if not app_id:
@@ -247,28 +288,157 @@ class MobileOrgUnitViewSet(ModelViewSet):
             serializer = self.get_serializer(queryset, many=True)
             return Response({self.results_key: serializer.data})
 
-        roots_key = ""
         roots = []
         if request.user.is_authenticated:
-            roots = self.request.user.iaso_profile.org_units.values_list("id", flat=True).order_by("id")
-            roots_key = "|".join([str(root) for root in roots])
+            roots = list(self.request.user.iaso_profile.org_units.values_list("id", flat=True).order_by("id"))
+
+        if LAST_SYNC in request.query_params:
+            return self.list_changes(request, app_id, roots)
+
+        try:
+            project = Project.objects.get_for_user_and_app_id(None, app_id)
+        except Project.DoesNotExist:
+            return super().list(request, *args, **kwargs)
 
         page_size = self.paginator.get_page_size(request)
         page_number = self.paginator.get_iaso_page_number(request)
-
         include_geo_json = self.check_include_geo_json()
+        # The payload only depends on the user if the download is limited to their roots, otherwise all the devices
+        # of the project share the same snapshots.
+        audience = "roots:" + "|".join(map(str, roots)) if self.limit_download_to_roots(app_id) else "all"
+        audience += "-"
+        compact = self.check_compact()
+        key = f"{audience}{page_size}-{page_number}-{'geo_json' if include_geo_json else ''}"
+        if compact:
+            key += "-compact"
+
+        # Cheap query telling if the org units changed since the snapshot was built, see MobileOrgUnitSnapshot
+        fingerprint = (
+            self.get_queryset()
+            .order_by()
+            .aggregate(
+                count=Count("id"), last_update=Max("updated_at"), last_type_update=Max("org_unit_type__updated_at")
+            )
+        )
+        fingerprint = "{count}-{last_update}-{last_type_update}".format(**fingerprint)
+
+        snapshot = MobileOrgUnitSnapshot.objects.filter(project=project, key=key).first()
+        if snapshot is None or snapshot.fingerprint != fingerprint:
+            with transaction.atomic():
+                # Another request may have rebuilt it while we were waiting for the lock
+                MobileOrgUnitSnapshot.lock(project, key)
+                snapshot = MobileOrgUnitSnapshot.objects.filter(project=project, key=key).first()
+                if snapshot is None or snapshot.fingerprint != fingerprint:
+                    chunks = self.render_org_units(self.get_queryset(), compact=compact)
+                    snapshot = MobileOrgUnitSnapshot.store(project, key, fingerprint, chunks, audience=audience)
+
+        suffix = b"}"
+        if page_number == 1:
+            suffix = b',"roots":%s,"roots_hash":"%s"}' % (JSONRenderer().render(roots), get_roots_hash(roots).encode())
+
+        etag = snapshot.get_etag(suffix)
+        if etag in parse_etags(request.META.get("HTTP_IF_NONE_MATCH", "")):
+            response = HttpResponseNotModified()
+        else:
+            if "gzip" in request.META.get("HTTP_ACCEPT_ENCODING", ""):
+                response = HttpResponse(snapshot.render(suffix, gzipped=True), content_type="application/json")
+                response["Content-Encoding"] = "gzip"
+            elif snapshot.content_length > STREAM_CHUNK_SIZE:
+                # decompressed while it is sent, the whole pyramid is never held in memory
+                response = StreamingHttpResponse(snapshot.stream(suffix), content_type="application/json")
+                response["Content-Length"] = snapshot.content_length + len(suffix)
+            else:
+                response = HttpResponse(snapshot.render(suffix), content_type="application/json")
+        response["ETag"] = etag
+        response["Vary"] = "Accept-Encoding, Authorization, Cookie"
+        return response
 
-        cache_key = f"{app_id}-{page_size}-{page_number}-{'geo_json' if include_geo_json else ''}--{roots_key}"
-        cached_response = cache.get(cache_key)
-        if cached_response is None:
-            super_response = super().list(request, *args, **kwargs)
-            cached_response = super_response.data
-            cache.set(cache_key, cached_response, 300)
+    def render_org_units(self, queryset, compact: bool = False) -> Iterator[bytes]:
+        """Render the list response as JSON chunks, without the closing brace of the object
 
-        if page_number == 1:
-            cached_response["roots"] = roots
+        Without pagination the org units are read with a server side cursor and serialized by batches, so the memory
+        used doesn't depend on the size of the pyramid. With `compact`, each batch is encoded as columns, see
+        `encode_compact_batch`.
+        """
+        renderer = JSONRenderer()
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            header = self.get_paginated_response([]).data
+            del header[self.results_key]
+            yield renderer.render(header)[:-1] + b","
+            batches: Iterable[list] = [page]
+        else:
+            yield b"{"
+            batches = batched(queryset.iterator(chunk_size=STREAM_BATCH_SIZE), STREAM_BATCH_SIZE)
+
+        yield f'"{self.results_key}":['.encode()
+        org_unit_types = {}
+        separator = b""
+        for batch in batches:
+            data = self.get_serializer(batch, many=True).data
+            if not data:
+                continue
+            if compact:
+                org_unit_types.update((row["org_unit_type_id"], row["org_unit_type_name"]) for row in data)
+                yield separator + renderer.render(encode_compact_batch(data))
+            else:
+                yield separator + renderer.render(data)[1:-1]
+            separator = b","
+        yield b"]"
+        if compact:
+            yield b',"orgUnitTypes":' + renderer.render(org_unit_types)
+
+    def list_changes(self, request, app_id, roots):
+        """Delta sync: the org units modified since `last_sync` and the ids of the ones the device must remove
+
+        Removed org units are the ones modified since `last_sync` that are no longer downloaded (they were rejected,
+        closed in the pyramid, or moved outside the user's roots) and the ones deleted since then (see
+        OrgUnitTombstone).
+
+        `full_resync` tells the device to download the whole pyramid instead: when the roots of the user changed
+        (the device sends the `roots_hash` it got with its previous download or sync), or when `last_sync` is older than
+        the deletions kept.
+        """
+        serializer = LastSyncSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        last_sync = serializer.validated_data[LAST_SYNC]
+        roots_hash = get_roots_hash(roots)
+        # An org unit saved in a transaction still running now will have an `updated_at` before this cursor, so keep
+        # a margin to get it on the next sync. Sending an org unit twice is harmless.
+        sync_cursor = timezone.now() - SYNC_CURSOR_MARGIN
+
+        previous_roots_hash = serializer.validated_data.get(ROOTS_HASH)
+        if (previous_roots_hash and previous_roots_hash != roots_hash) or last_sync < sync_cursor - TOMBSTONE_RETENTION:
+            return Response({"full_resync": True, "roots": roots, "roots_hash": roots_hash})
+
+        queryset = self.get_queryset().filter(
+            Q(updated_at__gte=last_sync) | Q(org_unit_type__updated_at__gte=last_sync)
+        )
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            data = self.get_paginated_response(self.get_serializer(page, many=True).data).data
+        else:
+            data = {self.results_key: self.get_serializer(queryset, many=True).data}
 
-        return Response(cached_response)
+        if page is None or self.paginator.page.number == 1:
+            data["full_resync"] = False
+            data["roots"] = roots
+            data["roots_hash"] = roots_hash
+            removed = (
+                OrgUnit.objects.filter_for_user_and_app_id(None, app_id)
+                .filter(updated_at__gte=last_sync)
+                .exclude(id__in=self.get_visible_org_units(app_id).values("id"))
+                .values_list("id", flat=True)
+                .distinct()
+            )
+            project = Project.objects.filter(app_id=app_id).select_related("account").first()
+            version_id = project.account.default_version_id if project and project.account else None
+            deleted = OrgUnitTombstone.objects.filter(version_id=version_id, deleted_at__gte=last_sync).values_list(
+                "org_unit_id", flat=True
+            )
+            data["deleted"] = sorted({*removed, *deleted})
+            data["sync_cursor"] = sync_cursor.isoformat()
+        return Response(data)
 
     @safe_api_import("orgUnit")
     def create(self, _, request):
@@ -336,65 +506,167 @@ def bbox_merge(a: Optional[tuple], b: Optional[tuple]) -> Optional[tuple]:
     )
 
 
+def lock_uuids(uuids: List[str]):
+    """Lock the uuids until the end of the transaction, so that concurrent imports of the same org units (e.g. a device
+    retrying a push that timed out) wait for each other instead of creating duplicates. uuid is not unique in DB."""
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_xact_lock(hashtext(u)) FROM unnest(%s::text[]) AS u ORDER BY u", [uuids])
+
+
 def import_data(org_units, user, app_id):
-    new_org_units = []
+    """Create the org units pushed by the mobile app, the ones that already exist (same uuid) are ignored.
+
+    An org unit can have for parent another org unit of the same push (by uuid), so the new org units are inserted by
+    levels, parents first. Everything is done in a fixed number of queries plus one insert per level, the paths are
+    computed in memory instead of calling save() for each org unit.
+    """
     project = Project.objects.get_for_user_and_app_id(user, app_id)
     org_units = sorted(org_units, key=get_timestamp)
 
+    uuids = sorted({org_unit["id"] for org_unit in org_units if org_unit.get("id")})
+    lock_uuids(uuids)
+    existing_uuids = set(OrgUnit.objects.filter(uuid__in=uuids).values_list("uuid", flat=True))
+
+    # uuid -> (org unit to create, reference to its parent as sent by the device)
+    to_create: Dict[str, tuple] = {}
     for org_unit in org_units:
         uuid = org_unit.get("id", None)
+        if not uuid or uuid in existing_uuids or uuid in to_create:
+            continue
         latitude = org_unit.get("latitude", None)
         longitude = org_unit.get("longitude", None)
-        org_unit_location = None
+        org_unit_db = OrgUnit(uuid=uuid)
+        org_unit_db.custom = True
+        org_unit_db.name = org_unit.get("name", None)
+        org_unit_db.accuracy = org_unit.get("accuracy", None)
+        parent_id = org_unit.get("parentId", None)
+        if not parent_id:
+            parent_id = org_unit.get(
+                "parent_id", None
+            )  # there exist versions of the mobile app in the wild with both parentId and parent_id
+
+        org_unit_type_id = org_unit.get(
+            "orgUnitTypeId", None
+        )  # there exist versions of the mobile app in the wild with both orgUnitTypeId and org_unit_type_id
+        if not org_unit_type_id:
+            org_unit_type_id = org_unit.get("org_unit_type_id", None)
+        org_unit_db.org_unit_type_id = org_unit_type_id
+
+        t = org_unit.get("created_at", None)
+        if t:
+            org_unit_db.created_at = timestamp_to_utc_datetime(int(t))
+        else:
+            org_unit_db.created_at = org_unit.get("created_at", None)
 
+        t = org_unit.get("updated_at", None)
+        if t:
+            org_unit_db.updated_at = timestamp_to_utc_datetime(int(t))
+        else:
+            org_unit_db.updated_at = org_unit.get("created_at", None)
+        if not user.is_anonymous:
+            org_unit_db.creator = user
+        org_unit_db.source = "API"
         if latitude and longitude:
             altitude = org_unit.get("altitude", 0)
-            org_unit_location = Point(x=longitude, y=latitude, z=altitude, srid=4326)
-        org_unit_db, created = OrgUnit.objects.get_or_create(uuid=uuid)
-
-        if created:
-            org_unit_db.custom = True
-            org_unit_db.validated = False
-            org_unit_db.name = org_unit.get("name", None)
-            org_unit_db.accuracy = org_unit.get("accuracy", None)
-            parent_id = org_unit.get("parentId", None)
-            if not parent_id:
-                parent_id = org_unit.get(
-                    "parent_id", None
-                )  # there exist versions of the mobile app in the wild with both parentId and parent_id
-
-            if parent_id is not None:
-                if str.isdigit(parent_id):
-                    org_unit_db.parent_id = parent_id
-                else:
-                    parent_org_unit = OrgUnit.objects.get(uuid=parent_id)
-                    org_unit_db.parent_id = parent_org_unit.id
-
-            org_unit_type_id = org_unit.get(
-                "orgUnitTypeId", None
-            )  # there exist versions of the mobile app in the wild with both orgUnitTypeId and org_unit_type_id
-            if not org_unit_type_id:
-                org_unit_type_id = org_unit.get("org_unit_type_id", None)
-            org_unit_db.org_unit_type_id = org_unit_type_id
-
-            t = org_unit.get("created_at", None)
-            if t:
-                org_unit_db.created_at = timestamp_to_utc_datetime(int(t))
+            org_unit_db.location = Point(x=longitude, y=latitude, z=altitude, srid=4326)
+        org_unit_db.version = project.account.default_version
+        to_create[uuid] = (org_unit_db, parent_id)
+
+    # Resolve in one query the parents that are not part of this push, by id or uuid
+    parent_refs = {parent_id for _, parent_id in to_create.values() if parent_id is not None}
+    parent_ids = [parent_id for parent_id in parent_refs if str.isdigit(parent_id)]
+    parent_uuids = [parent_id for parent_id in parent_refs if not str.isdigit(parent_id) and parent_id not in to_create]
+    parents = {}
+    for parent in OrgUnit.objects.filter(Q(id__in=parent_ids) | Q(uuid__in=parent_uuids)).only("id", "uuid", "path"):
+        parents[str(parent.id)] = parent
+        parents[parent.uuid] = parent
+    for parent_id in parent_uuids:
+        if parent_id not in parents:
+            raise OrgUnit.DoesNotExist(f"Parent org unit {parent_id} not found")
+
+    pending = list(to_create.values())
+    while pending:
+        # org units whose parent is not new or was inserted by a previous level
+        level = [
+            (org_unit, parent_id)
+            for org_unit, parent_id in pending
+            if parent_id not in to_create or to_create[parent_id][0].pk is not None
+        ]
+        if not level:
+            raise ValueError("Cycle in the parents of the imported org units")
+        for org_unit, parent_id in level:
+            if parent_id in to_create:
+                org_unit.parent_id = to_create[parent_id][0].pk
+            elif parent_id in parents:
+                org_unit.parent_id = parents[parent_id].id
+            elif parent_id is not None:
+                org_unit.parent_id = parent_id
+        OrgUnit.objects.bulk_create([org_unit for org_unit, _ in level])
+        pending = [(org_unit, parent_id) for org_unit, parent_id in pending if org_unit.pk is None]
+
+    # Same logic as OrgUnit.calculate_paths: org units whose parent has no path yet are left without path
+    paths: Dict[str, Optional[list]] = {}
+
+    def get_path(uuid):
+        if uuid not in paths:
+            org_unit, parent_id = to_create[uuid]
+            if parent_id is None:
+                parent_path = []
+            elif parent_id in to_create:
+                parent_path = get_path(parent_id)
+            elif parent_id in parents:
+                parent_path = parents[parent_id].path
             else:
-                org_unit_db.created_at = org_unit.get("created_at", None)
+                parent_path = None
+            paths[uuid] = None if parent_path is None else [*parent_path, str(org_unit.pk)]
+        return paths[uuid]
+
+    for uuid, (org_unit, _) in to_create.items():
+        org_unit.path = get_path(uuid)
+    OrgUnit.objects.bulk_update([org_unit for org_unit, _ in to_create.values() if org_unit.path is not None], ["path"])
+
+    return [org_unit for org_unit, _ in to_create.values()]
+
+
+def batched(iterable: Iterable, size: int) -> Iterator[list]:
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def delta_encode(values: List[Optional[int]]) -> List[Optional[int]]:
+    """Replace each value by its difference with the previous non null one, null values are kept"""
+    previous = 0
+    result: List[Optional[int]] = []
+    for value in values:
+        if value is None:
+            result.append(None)
+        else:
+            result.append(value - previous)
+            previous = value
+    return result
 
-            t = org_unit.get("updated_at", None)
-            if t:
-                org_unit_db.updated_at = timestamp_to_utc_datetime(int(t))
-            else:
-                org_unit_db.updated_at = org_unit.get("created_at", None)
-            if not user.is_anonymous:
-                org_unit_db.creator = user
-            org_unit_db.source = "API"
-            if org_unit_location:
-                org_unit_db.location = org_unit_location
-
-            new_org_units.append(org_unit_db)
-            org_unit_db.version = project.account.default_version
-            org_unit_db.save()
-    return new_org_units
+
+def encode_compact_batch(rows: List[dict]) -> dict:
+    """Encode serialized org units as a dict of columns, one list per field.
+
+    - `org_unit_type_name` is dropped, the names are sent once for all in `orgUnitTypes`
+    - `id` is delta encoded (consecutive org units of a pyramid usually have close ids)
+    - `latitude` and `longitude` are converted to integers (in millionths of degree) then delta encoded
+
+    Delta encoding restarts at each batch.
+    """
+    columns: Dict[str, list] = {
+        field: [row[field] for row in rows] for field in rows[0] if field != "org_unit_type_name"
+    }
+    columns["id"] = delta_encode(columns["id"])
+    for field in ("latitude", "longitude"):
+        columns[field] = delta_encode(
+            [round(value * COORDINATES_PRECISION) if value is not None else None for value in columns[field]]
+        )
+    return columns
@@ -0,0 +1,128 @@
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet
+from django.db import connection
+from django.http import Http404, HttpResponse
+from rest_framework import permissions, serializers
+from rest_framework.request import Request
+from rest_framework.views import APIView
+
+from iaso.api.org_units import ORG_UNIT_PERMISSIONS
+from iaso.api.query_params import APP_ID
+from iaso.models import OrgUnit, Project
+
+"""
+Mapbox vector tiles of the org units, so the web maps only load the shapes of the visible area at a resolution
+matching the zoom level, instead of downloading whole pyramids as GeoJSON.
+
+The tiles are built by PostGIS (`ST_AsMVT`) from the simplified shape of the org units, or their location if they
+don't have one. Each feature carries the id, name, type, parent and validation status of the org unit.
+"""
+
+CONTENT_TYPE_MVT = "application/vnd.mapbox-vector-tile"
+LAYER_NAME = "org_units"
+MAX_ZOOM = 22
+
+TILE_QUERY = f"""
+    WITH bounds AS (
+        SELECT ST_TileEnvelope(%s, %s, %s) AS envelope, ST_Transform(ST_TileEnvelope(%s, %s, %s), 4326) AS wgs84
+    ),
+    features AS (
+        SELECT
+            ou.id,
+            ou.name,
+            ou.org_unit_type_id,
+            ou.parent_id,
+            ou.validation_status,
+            ST_AsMVTGeom(
+                ST_Transform(ST_Force2D(COALESCE(ou.simplified_geom::geometry, ou.location::geometry)), 3857),
+                bounds.envelope
+            ) AS geom
+        FROM iaso_orgunit ou, bounds
+        WHERE ou.id IN ({{org_units}})
+        AND (ou.simplified_geom::geometry && bounds.wgs84 OR ou.location::geometry && bounds.wgs84)
+    )
+    SELECT ST_AsMVT(features, '{LAYER_NAME}') FROM features WHERE geom IS NOT NULL
+"""
+
+
+class HasOrgUnitTilePermission(permissions.BasePermission):
+    """Users with a permission on the org units, or anonymous users with the app_id of a project open to them"""
+
+    def has_permission(self, request, view):
+        if request.user.is_authenticated:
+            return any(request.user.has_perm(perm) for perm in ORG_UNIT_PERMISSIONS)
+        try:
+            Project.objects.get_for_user_and_app_id(request.user, request.query_params.get(APP_ID))
+        except Project.DoesNotExist:
+            return False
+        return True
+
+
+class TileParamsSerializer(serializers.Serializer):
+    version_id = serializers.IntegerField(required=False)
+    orgUnitTypeId = serializers.CharField(required=False)
+    validation_status = serializers.ChoiceField(choices=OrgUnit.VALIDATION_STATUS_CHOICES, required=False)
+
+    def validate_orgUnitTypeId(self, value):
+        try:
+            return [int(type_id) for type_id in value.split(",") if type_id]
+        except ValueError:
+            raise serializers.ValidationError("Expected a comma separated list of ids")
+
+
+class OrgUnitTileView(APIView):
+    """Vector tile of the org units the user can see: /api/orgunits/tiles/{z}/{x}/{y}.mvt
+
+    Parameters (all optional):
+      - version_id: source version of the org units, default to the default version of the user's account
+      - orgUnitTypeId: comma separated list of org unit type ids
+      - validation_status: default to VALID
+      - app_id: for anonymous users, as in the org units API
+
+    The tiles are cached for ORG_UNIT_TILES_CACHE_SECONDS, per set of visible org units.
+    """
+
+    permission_classes = [HasOrgUnitTilePermission]
+
+    def get(self, request: Request, z: int, x: int, y: int):
+        if z > MAX_ZOOM or x >= 2**z or y >= 2**z:
+            raise Http404
+
+        params = TileParamsSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+
+        queryset = self.get_queryset(request, **params.validated_data)
+        try:
+            org_units_sql, org_units_params = queryset.values("id").query.sql_with_params()
+        except EmptyResultSet:
+            return self.tile_response(b"")
+
+        sql_params = [z, x, y, z, x, y, *org_units_params]
+        # The SQL of the queryset includes the user's restrictions (account, org units), so the key does too
+        cache_key = "orgunit-tile-" + hashlib.sha1(f"{org_units_sql}{sql_params}".encode()).hexdigest()
+        tile = cache.get(cache_key)
+        if tile is None:
+            with connection.cursor() as cursor:
+                cursor.execute(TILE_QUERY.format(org_units=org_units_sql), sql_params)
+                tile = bytes(cursor.fetchone()[0] or b"")
+            cache.set(cache_key, tile, settings.ORG_UNIT_TILES_CACHE_SECONDS)
+
+        return self.tile_response(tile)
+
+    def get_queryset(self, request, version_id=None, orgUnitTypeId=None, validation_status=OrgUnit.VALIDATION_VALID):
+        queryset = OrgUnit.objects.filter_for_user_and_app_id(request.user, request.query_params.get(APP_ID))
+        if version_id is None and request.user.is_authenticated:
+            version_id = request.user.iaso_profile.account.default_version_id
+        if version_id is not None:
+            queryset = queryset.filter(version_id=version_id)
+        if orgUnitTypeId:
+            queryset = queryset.filter(org_unit_type_id__in=orgUnitTypeId)
+        return queryset.filter(validation_status=validation_status)
+
+    def tile_response(self, tile: bytes) -> HttpResponse:
+        response = HttpResponse(tile, content_type=CONTENT_TYPE_MVT)
+        response["Cache-Control"] = f"private, max-age={settings.ORG_UNIT_TILES_CACHE_SECONDS}"
+        return response
@@ -29,19 +29,20 @@ from iaso.utils import geojson_queryset
 from ..utils.models.common import get_creator_name, get_org_unit_parents_ref
 
 
+# Any of them gives access to the org units
+ORG_UNIT_PERMISSIONS = (
+    permission.FORMS,
+    permission.ORG_UNITS,
+    permission.SUBMISSIONS,
+    permission.REGISTRY,
+    permission.POLIO,
+)
+
+
 # noinspection PyMethodMayBeStatic
 class HasOrgUnitPermission(permissions.BasePermission):
     def has_object_permission(self, request, view, obj):
-        if not (
-            request.user.is_authenticated
-            and (
-                request.user.has_perm(permission.FORMS)
-                or request.user.has_perm(permission.ORG_UNITS)
-                or request.user.has_perm(permission.SUBMISSIONS)
-                or request.user.has_perm(permission.REGISTRY)
-                or request.user.has_perm(permission.POLIO)
-            )
-        ):
+        if not (request.user.is_authenticated and any(request.user.has_perm(perm) for perm in ORG_UNIT_PERMISSIONS)):
             return False
 
         if obj.version.data_source.read_only and request.method != "GET":
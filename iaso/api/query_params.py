@@ -10,6 +10,7 @@ FORM_ID = "form_id"
 FORM_IDS = "form_ids"
 IDS = "ids"
 JSON_CONTENT = "jsonContent"
+LAST_SYNC = "last_sync"
 LIMIT = "limit"
 MODIFICATION_DATE_FROM = "modificationDateFrom"
 MODIFICATION_DATE_TO = "modificationDateTo"
@@ -23,6 +24,7 @@ PERIOD_IDS = "period_ids"
 PERIODS = "periods"
 PROJECT = "project"
 PLANNING_IDS = "planningIds"
+ROOTS_HASH = "roots_hash"
 SEARCH = "search"
 SENT_DATE_FROM = "sentDateFrom"
 SENT_DATE_TO = "sentDateTo"
@@ -21,6 +21,7 @@ class Dhis2OuImporterSerializer(serializers.Serializer):
     force = serializers.BooleanField(required=False, default=False)
     validate_status = serializers.BooleanField(required=False, default=False)
     continue_on_error = serializers.BooleanField(required=False, default=False)
+    update_existing = serializers.BooleanField(required=False, default=False)
     description = serializers.CharField(max_length=200, required=False, allow_null=True)
 
     def validate(self, attrs):
@@ -71,6 +72,7 @@ class Dhis2OuImporterViewSet(viewsets.ViewSet):
             login=data.get("dhis2_login", None),
             password=data.get("dhis2_password", None),
             update_mode=update_mode,
+            update_existing=data.get("update_existing", False),
             user=request.user,
             description=data.get("description", ""),
         )
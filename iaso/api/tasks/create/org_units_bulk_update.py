@@ -20,6 +20,7 @@ class OrgUnitsBulkUpdate(viewsets.ViewSet):
         selected_ids = request.data.get("selected_ids", [])
         unselected_ids = request.data.get("unselected_ids", [])
         searches = request.data.get("searches", [])
+        chunk_size = request.data.get("chunk_size", None)
 
         user = self.request.user
         app_id = self.request.query_params.get("app_id")
@@ -35,6 +36,7 @@ class OrgUnitsBulkUpdate(viewsets.ViewSet):
             groups_ids_added=groups_ids_added,
             groups_ids_removed=groups_ids_removed,
             validation_status=validation_status,
+            chunk_size=chunk_size,
             user=user,
         )
         return Response(
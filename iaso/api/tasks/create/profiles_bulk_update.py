@@ -38,6 +38,7 @@ class ProfilesBulkUpdate(viewsets.ViewSet):
         children_ou = request.data.get("ouChildren", None) == "true"
         projects = request.data.get("projects", None)
         user_roles = request.data.get("userRoles", None)
+        chunk_size = request.data.get("chunk_size", None)
 
         user = self.request.user
 
@@ -63,6 +64,7 @@ class ProfilesBulkUpdate(viewsets.ViewSet):
             projects=projects,
             user=user,
             user_roles=user_roles,
+            chunk_size=chunk_size,
         )
         return Response(
             {"task": TaskSerializer(instance=task).data},
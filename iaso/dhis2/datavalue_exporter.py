@@ -1,16 +1,20 @@
-import itertools
 import json
 import logging
+import math
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from timeit import default_timer as timer
+from typing import Deque, List, NamedTuple
 
 from dhis2 import Api
 from dhis2 import RequestException
-from django.core.paginator import Paginator
+from django.conf import settings
 from django.utils import timezone
 
 import iaso.models as models
 from iaso.models import OrgUnit, MappingVersion, ExportLog, RUNNING, ERRORED, EXPORTED
 from .api_logger import ApiLogger  # type: ignore
+from .mapping_plan import MappingPlan, get_mapping_plan
 from .value_formatter import format_value
 from ..periods import Period
 
@@ -104,7 +108,7 @@ class AggregateHandler(BaseHandler):
 
         return None
 
-    def map_to_values(self, instance, form_mapping, export_status=None, related_data=None):
+    def map_to_values(self, instance, form_mapping, export_status=None, related_data=None, plan=None):
         data_set_entry = {
             "dataSet": form_mapping["data_set_id"],
             "completeDate": instance.created_at.strftime("%Y-%m-%d"),
@@ -117,44 +121,56 @@ class AggregateHandler(BaseHandler):
 
         errored = False
         mapping_errors = []
-        question_mappings = form_mapping["question_mappings"]
-        for question_key in answers.keys():
-            if question_key in question_mappings:
-                try:
-                    data_element = question_mappings[question_key]
-                    if data_element.get("type") == MappingVersion.QUESTION_MAPPING_NEVER_MAPPED:
-                        continue
-
-                    data_element["question_key"] = question_key
-                    raw_value = answers[question_key]
-                    data_value = {
-                        "dataElement": data_element["id"],
-                        "value": format_value(data_element, raw_value, self.orgunit_resolver),
-                        "comment": str(instance.id) + " " + str(raw_value) + " " + question_key,
-                    }
-                    if "categoryOptionCombo" in data_element:
-                        data_value["categoryOptionCombo"] = data_element["categoryOptionCombo"]
-
-                    if "attributeOptionCombo" in data_element:
-                        data_value["attributeOptionCombo"] = data_element["attributeOptionCombo"]
-                    data_set_entry["dataValues"].append(data_value)
-                except Exception as error:
-                    errored = True
-                    mapping_errors.append([question_key, error])
-                    self.logger.warn("ERROR Mapping {} {}".format(error, question_key))
+        questions = (plan or MappingPlan(form_mapping)).questions
+        data_values = data_set_entry["dataValues"]
+        for question_key, raw_value in answers.items():
+            question = questions.get(question_key)
+            if question is None:
+                continue
+            try:
+                if question.error:
+                    raise question.error
+                data_value = {
+                    "dataElement": question.data_element_id,
+                    "value": question.format(raw_value, self.orgunit_resolver),
+                    "comment": str(instance.id) + " " + str(raw_value) + " " + question_key,
+                }
+                data_value.update(question.option_combos)
+                data_values.append(data_value)
+            except Exception as error:
+                errored = True
+                mapping_errors.append([question_key, error])
+                self.logger.warn("ERROR Mapping {} {}".format(error, question_key))
         if errored:
             return (None, mapping_errors)
         else:
             return (data_set_entry, None)
 
     def export_page(self, prefix, data, export_statuses, stats, api):
+        export_logs, exception = self.send_page(prefix, data, stats, api)
+        return self.save_export_logs(export_logs, exception, export_statuses)
+
+    def send_page(self, prefix, data, stats, api):
+        """Post the page to DHIS2, without touching the database, so it can run in a worker thread
+
+        Returns the (unsaved) export logs and the InstanceExportError if DHIS2 refused the values"""
         if len(data) == 0:
             stats["batched_time"] = 0
-            return []
+            return [], None
 
-        export_log = self.export_page_values(prefix, data, export_statuses, stats, api)
+        export_log, exception = self.export_page_values(prefix, data, stats, api)
+        if exception:
+            return [export_log], exception
         export_log_complete_ds = self.mark_dataset_as_complete(data, api)
-        return [export_log, export_log_complete_ds]
+        return [export_log, export_log_complete_ds], None
+
+    def save_export_logs(self, export_logs, exception, export_statuses):
+        ExportLog.objects.bulk_create(export_logs)
+        if exception:
+            for export_status in export_statuses:
+                self.export_log_on(ERRORED, export_status, export_logs)
+            raise exception
+        return export_logs
 
     def mark_dataset_as_complete(self, data, api):
         def to_complete_data_set_registration(data_value_set):
@@ -176,7 +192,6 @@ class AggregateHandler(BaseHandler):
         except:
             print("problem in making datset complete")
         export_log.url = api.base_url + "/completeDataSetRegistrations"
-        export_log.save()
         return export_log
 
     def flatten(self, data):
@@ -194,7 +209,7 @@ class AggregateHandler(BaseHandler):
             export_status.export_logs.add(export_log)
         export_status.save()
 
-    def export_page_values(self, prefix, data, export_statuses, stats, api):
+    def export_page_values(self, prefix, data, stats, api):
         try:
             # print(prefix, "POSTING to dataValueSets {} ".format(request))
             batched_start = timer()
@@ -216,9 +231,8 @@ class AggregateHandler(BaseHandler):
             export_log.received = resp
             export_log.url = api.base_url + "/dataValueSets"
             export_log.http_status = 200
-            export_log.save()
 
-            return export_log
+            return export_log, None
 
         except RequestException as dhis2_exception:
             message = "ERROR while processing " + prefix
@@ -233,16 +247,12 @@ class AggregateHandler(BaseHandler):
             export_log.sent = request
             export_log.received = resp
             export_log.http_code = dhis2_exception.code
-            export_log.save()
-
-            for export_status in export_statuses:
-                self.export_log_on(ERRORED, export_status, [export_log])
 
-            raise exception
+            return export_log, exception or InstanceExportError(message, {}, [dhis2_exception.description])
 
 
 class EventHandler(BaseHandler):
-    def map_to_values(self, instance, form_mapping, export_status=None):
+    def map_to_values(self, instance, form_mapping, export_status=None, plan=None):
         event = {
             "program": form_mapping["program_id"],
             "event": instance.export_id,
@@ -255,7 +265,7 @@ class EventHandler(BaseHandler):
             event["coordinate"] = {"latitude": instance.location.y, "longitude": instance.location.x}
         errored = False
         event_errors = []
-        question_mappings = form_mapping["question_mappings"]
+        questions = (plan or MappingPlan(form_mapping)).questions
 
         if instance.org_unit.source_ref == "" or instance.org_unit.source_ref is None:
             errored = True
@@ -273,38 +283,34 @@ class EventHandler(BaseHandler):
             )
             self.logger.error(str(event_errors))
 
-        for question_key in instance.json.keys():
-            if question_key in question_mappings:
-                try:
-                    data_element = question_mappings[question_key]
-                    if data_element.get("type") == MappingVersion.QUESTION_MAPPING_NEVER_MAPPED:
-                        continue
-                    data_element["question_key"] = question_key
-                    raw_value = instance.json[question_key]
-
-                    if data_element.get("type") == MappingVersion.QUESTION_MAPPING_MULTIPLE:
-                        raw_values = raw_value.split(" ")
-
-                        for value in data_element["values"]:
-                            mapping_de = data_element["values"][value]
-                            boolval = "1" if (value in raw_values) else "0"
-                            data_value = {
-                                "dataElement": mapping_de["id"],
-                                "value": format_value(mapping_de, boolval, self.orgunit_resolver)
-                                # "debug": str(raw_value) + " " + question_key,
-                            }
-                            event["dataValues"].append(data_value)
-                    else:
+        for question_key, raw_value in instance.json.items():
+            question = questions.get(question_key)
+            if question is None:
+                continue
+            try:
+                if question.error:
+                    raise question.error
+
+                if question.choices is not None:
+                    raw_values = raw_value.split(" ")
+
+                    for choice in question.choices:
+                        boolval = "1" if (choice.value in raw_values) else "0"
                         data_value = {
-                            "dataElement": data_element["id"],
-                            "value": format_value(data_element, raw_value, self.orgunit_resolver),
-                            # "debug": str(raw_value) + " " + question_key,
+                            "dataElement": choice.data_element_id,
+                            "value": choice.format(boolval, self.orgunit_resolver),
                         }
                         event["dataValues"].append(data_value)
-                except Exception as error:
-                    errored = True
-                    event_errors.append([question_key, error])
-                    self.logger.error("ERROR Mapping" + str(error) + "question_key" + question_key)
+                else:
+                    data_value = {
+                        "dataElement": question.data_element_id,
+                        "value": question.format(raw_value, self.orgunit_resolver),
+                    }
+                    event["dataValues"].append(data_value)
+            except Exception as error:
+                errored = True
+                event_errors.append([question_key, error])
+                self.logger.error("ERROR Mapping" + str(error) + "question_key" + question_key)
 
         if errored:
             return (None, event_errors)
@@ -312,9 +318,19 @@ class EventHandler(BaseHandler):
             return (event, None)
 
     def export_page(self, prefix, data, export_statuses, stats, api):
+        export_logs, exception = self.send_page(prefix, data, stats, api)
+        if exception:
+            raise exception
+        ExportLog.objects.bulk_create(export_logs)
+        return export_logs
+
+    def send_page(self, prefix, data, stats, api):
+        """Post the page to DHIS2, without touching the database, so it can run in a worker thread
+
+        Returns the (unsaved) export logs and the InstanceExportError if DHIS2 refused the events"""
         if len(data) == 0:
             stats["batched_time"] = 0
-            return []
+            return [], None
 
         try:
             payload = {"events": data}
@@ -332,15 +348,14 @@ class EventHandler(BaseHandler):
             export_log.received = resp
             export_log.url = api.base_url + "/events"
             export_log.http_status = 200
-            export_log.save()
 
-            return [export_log]
+            return [export_log], None
         except RequestException as dhis2_exception:
             message = "ERROR while processing " + prefix
             resp = json.loads(dhis2_exception.description)
             exception = self.handle_exception(resp, message)
 
-            raise exception
+            return [], exception or InstanceExportError(message, {}, [dhis2_exception.description])
 
     def handle_exception(self, resp, message):
         response = resp["response"]
@@ -545,8 +560,8 @@ class EventTrackerHandler(BaseHandler):
                 for repeat_group in export_status.mapping_version.form_version.repeat_groups():
                     repeat_group_name = repeat_group["name"]
                     if repeat_group_name in question_mappings:
-                        subform_mapping = question_mappings[repeat_group_name][0]
-                        subform_mapping["question_mappings"] = {}
+                        # a copy, the mapping of the form version is shared by all the instances
+                        subform_mapping = {**question_mappings[repeat_group_name][0], "question_mappings": {}}
                         for question_name in question_mappings:
                             question_mapping = question_mappings[question_name]
                             if (
@@ -706,7 +721,27 @@ class EventTrackerHandler(BaseHandler):
         export_status.save()
 
 
+class PendingPage(NamedTuple):
+    prefix: str
+    export_statuses: List[models.ExportStatus]
+    data: dict
+    # result of `DataValueExporter.send_page`
+    future: Future
+
+
 class DataValueExporter:
+    """Export the instances of an ExportRequest to DHIS2, page by page
+
+    The pages are read with keyset pagination (on the id of the ExportStatus) and mapped in the main thread. The
+    aggregate and event payloads are posted to DHIS2 by a pool of `concurrency` threads, which don't touch the
+    database, while the next pages are read and mapped. The results are then recorded, in bulk and in the order of
+    the pages, by the main thread. The tracker values of a page are exported by the main thread when the page is
+    recorded, after its aggregate and event values were accepted: their export interleaves DHIS2 calls and database
+    queries.
+
+    Throughput metrics are stored in `export_request.result`.
+    """
+
     def __init__(self):
         self.form_mappings_cache = {}
         self.api_cache = {}
@@ -744,9 +779,15 @@ class DataValueExporter:
                 skipped.append((instance.id, "no mapping"))
                 continue
 
-            (values, map_errors) = self.handlers[form_mapping.mapping.mapping_type].map_to_values(
-                instance, form_mapping.json, export_status
-            )
+            mapping_type = form_mapping.mapping.mapping_type
+            if mapping_type == models.EVENT_TRACKER:
+                (values, map_errors) = self.handlers[mapping_type].map_to_values(
+                    instance, form_mapping.json, export_status
+                )
+            else:
+                (values, map_errors) = self.handlers[mapping_type].map_to_values(
+                    instance, form_mapping.json, export_status, plan=get_mapping_plan(form_mapping)
+                )
 
             if map_errors:
                 message = "ERROR while processing " + prefix + ", instance_id %d" % (instance.id,)
@@ -776,86 +817,155 @@ class DataValueExporter:
     def flag_as_exported(self, export_request, export_statuses, stats, export_logs):
         stats["exported_count"] += len(export_statuses)
         for export_status in export_statuses:
-            self.export_log_on(EXPORTED, export_status, export_logs)
+            export_status.status = EXPORTED
+        models.ExportStatus.objects.bulk_update(export_statuses, ["status"])
+        links = models.ExportStatus.export_logs.through
+        links.objects.bulk_create(
+            [
+                links(exportstatus_id=export_status.id, exportlog_id=export_log.id)
+                for export_status in export_statuses
+                for export_log in export_logs
+            ],
+            ignore_conflicts=True,
+        )
 
+        now = timezone.now()
+        models.Instance.objects.filter(id__in=[export_status.instance_id for export_status in export_statuses]).update(
+            last_export_success_at=now, to_export=False, updated_at=now
+        )
         for export_status in export_statuses:
-            instance = export_status.instance
-            instance.last_export_success_at = timezone.now()
-            instance.to_export = False
-            instance.save()
+            export_status.instance.last_export_success_at = now
+            export_status.instance.to_export = False
 
         export_request.errored_count = stats["errored_count"]
         export_request.exported_count = stats["exported_count"]
         export_request.save()
 
-    def export_instances(self, export_request, page_size=25, continue_on_error=False):
+    def iter_pages(self, export_request, page_size):
+        """Pages of ExportStatus, read with keyset pagination: each page starts after the last id of the previous one"""
+        queryset = export_request.exportstatus_set.select_related(
+            "mapping_version__mapping__data_source__credentials", "instance__org_unit__version"
+        ).order_by("id")
+        last_id = 0
+        while True:
+            export_statuses = list(queryset.filter(id__gt=last_id)[:page_size])
+            if not export_statuses:
+                return
+            yield export_statuses
+            last_id = export_statuses[-1].id
+
+    def send_page(self, prefix, data, api):
+        """Post the aggregate and event values of a page, called in a worker thread"""
+        start = timer()
+        stats = {"batched_time": 0}
+        export_logs = []
+        for mapping_type in (models.AGGREGATE, models.EVENT):
+            logs, exception = self.handlers[mapping_type].send_page(prefix, data[mapping_type], stats, api)
+            export_logs.extend(logs)
+            if exception:
+                return mapping_type, export_logs, exception, timer() - start
+        return None, export_logs, None, timer() - start
+
+    def record_page(self, export_request, pending_page, stats, metrics):
+        """Save the result of the DHIS2 calls of a page sent by `send_page`"""
+        errored_type, export_logs, exception, dhis2_time = pending_page.future.result()
+        metrics["dhis2_seconds"] += dhis2_time
+        db_start = timer()
+        if errored_type == models.AGGREGATE:
+            # the statuses are flagged errored with the log, as AggregateHandler.export_page
+            self.handlers[models.AGGREGATE].save_export_logs(export_logs, exception, pending_page.export_statuses)
+        ExportLog.objects.bulk_create(export_logs)
+        if exception:
+            raise exception
+        if len(pending_page.data[models.EVENT_TRACKER]) == 0:
+            self.flag_as_exported(export_request, pending_page.export_statuses, stats, export_logs)
+        metrics["db_seconds"] += timer() - db_start
+
+        # exported once the aggregate and event values of the page are accepted, as when the page was exported at once
+        self.handlers[models.EVENT_TRACKER].export_page(
+            pending_page.prefix,
+            pending_page.data[models.EVENT_TRACKER],
+            pending_page.export_statuses,
+            stats,
+            self.get_api(pending_page.export_statuses[0].mapping_version),
+        )
+
+    def run_page_step(self, export_request, export_statuses, stats, step, *args):
+        """Run step for a page, on errors flag the page and the export request as errored"""
+        try:
+            step(*args)
+        except InstanceExportError as exception:
+            self.flag_as_errored(export_request, export_statuses, exception.message, stats)
+            if not export_request.continue_on_error:
+                raise exception
+
+        # it's ok to catch BaseException, we want to be able to mark it as errored if cancelled or worst
+        except BaseException as exception:
+            self.flag_as_errored(
+                export_request, export_statuses, repr(exception) + " : " + type(exception).__name__, stats
+            )
+            raise exception
+
+    def export_instances(self, export_request, page_size=25, continue_on_error=False, concurrency=None):
+        if concurrency is None:
+            concurrency = settings.DHIS2_EXPORT_CONCURRENCY
         export_request.status = RUNNING
         export_request.started_at = timezone.now()
         export_request.continue_on_error = continue_on_error
         export_request.save()
 
-        paginator = Paginator(
-            export_request.exportstatus_set.prefetch_related("mapping_version")
-            .prefetch_related("instance")
-            .prefetch_related("instance__org_unit")
-            .prefetch_related("instance__org_unit__version")
-            .order_by("id")
-            .all(),
-            page_size,
-        )
-        if paginator.count == 0:
+        count = export_request.exportstatus_set.count()
+        if count == 0:
             logger.warning(f"Not linked error status for {export_request}")
+        num_pages = max(math.ceil(count / page_size), 1)
 
         skipped = []
         stats = {"exported_count": 0, "errored_count": 0}
-        export_statuses = []
-        for page in range(1, paginator.num_pages + 1):
-            page_start = timer()
-            prefix = "page %d/%d" % (page, paginator.num_pages)
+        metrics = {"pages": 0, "mapping_seconds": 0.0, "dhis2_seconds": 0.0, "db_seconds": 0.0}
+        start = timer()
+        pending: Deque[PendingPage] = deque()
+
+        def record_oldest_page():
+            pending_page = pending.popleft()
+            self.run_page_step(
+                export_request,
+                pending_page.export_statuses,
+                stats,
+                self.record_page,
+                export_request,
+                pending_page,
+                stats,
+                metrics,
+            )
+            logger.debug(pending_page.prefix + " recorded: %d skipped" % len(skipped))
+
+        def send_page(prefix, export_statuses):
+            mapping_start = timer()
+            data = self.map_page_to_data_values(prefix, export_statuses, skipped)
+            metrics["mapping_seconds"] += timer() - mapping_start
+            api = self.get_api(export_statuses[0].mapping_version)
+            pending.append(
+                PendingPage(prefix, export_statuses, data, executor.submit(self.send_page, prefix, data, api))
+            )
 
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
             try:
-                export_statuses = paginator.page(page).object_list
-                if len(export_statuses) == 0:
-                    logger.warning(f"Empty page {page} for {export_request}")
-                    continue
-                data = self.map_page_to_data_values(prefix, export_statuses, skipped)
-                api = self.get_api(export_statuses[0].mapping_version)
-
-                export_logs_aggregate = self.handlers[models.AGGREGATE].export_page(
-                    prefix, data[models.AGGREGATE], export_statuses, stats, api
-                )
-
-                export_logs_event = self.handlers[models.EVENT].export_page(
-                    prefix, data[models.EVENT], export_statuses, stats, api
-                )
-
-                self.handlers[models.EVENT_TRACKER].export_page(
-                    prefix, data[models.EVENT_TRACKER], export_statuses, stats, api
-                )
-
-                if len(data[models.EVENT_TRACKER]) == 0:
-                    export_logs = list(itertools.chain(export_logs_aggregate, export_logs_event))
-                    self.flag_as_exported(export_request, export_statuses, stats, export_logs)
-
-                page_end = timer()
-                page_time = page_end - page_start
-                logger.debug(
-                    prefix
-                    + " in %1.2f sec (dhis2 time %1.2f batched): %d skipped"
-                    % (page_time, stats["batched_time"], len(skipped))
-                )
-
-            except InstanceExportError as exception:
-                self.flag_as_errored(export_request, export_statuses, exception.message, stats)
-                if not export_request.continue_on_error:
-                    raise exception
-
-            # it's ok to catch BaseException, we want to be able to mark it as errored if cancelled or worst
-            except BaseException as exception:
-                self.flag_as_errored(
-                    export_request, export_statuses, repr(exception) + " : " + type(exception).__name__, stats
-                )
-                raise exception
+                for page, export_statuses in enumerate(self.iter_pages(export_request, page_size), 1):
+                    prefix = "page %d/%d" % (page, num_pages)
+                    metrics["pages"] += 1
+                    self.run_page_step(export_request, export_statuses, stats, send_page, prefix, export_statuses)
+                    # Bound the number of pages in flight
+                    while len(pending) >= concurrency:
+                        record_oldest_page()
+                while pending:
+                    record_oldest_page()
+            except BaseException:
+                # The pages already posted but not recorded stay SKIPPED, they will be sent again by the next export
+                # (DHIS2 updates the existing values and events)
+                executor.shutdown(wait=True, cancel_futures=True)
+                raise
+            finally:
+                self.save_metrics(export_request, metrics, stats, timer() - start)
 
         export_request.status = EXPORTED if stats["errored_count"] == 0 else ERRORED
         export_request.finished = True
@@ -863,3 +973,11 @@ class DataValueExporter:
         export_request.exported_count = stats["exported_count"]
         export_request.ended_at = timezone.now()
         export_request.save()
+
+    def save_metrics(self, export_request, metrics, stats, total_time):
+        processed_count = stats["exported_count"] + stats["errored_count"]
+        metrics = {key: round(value, 3) if isinstance(value, float) else value for key, value in metrics.items()}
+        metrics["total_seconds"] = round(total_time, 3)
+        metrics["instances_per_second"] = round(processed_count / total_time, 2) if total_time else None
+        export_request.result = {**(export_request.result or {}), "metrics": metrics}
+        export_request.save(update_fields=["result"])
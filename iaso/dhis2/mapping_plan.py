@@ -0,0 +1,91 @@
+"""
+Compiled question mappings of the aggregate and event MappingVersions.
+
+Mapping an instance used to walk the `question_mappings` of the mapping json, look up the value type and option set
+of each data element and annotate the shared mapping dict with the question key, for every answer of every instance.
+A `MappingPlan` does this once per mapping version: each mapped question is compiled to its data element id, a
+formatter (see `get_formatter`) and its category/attribute option combos, so mapping an instance is a loop over its
+answers.
+
+The plans are read only and cached per mapping version (id and last update) by `get_mapping_plan`, so they are
+shared by the pages and export requests of a worker.
+"""
+
+from types import MappingProxyType
+from typing import Callable, Dict, NamedTuple, Optional, Tuple
+
+from iaso.models import MappingVersion
+from iaso.utils.lru_cache import LRUCache
+from .value_formatter import get_formatter
+
+PLAN_CACHE_SIZE = 256
+
+# Keys of the data element copied to each data value
+OPTION_COMBO_KEYS = ("categoryOptionCombo", "attributeOptionCombo")
+
+
+class MultipleChoicePlan(NamedTuple):
+    value: str
+    data_element_id: str
+    format: Callable
+
+
+class QuestionPlan(NamedTuple):
+    question_key: str
+    # copy of the question mapping, with the question key, as reported in the mapping errors
+    data_element: dict
+    data_element_id: Optional[str]
+    format: Callable
+    option_combos: dict
+    # for "multiple" questions, one boolean data element per choice
+    choices: Optional[Tuple[MultipleChoicePlan, ...]]
+    # raised when the question is mapped, if the question mapping is invalid
+    error: Optional[Exception]
+
+
+def compile_question(question_key, question_mapping) -> QuestionPlan:
+    data_element = {**question_mapping, "question_key": question_key}
+    try:
+        choices = None
+        data_element_id = None
+        if data_element.get("type") == MappingVersion.QUESTION_MAPPING_MULTIPLE:
+            choices = tuple(
+                MultipleChoicePlan(value, choice["id"], get_formatter(choice))
+                for value, choice in data_element["values"].items()
+            )
+        else:
+            data_element_id = data_element["id"]
+        return QuestionPlan(
+            question_key=question_key,
+            data_element=data_element,
+            data_element_id=data_element_id,
+            format=get_formatter(data_element),
+            option_combos={key: data_element[key] for key in OPTION_COMBO_KEYS if key in data_element},
+            choices=choices,
+            error=None,
+        )
+    except Exception as error:
+        # get_formatter itself may be the one failing, e.g. on an invalid option set
+        def raise_error(raw_value, orgunit_resolver):
+            raise error
+
+        return QuestionPlan(question_key, data_element, None, raise_error, {}, None, error)
+
+
+class MappingPlan:
+    def __init__(self, form_mapping: dict):
+        questions: Dict[str, QuestionPlan] = {}
+        for question_key, question_mapping in form_mapping.get("question_mappings", {}).items():
+            if question_mapping.get("type") == MappingVersion.QUESTION_MAPPING_NEVER_MAPPED:
+                continue
+            questions[question_key] = compile_question(question_key, question_mapping)
+        self.questions = MappingProxyType(questions)
+
+
+_plans: "LRUCache[MappingPlan]" = LRUCache(PLAN_CACHE_SIZE)
+
+
+def get_mapping_plan(mapping_version: MappingVersion) -> MappingPlan:
+    """The compiled plan of mapping_version, cached until the mapping version is updated"""
+    key = (mapping_version.id, mapping_version.updated_at)
+    return _plans.get_or_compute(key, lambda: MappingPlan(mapping_version.json))
@@ -29,105 +29,146 @@ n        TRUE_ONLY              Yes only	        True values, renders as check-b
 
 
 def translate_optionset(data_element, raw_value):
-    if "optionSet" in data_element:
-        if raw_value == "":
-            return None
+    return get_optionset_translator(data_element)(raw_value)
+
 
-        for options in data_element["optionSet"]["options"]:
-            if options.get("odk") == raw_value:
-                return options["code"]
+def get_optionset_translator(data_element):
+    """Function translating the raw values of data_element with its option set, its options are indexed once"""
+    if "optionSet" not in data_element:
+        return lambda raw_value: raw_value
 
-        for options in data_element["optionSet"]["options"]:
-            if options["code"] == raw_value:
-                return raw_value
+    options = data_element["optionSet"]["options"]
+    codes_by_odk = {}
+    for option in options:
+        if option.get("odk") is not None:
+            codes_by_odk.setdefault(option["odk"], option["code"])
+    codes = {option["code"] for option in options}
 
+    def translate(raw_value):
+        if raw_value == "":
+            return None
+        if raw_value in codes_by_odk:
+            return codes_by_odk[raw_value]
+        if raw_value in codes:
+            return raw_value
         raise Exception("no value matching : '" + raw_value + "' in " + str(data_element))
-    return raw_value
 
+    return translate
 
-def format_value(data_element, raw_value, orgunit_resolver):
-    if "valueType" in data_element:
-        data_element_type = data_element["valueType"]
-    else:
-        raise Exception("no valueType for ", data_element)
 
-    if raw_value is None:
+def format_number(data_element, raw_value, translated_value, orgunit_resolver):
+    if translated_value == "":
         return None
+    try:
+        if isinstance(translated_value, float):
+            return translated_value
+        if isinstance(translated_value, int):
+            return translated_value
+        if "." in translated_value:
+            return float(translated_value)
+        else:
+            return int(translated_value)
+    except Exception:
+        raise Exception("Bad value for float '" + str(raw_value) + "'", data_element)
 
-    translated_value = translate_optionset(data_element, raw_value)
 
-    if data_element_type == "NUMBER":
-        if translated_value == "":
-            return None
-        try:
-            if isinstance(translated_value, float):
-                return translated_value
-            if isinstance(translated_value, int):
-                return translated_value
-            if "." in translated_value:
-                return float(translated_value)
-            else:
-                return int(translated_value)
-        except Exception:
-            import traceback
-
-            raise Exception("Bad value for float '" + str(raw_value) + "'", data_element)
-
-    if (
-        data_element_type == "INTEGER_ZERO_OR_POSITIVE"
-        or data_element_type == "INTEGER"
-        or data_element_type == "INTEGER_POSITIVE"
-        or data_element_type == "INTEGER_NEGATIVE"
-        or data_element_type == "PERCENTAGE"
-    ):
-        if translated_value == "":
-            return None
-        try:
-            return int(translated_value)
-        except:
-            raise Exception("Bad value for int '" + str(raw_value) + "'", data_element)
+def format_integer(data_element, raw_value, translated_value, orgunit_resolver):
+    if translated_value == "":
+        return None
+    try:
+        return int(translated_value)
+    except:
+        raise Exception("Bad value for int '" + str(raw_value) + "'", data_element)
 
-    if data_element_type == "ORGANISATION_UNIT":
-        if translated_value is None:
-            return None
-        return orgunit_resolver(str(translated_value))
-
-    if (
-        data_element_type == "TEXT"
-        or data_element_type == "LONG_TEXT"
-        or data_element_type == "USERNAME"
-        or data_element_type == "EMAIL"
-        or data_element_type == "PHONE_NUMBER"
-        or data_element_type == "LETTER"
-    ):
-        if translated_value is None:
-            return None
-        return str(translated_value)
-
-    if data_element_type == "BOOLEAN":
-        if translated_value == "1" or translated_value == "yes" or translated_value == "true" or translated_value == 1:
-            return True
-        elif (
-            translated_value == "0" or translated_value == "no" or translated_value == "false" or translated_value == 0
-        ):
-            return False
-        elif translated_value == "":
-            return None
-        else:
-            raise Exception("Bad value for boolean '" + str(raw_value) + "'", data_element)
 
-    if data_element_type == "COORDINATE":
-        if translated_value:
-            coordinates = translated_value.split(" ")
-            return "[" + coordinates[1] + "," + coordinates[0] + "]"
+def format_org_unit(data_element, raw_value, translated_value, orgunit_resolver):
+    if translated_value is None:
         return None
+    return orgunit_resolver(str(translated_value))
 
-    if data_element_type == "TIME":
-        return translated_value[0:5]
 
-    if data_element_type == "DATE" or data_element_type == "AGE":
-        if translated_value:
-            return translated_value
+def format_text(data_element, raw_value, translated_value, orgunit_resolver):
+    if translated_value is None:
         return None
+    return str(translated_value)
+
+
+def format_boolean(data_element, raw_value, translated_value, orgunit_resolver):
+    if translated_value == "1" or translated_value == "yes" or translated_value == "true" or translated_value == 1:
+        return True
+    elif translated_value == "0" or translated_value == "no" or translated_value == "false" or translated_value == 0:
+        return False
+    elif translated_value == "":
+        return None
+    else:
+        raise Exception("Bad value for boolean '" + str(raw_value) + "'", data_element)
+
+
+def format_coordinate(data_element, raw_value, translated_value, orgunit_resolver):
+    if translated_value:
+        coordinates = translated_value.split(" ")
+        return "[" + coordinates[1] + "," + coordinates[0] + "]"
+    return None
+
+
+def format_time(data_element, raw_value, translated_value, orgunit_resolver):
+    return translated_value[0:5]
+
 
+def format_date(data_element, raw_value, translated_value, orgunit_resolver):
+    if translated_value:
+        return translated_value
+    return None
+
+
+def format_unsupported(data_element, raw_value, translated_value, orgunit_resolver):
     raise Exception("unsupported data element type : " + str(data_element), raw_value)
+
+
+FORMATTERS = {
+    "NUMBER": format_number,
+    "INTEGER_ZERO_OR_POSITIVE": format_integer,
+    "INTEGER": format_integer,
+    "INTEGER_POSITIVE": format_integer,
+    "INTEGER_NEGATIVE": format_integer,
+    "PERCENTAGE": format_integer,
+    "ORGANISATION_UNIT": format_org_unit,
+    "TEXT": format_text,
+    "LONG_TEXT": format_text,
+    "USERNAME": format_text,
+    "EMAIL": format_text,
+    "PHONE_NUMBER": format_text,
+    "LETTER": format_text,
+    "BOOLEAN": format_boolean,
+    "COORDINATE": format_coordinate,
+    "TIME": format_time,
+    "DATE": format_date,
+    "AGE": format_date,
+}
+
+
+def get_formatter(data_element):
+    """Function formatting the raw values of data_element: `formatter(raw_value, orgunit_resolver)`
+
+    The value type and option set are looked up once, so the formatter can be reused for all the values of the
+    data element, see iaso/dhis2/mapping_plan.py."""
+    if "valueType" not in data_element:
+
+        def missing_value_type(raw_value, orgunit_resolver):
+            raise Exception("no valueType for ", data_element)
+
+        return missing_value_type
+
+    format_translated = FORMATTERS.get(data_element["valueType"], format_unsupported)
+    translate = get_optionset_translator(data_element)
+
+    def formatter(raw_value, orgunit_resolver):
+        if raw_value is None:
+            return None
+        return format_translated(data_element, raw_value, translate(raw_value), orgunit_resolver)
+
+    return formatter
+
+
+def format_value(data_element, raw_value, orgunit_resolver):
+    return get_formatter(data_element)(raw_value, orgunit_resolver)
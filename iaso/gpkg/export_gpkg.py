@@ -5,127 +5,129 @@ import os
 import sqlite3
 import tempfile
 import uuid
-from typing import Optional
+from itertools import groupby
+from typing import Iterable, Iterator, List
 
-import geopandas as gpd  # type: ignore
-from django.contrib.gis.geos import GEOSGeometry
+import fiona  # type: ignore
+import shapely  # type: ignore
+from django.core.exceptions import EmptyResultSet
+from django.db import connection
 from django.db.models import QuerySet
-from pandas import DataFrame
-from shapely import wkt  # type: ignore
-from shapely.geometry.base import BaseGeometry  # type: ignore
+from shapely.geometry import mapping  # type: ignore
 
 from iaso.gpkg.import_gpkg import get_ref
 from iaso.models import Group
 from iaso.models import SourceVersion, OrgUnit
 
+"""
+The org units are streamed from the database instead of being loaded in a DataFrame: the rows are read in chunks from
+a server side cursor, ordered by layer, with their geometry as WKB straight from PostGIS and their groups aggregated
+by the query. Each chunk is appended to the layer of its org unit type, so the memory used doesn't depend on the size
+of the exported pyramid.
+"""
+
+CHUNK_SIZE = 5000
+
+# Columns of the layers, see "Export Format" in README.md
 OUT_COLUMNS = [
+    "id",
     "name",
     "ref",
-    "geography",
     "parent",
     "parent_ref",
     "group_refs",
     "group_names",
-    # "id", # it's present as  an index, so it bug GeoPandas but it's exported
     "uuid",
 ]
 
-
-def geos_to_shapely(geom: Optional[GEOSGeometry]) -> Optional[BaseGeometry]:
-    # Pandas need a shapely geom because it needs an object with __geo_interface__ for fiona
-    if not geom:
-        return None
-    shape = wkt.loads(geom.wkt)
-    return shape if not shape.is_empty else None
+LAYER_SCHEMA = {
+    "geometry": "Unknown",
+    "properties": {column: "int" if column == "id" else "str" for column in OUT_COLUMNS},
+}
+
+# The refs of org units and groups without source_ref are `iaso#{id}`, as in `get_ref`
+EXPORT_QUERY = """
+    SELECT
+        COALESCE(ou_type.depth, 999) AS depth,
+        COALESCE(ou_type.name, 'Unknown') AS type,
+        ST_AsBinary(COALESCE(ou.geom::geometry, ou.simplified_geom::geometry, ou.location::geometry)) AS geography,
+        ou.id,
+        ou.name,
+        COALESCE(ou.source_ref, 'iaso#' || ou.id) AS ref,
+        parent.name || ' (' || parent_type.name || ')' AS parent,
+        CASE WHEN ou.parent_id IS NOT NULL THEN COALESCE(parent.source_ref, 'iaso#' || ou.parent_id) END AS parent_ref,
+        groups.refs AS group_refs,
+        groups.names AS group_names,
+        ou.uuid
+    FROM iaso_orgunit ou
+    LEFT JOIN iaso_orgunittype ou_type ON ou_type.id = ou.org_unit_type_id
+    LEFT JOIN iaso_orgunit parent ON parent.id = ou.parent_id
+    LEFT JOIN iaso_orgunittype parent_type ON parent_type.id = parent.org_unit_type_id
+    LEFT JOIN LATERAL (
+        SELECT
+            string_agg(COALESCE(g.source_ref, 'iaso#' || g.id), ', ' ORDER BY g.id) AS refs,
+            string_agg(g.name, ', ' ORDER BY g.id) AS names
+        FROM iaso_group_org_units link JOIN iaso_group g ON g.id = link.group_id
+        WHERE link.orgunit_id = ou.id
+    ) groups ON TRUE
+    WHERE ou.id IN ({org_units})
+    ORDER BY 1, 2, ou.id
+"""
 
 
-ORG_UNIT_COLUMNS = [
-    "id",
-    "name",
-    "source_ref",
-    "parent__name",
-    "parent__source_ref",
-    "parent__id",
-    "parent__org_unit_type__name",
-    "org_unit_type__name",
-    "org_unit_type__depth",
-    "uuid",
-    "location",
-    "geom",
-    "simplified_geom",
-]
+def iter_org_unit_chunks(orgunits: "QuerySet[OrgUnit]", chunk_size: int = CHUNK_SIZE) -> Iterator[List[tuple]]:
+    """Rows of EXPORT_QUERY for the org units of the queryset, by chunks read from a server side cursor"""
+    try:
+        org_units_sql, params = orgunits.order_by().values("id").query.sql_with_params()
+    except EmptyResultSet:
+        return
+    with connection.chunked_cursor() as cursor:
+        cursor.execute(EXPORT_QUERY.format(org_units=org_units_sql), params)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+
+
+def layer_name(depth: int, type_name: str) -> str:
+    return f"level-{depth}-{type_name}"
+
+
+def to_records(rows: List[tuple]) -> Iterable[dict]:
+    # Parse the WKB of the whole chunk at once, fiona needs the geometries as GeoJSON like dicts
+    geometries = shapely.from_wkb([bytes(row[2]) if row[2] is not None else None for row in rows])
+    for row, geometry in zip(rows, geometries):
+        yield {
+            "geometry": mapping(geometry) if geometry is not None and not geometry.is_empty else None,
+            "properties": dict(zip(OUT_COLUMNS, row[3:])),
+        }
 
 
-def export_org_units_to_gpkg(filepath, orgunits: "QuerySet[OrgUnit]") -> None:
+def export_org_units_to_gpkg(filepath, orgunits: "QuerySet[OrgUnit]", chunk_size: int = CHUNK_SIZE) -> None:
     """Export the provided org unit queryset in GeoPackage (gpkg) format.
 
     Internal, use the other method as it only export orgunit and not group
 
-    The file may or may not exist.
-    filter_empty_geom is for compat with the old api"""
-
-    df = gpd.GeoDataFrame(orgunits.values(*ORG_UNIT_COLUMNS))
-
-    # cleanup / transforms
-    df = df.rename(
-        columns={
-            "org_unit_type__name": "type",
-            "org_unit_type__depth": "depth",
-        }
-    )
-    df["parent"] = df["parent__name"] + " (" + df["parent__org_unit_type__name"] + ")"
-    # Calculate alternative parent ref if we have a parent
-    df.loc[df["parent__id"].notnull(), "alt_parent_ref"] = df["parent__id"].apply(
-        lambda x: "iaso#{:.0f}".format(x) if x else None
-    )
-    # fill parent ref with alternative if we don't have one.
-    df["parent_ref"] = df["parent__source_ref"].fillna(df["alt_parent_ref"])
-    df["ref"] = df["source_ref"].fillna("iaso#" + df["id"].astype(str))
-    df["geography"] = df["geom"].fillna(df["simplified_geom"].fillna(df["location"]))
-    df["depth"] = df["depth"].fillna(999)
-    df["depth"] = df["depth"].astype(int)
-    df["type"] = df["type"].fillna("Unknown")
-
-    # Convert django geometry values (GEOS) to shapely models
-    df["geography"] = df["geography"].map(geos_to_shapely)
-
-    # Add the groups the orgunit belong to.
-    # values will return one line per orgunit - group combination
-    # so we will need to aggregate them and join them with the orgunit df
-    dg = DataFrame(orgunits.values("id", "groups__id", "groups__source_ref", "groups__name"))
-    dg = dg.dropna(subset=["groups__id"])  # drop orgunit that have no groups
-    dg = dg.set_index("id")
-    # same as OrgUnit fill missing ref with artificial ref based on id
-    dg["ref"] = dg["groups__source_ref"].fillna(dg["groups__id"].apply("iaso#{:.0f}".format))
-    # drop the other columns
-    dg = dg[["ref", "groups__name"]]
-    # Aggregate so there is one line per orgunit, and value are in a nice str
-    dog = dg[["ref", "groups__name"]].groupby("id").aggregate(lambda x: ", ".join(x))
-    dog = dog.rename(columns={"groups__name": "group_names", "ref": "group_refs"})
-    # Should produce a df like this  where index id is the OrgUnit.id=>
-    #                                                group_refs                                        group_names
-    # id
-    # 367989  Oivhk4v2ZVC, f30c3dZKVHA, CmUdnSqK776, CzoGWyy...  CSI TYPE II, Rural, CSI+ CS + infirmerie, CSI ...
-    # 367992  CmUdnSqK776, GXDIyF6Hq4m, CzoGWyy6fOl, qVyLsaa...  CSI+ CS + infirmerie, CSI TYPE  I, CSI + CS, P...
-    # 368013                           KX9EuY75nGE, cLAexA2XA80                            HD, Groupe des Hopitaux
-    # 368041  wHZQ5lPZobO, CmUdnSqK776, GXDIyF6Hq4m, CzoGWyy...  2017, CSI+ CS + infirmerie, CSI TYPE  I, CSI + CS
-
-    # Now we join the OrgUnit df
-    df = df.set_index("id")
-    df = df.join(dog)
-
-    # Convert to GeoDataframe, and group by org unit type
-    # as we want one layer per OrgUnitType
-    ou_gdf = gpd.GeoDataFrame(df, geometry="geography")
-    ou_gdf["layer_name"] = "level-" + ou_gdf["depth"].astype(str) + "-" + ou_gdf["type"]
-
-    ou_gdf_by_type = ou_gdf.groupby("layer_name")
-
-    for layer_name, group in ou_gdf_by_type:
-        # keep only the columns we want to export and reorder them
-        group = group[OUT_COLUMNS]
-        # projection is hardcoded, but we use geography column
-        group.to_file(filepath, driver="GPKG", layer=layer_name, crs="EPSG:4326")
+    One layer per org unit type, written incrementally: a chunk may span several layers but a layer is never reopened
+    since the rows are ordered by layer.
+    The file may or may not exist."""
+
+    layer = None
+    current_layer_name = None
+    try:
+        for rows in iter_org_unit_chunks(orgunits, chunk_size):
+            for name, layer_rows in groupby(rows, key=lambda row: layer_name(row[0], row[1])):
+                if name != current_layer_name:
+                    if layer is not None:
+                        layer.close()
+                    # projection is hardcoded, but we use geography column
+                    layer = fiona.open(filepath, "w", driver="GPKG", layer=name, schema=LAYER_SCHEMA, crs="EPSG:4326")
+                    current_layer_name = name
+                layer.writerecords(to_records(list(layer_rows)))
+    finally:
+        if layer is not None:
+            layer.close()
 
 
 CREATE_GROUPS_TABLE_QUERY = """create table groups
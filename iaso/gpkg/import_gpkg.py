@@ -1,15 +1,17 @@
 import math
 import sqlite3
-from copy import deepcopy
+from copy import copy, deepcopy
 from typing import Dict, List, Optional, Tuple, Union
 
 import fiona  # type: ignore
 from django.contrib.auth.models import User
 from django.contrib.gis.geos import MultiPolygon, Point, Polygon
 from django.db import transaction
+from django.utils.timezone import now
 
 from hat.audit import models as audit_models
-from iaso.models import DataSource, Group, OrgUnit, OrgUnitType, Project, SourceVersion
+from hat.audit.writer import audit_writer
+from iaso.models import DataSource, Group, MobileOrgUnitSnapshot, OrgUnit, OrgUnitType, Project, SourceVersion
 from iaso.models.org_unit import get_or_create_org_unit_type
 
 try:  # only in 3.8
@@ -88,22 +90,13 @@ def create_or_update_group(group: Group, ref: str, name: str, version: SourceVer
     return group
 
 
-def create_or_update_orgunit(
-    orgunit: Optional[OrgUnit],
-    data: OrgUnitData,
-    source_version: SourceVersion,
-    validation_status: str,
-    ref_group: Dict[str, Group],
+def set_orgunit_fields(
+    orgunit: OrgUnit, data: OrgUnitData, source_version: SourceVersion, validation_status: str
 ) -> OrgUnit:
+    """Set the fields of orgunit from the gpkg row, without saving it"""
     props = data["properties"]
     geometry = data["geometry"]
 
-    if not orgunit:
-        orgunit = OrgUnit()
-    else:
-        # Make a copy, so we can do the audit log, otherwise we would edit in place
-        orgunit = deepcopy(orgunit)
-
     orgunit.name = props["name"]
     orgunit.org_unit_type = data["type"]
     if orgunit.validation_status is None:
@@ -121,26 +114,46 @@ def create_or_update_orgunit(
             if type(simplified_geom) == Polygon:
                 simplified_geom = MultiPolygon(simplified_geom)
             orgunit.simplified_geom = simplified_geom
+    return orgunit
 
-    orgunit.save(skip_calculate_path=True)
 
+def get_groups(props: PropertyDict, ref_group: Dict[str, Group], orgunit: OrgUnit) -> Optional[List[Group]]:
+    """Groups of the org unit according to the group_refs column, None if the column is not there"""
     if "group_refs" not in props:
         # the column is not here we don't touch the group
-        pass
-    elif not props["group_refs"]:
+        return None
+    if not props["group_refs"]:
         # if it's an empty string or null we will remove all groups presumably
         # I previously wanted to differentiate the case of empty str vs null but QGIS don't show the difference
         #  in the ui so it's perilous
-        if orgunit is not None and orgunit.id is not None:
-            orgunit.groups.clear()
-    elif props["group_refs"]:
-        group_refs = props["group_refs"].split(",")
-        group_refs = [ref.strip() for ref in group_refs]
-
-        try:
-            groups = [ref_group[ref] for ref in group_refs if ref]
-        except KeyError:
-            raise ValueError(f"Bad GPKG group {group_refs} for {orgunit} don't exist in input or SourceVersion")
+        return []
+    group_refs = props["group_refs"].split(",")
+    group_refs = [ref.strip() for ref in group_refs]
+
+    try:
+        return [ref_group[ref] for ref in group_refs if ref]
+    except KeyError:
+        raise ValueError(f"Bad GPKG group {group_refs} for {orgunit} don't exist in input or SourceVersion")
+
+
+def create_or_update_orgunit(
+    orgunit: Optional[OrgUnit],
+    data: OrgUnitData,
+    source_version: SourceVersion,
+    validation_status: str,
+    ref_group: Dict[str, Group],
+) -> OrgUnit:
+    if not orgunit:
+        orgunit = OrgUnit()
+    else:
+        # Make a copy, so we can do the audit log, otherwise we would edit in place
+        orgunit = deepcopy(orgunit)
+
+    set_orgunit_fields(orgunit, data, source_version, validation_status)
+    orgunit.save(skip_calculate_path=True)
+
+    groups = get_groups(data["properties"], ref_group, orgunit)
+    if groups is not None:
         orgunit.groups.set(groups)
 
     return orgunit
@@ -152,8 +165,167 @@ def get_ref(inst: Union[OrgUnit, Group]) -> str:
     return inst.source_ref if inst.source_ref else f"iaso#{inst.pk}"
 
 
+"""
+Bulk import: instead of saving each org unit twice (with and then without its parent) and logging each modification
+separately, the rows of all the layers are staged in memory, the parents are resolved by ref, then the org units are
+inserted level by level and updated with bulk queries. The paths are computed once, top-down, for the staged org units,
+and the descendants of the moved ones which are not in the GPKG are moved with one query per moved org unit. The audit
+records are written in batches.
+"""
+
+BULK_BATCH_SIZE = 2000
+
+IMPORTED_FIELDS = [
+    "name",
+    "org_unit_type",
+    "validation_status",
+    "source_ref",
+    "version",
+    "location",
+    "geom",
+    "simplified_geom",
+    "parent",
+]
+
+
+class StagedOrgUnit(TypedDict):
+    orgunit: OrgUnit
+    # the org unit as it was in the database, None if it is created
+    original: Optional[OrgUnit]
+    parent_ref: Optional[str]
+    # None if the groups of the org unit are not modified
+    groups: Optional[List[Group]]
+
+
+def stage_orgunits(
+    filename,
+    project: Project,
+    source_version: SourceVersion,
+    validation_status: str,
+    ref_group: Dict[str, Group],
+    ref_ou: Dict[str, OrgUnit],
+) -> Tuple[List[StagedOrgUnit], int]:
+    """Read the org units of all the layers, without saving them. ref_ou is updated with the staged org units.
+
+    Return the staged org units and the number of rows read"""
+    staged: List[StagedOrgUnit] = []
+    staged_by_ref: Dict[str, StagedOrgUnit] = {}
+    total_rows = 0
+    for layer_name in fiona.listlayers(filename):
+        # layers to import must be named level-{depth}-{name}
+        if not layer_name.startswith("level-"):
+            continue
+
+        _, depth, name = layer_name.split("-", maxsplit=2)
+        org_unit_type = get_or_create_org_unit_type_and_assign_project(name, project, int(depth))
+
+        with fiona.open(filename, mode="r", layer=layer_name) as colx:
+            for row in colx:
+                data: OrgUnitData = {
+                    "geometry": row["geometry"],
+                    "properties": row["properties"],
+                    "type": org_unit_type,
+                }
+                ref = row["properties"]["ref"]
+                entry = staged_by_ref.get(ref) if ref else None
+                if entry is None:
+                    original = ref_ou.get(ref)
+                    # Copy the existing org unit, so we can do the audit log
+                    entry = {
+                        "orgunit": copy(original) if original else OrgUnit(),
+                        "original": original,
+                        "parent_ref": None,
+                        "groups": None,
+                    }
+                    staged.append(entry)
+                    if ref:
+                        staged_by_ref[ref] = entry
+
+                orgunit = set_orgunit_fields(entry["orgunit"], data, source_version, validation_status)
+                # work around https://code.djangoproject.com/ticket/33787, as in OrgUnit.save()
+                if orgunit.location is not None and orgunit.location.empty:
+                    orgunit.location = None
+                if ref:
+                    ref_ou[ref] = orgunit
+                entry["parent_ref"] = row["properties"]["parent_ref"]
+                entry["groups"] = get_groups(row["properties"], ref_group, orgunit)
+                total_rows += 1
+    return staged, total_rows
+
+
+def resolve_parents(staged: List[StagedOrgUnit], ref_ou: Dict[str, OrgUnit]) -> None:
+    for entry in staged:
+        orgunit, parent_ref = entry["orgunit"], entry["parent_ref"]
+        if parent_ref and parent_ref not in ref_ou:
+            raise ValueError(f"Bad GPKG parent {parent_ref} for {orgunit} don't exist in input or SourceVersion")
+        orgunit.parent = ref_ou[parent_ref] if parent_ref else None
+
+
+def save_staged_orgunits(staged: List[StagedOrgUnit]) -> None:
+    """Insert the new org units, parents first, then update the existing ones"""
+    remaining = [entry["orgunit"] for entry in staged if entry["original"] is None]
+    while remaining:
+        ready = [orgunit for orgunit in remaining if orgunit.parent is None or orgunit.parent.pk is not None]
+        if not ready:
+            raise ValueError(f"Bad GPKG parents, there is a cycle between {remaining[:10]}")
+        for orgunit in ready:
+            orgunit.parent_id = orgunit.parent.pk if orgunit.parent is not None else None
+        OrgUnit.objects.bulk_create(ready, batch_size=BULK_BATCH_SIZE)
+        remaining = [orgunit for orgunit in remaining if orgunit.pk is None]
+
+    updated = [entry["orgunit"] for entry in staged if entry["original"] is not None]
+    for orgunit in updated:
+        orgunit.parent_id = orgunit.parent.pk if orgunit.parent is not None else None
+        orgunit.updated_at = now()
+    OrgUnit.objects.bulk_update(updated, [*IMPORTED_FIELDS, "updated_at"], batch_size=BULK_BATCH_SIZE)
+
+
+def save_staged_groups(staged: List[StagedOrgUnit], source_version: SourceVersion) -> None:
+    Membership = Group.org_units.through
+    with_groups = [entry for entry in staged if entry["groups"] is not None]
+    existing_ids = [entry["orgunit"].pk for entry in with_groups if entry["original"] is not None]
+    for start in range(0, len(existing_ids), BULK_BATCH_SIZE):
+        Membership.objects.filter(orgunit_id__in=existing_ids[start : start + BULK_BATCH_SIZE]).delete()
+    Membership.objects.bulk_create(
+        [
+            Membership(group_id=group.pk, orgunit_id=entry["orgunit"].pk)
+            for entry in with_groups
+            for group in entry["groups"]  # type: ignore
+        ],
+        batch_size=BULK_BATCH_SIZE,
+        ignore_conflicts=True,
+    )
+    # the memberships are changed without the m2m_changed signal
+    MobileOrgUnitSnapshot.objects.invalidate_for_versions([source_version.id])
+
+
+def bulk_import_orgunits(
+    filename,
+    project: Project,
+    source_version: SourceVersion,
+    validation_status: str,
+    ref_group: Dict[str, Group],
+    ref_ou: Dict[str, OrgUnit],
+    user: Optional[User],
+) -> int:
+    staged, total_org_unit = stage_orgunits(filename, project, source_version, validation_status, ref_group, ref_ou)
+    resolve_parents(staged, ref_ou)
+    save_staged_orgunits(staged)
+    OrgUnit.objects.bulk_update_paths([entry["orgunit"] for entry in staged], batch_size=BULK_BATCH_SIZE)
+    save_staged_groups(staged, source_version)
+
+    modifications_to_log = [
+        (entry["original"], entry["orgunit"])
+        for entry in staged
+        if entry["orgunit"].location is not None or entry["orgunit"].geom is not None
+    ]
+    audit_writer.log_many(modifications_to_log, source=audit_models.GPKG_IMPORT, user=user)
+    audit_writer.flush()
+    return total_org_unit
+
+
 @transaction.atomic
-def import_gpkg_file(filename, project_id, source_name, version_number, validation_status, description):
+def import_gpkg_file(filename, project_id, source_name, version_number, validation_status, description, bulk=False):
     source, created = DataSource.objects.get_or_create(name=source_name)
     if source.read_only:
         raise Exception("Source is marked read only")
@@ -161,7 +333,9 @@ def import_gpkg_file(filename, project_id, source_name, version_number, validati
     # to our project via the tenant.
     source.projects.add(project_id)
     project = Project.objects.get(id=project_id)
-    import_gpkg_file2(filename, project, source, version_number, validation_status, user=None, description=description)
+    import_gpkg_file2(
+        filename, project, source, version_number, validation_status, user=None, description=description, bulk=bulk
+    )
 
 
 @transaction.atomic
@@ -173,7 +347,11 @@ def import_gpkg_file2(
     validation_status,
     user: Optional[User],
     description,
+    bulk: bool = False,
 ):
+    """Import the org units and groups of the gpkg in the version version_number of source
+
+    With bulk, the org units are saved with bulk queries, see `bulk_import_orgunits`."""
     if version_number is None:
         last_version = source.versions.all().order_by("number").last()
         version_number = last_version.number + 1 if last_version else 0
@@ -211,6 +389,9 @@ def import_gpkg_file2(
         ref = get_ref(ou)
         ref_ou[ref] = ou
 
+    if bulk:
+        return bulk_import_orgunits(filename, project, version, validation_status, ref_group, ref_ou, user)
+
     # The child may be created before the parent, so we keep a list to update after creating them all
     to_update_with_parent: List[Tuple[str, str]] = []
     modifications_to_log: List[Tuple[Optional[OrgUnit], OrgUnit]] = []
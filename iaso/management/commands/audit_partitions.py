@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from hat.audit import partitions
+
+
+class Command(BaseCommand):
+    help = """Manage the monthly partitions of the audit log (audit_modification table)
+
+    create: create the partitions of the coming months, so the new modifications don't end up in the default
+            partition. Also done monthly by the create_audit_partitions task (see cron.yaml).
+    detach: detach the partitions older than --keep-months, their modifications are no longer listed in the logs.
+    archive: detach the old partitions, then dump each detached partition to a compressed CSV file in --directory and
+             drop it."""
+
+    def add_arguments(self, parser):
+        parser.add_argument("action", choices=["list", "create", "detach", "archive"])
+        parser.add_argument("--months", type=int, default=3, help="Number of months to create in advance")
+        parser.add_argument("--keep-months", type=int, default=24, help="Number of past months to keep attached")
+        parser.add_argument("--directory", help="Directory where the archives are written")
+
+    def handle(self, *args, **options):
+        if not partitions.is_partitioned():
+            raise CommandError(f"{partitions.TABLE} is not partitioned")
+        action = options["action"]
+
+        if action == "list":
+            for partition in partitions.list_partitions():
+                bounds = "default" if partition.is_default else f"{partition.start or '-'} to {partition.end}"
+                self.stdout.write(f"{partition.name}: {bounds}")
+            for name in partitions.list_detached_partitions():
+                self.stdout.write(f"{name}: detached")
+
+        elif action == "create":
+            for name in partitions.create_partitions(options["months"]):
+                self.stdout.write(f"Created {name}")
+
+        else:
+            if action == "archive" and not options["directory"]:
+                raise CommandError("--directory is required to archive the partitions")
+            current_month = partitions.month_start(timezone.now())
+            before = partitions.add_months(current_month, -options["keep_months"])
+            for name in partitions.detach_partitions(before):
+                self.stdout.write(f"Detached {name}")
+            if action == "archive":
+                for name in partitions.list_detached_partitions():
+                    path = partitions.archive_partition(name, options["directory"])
+                    self.stdout.write(f"Archived {name} to {path}")
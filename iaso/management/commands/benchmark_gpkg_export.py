@@ -0,0 +1,112 @@
+import os
+import random
+import tempfile
+import tracemalloc
+from time import perf_counter
+
+from django.conf import settings
+from django.contrib.gis.geos import MultiPolygon, Point
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from iaso.gpkg.export_gpkg import CHUNK_SIZE, add_group_in_gpkg, export_org_units_to_gpkg
+from iaso.models import DataSource, Group, OrgUnit, OrgUnitType, SourceVersion
+
+# name and number of children per parent of the levels with a shape, the last level is filled with facilities
+LEVELS = [("Country", 1), ("Region", 10), ("District", 20), ("Area", 25)]
+BATCH_SIZE = 5000
+
+
+class Command(BaseCommand):
+    help = (
+        "Export a synthetic pyramid to a GeoPackage and report the time and peak memory used by the export. "
+        "The pyramid is created in a transaction which is rolled back at the end."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--count", type=int, default=500_000, help="Number of org units in the pyramid")
+        parser.add_argument("--vertices", type=int, default=64, help="Number of vertices of the shapes")
+        parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="Rows read per chunk by the exporter")
+
+    def handle(self, *args, **options):
+        if not settings.DEBUG:
+            raise CommandError("Cannot run the benchmark in non-debug mode")
+
+        with transaction.atomic():
+            start = perf_counter()
+            version = self.create_pyramid(options["count"], options["vertices"])
+            self.stdout.write(f"Created {options['count']} org units in {perf_counter() - start:.1f}s")
+
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                filepath = os.path.join(tmp_dir, "benchmark.gpkg")
+                start = perf_counter()
+                self.export(filepath, version, options["chunk_size"])
+                duration = perf_counter() - start
+                size = os.path.getsize(filepath) / 1024 / 1024
+
+                # Exported again to measure the memory: tracing the allocations slows the export down. Only the
+                # memory allocated during the export is counted, not the one used by the pyramid creation.
+                os.remove(filepath)
+                tracemalloc.start()
+                try:
+                    self.export(filepath, version, options["chunk_size"])
+                    _current, peak = tracemalloc.get_traced_memory()
+                finally:
+                    tracemalloc.stop()
+
+            self.stdout.write(f"Exported in {duration:.1f}s, {size:.1f} MB")
+            self.stdout.write(f"Peak memory allocated by the export: {peak / 1024 / 1024:.0f} MB")
+            transaction.set_rollback(True)
+
+    def export(self, filepath: str, version: SourceVersion, chunk_size: int):
+        export_org_units_to_gpkg(filepath, version.orgunit_set.all(), chunk_size=chunk_size)
+        add_group_in_gpkg(filepath, Group.all_objects.filter(source_version=version))
+
+    def create_pyramid(self, count: int, vertices: int) -> SourceVersion:
+        source = DataSource.objects.create(name="GPKG export benchmark")
+        version = SourceVersion.objects.create(data_source=source, number=1)
+        groups = [Group.objects.create(name=f"Group {i}", source_version=version) for i in range(2)]
+
+        parent_ids = [None]
+        created = 0
+        for depth, (name, children) in enumerate(LEVELS):
+            org_unit_type = OrgUnitType.objects.create(name=name, depth=depth)
+            org_units = []
+            for parent_id in parent_ids:
+                for i in range(children):
+                    shape = Point(random.uniform(-20, 40), random.uniform(-30, 30)).buffer(0.5, vertices // 4)
+                    org_units.append(
+                        OrgUnit(
+                            name=f"{name} {created + len(org_units)}",
+                            source_ref=f"{name.lower()}-{created + len(org_units)}",
+                            org_unit_type=org_unit_type,
+                            version=version,
+                            parent_id=parent_id,
+                            validation_status=OrgUnit.VALIDATION_VALID,
+                            geom=MultiPolygon(shape),
+                            simplified_geom=MultiPolygon(shape.simplify(0.01)),
+                        )
+                    )
+            parent_ids = [org_unit.id for org_unit in OrgUnit.objects.bulk_create(org_units, batch_size=BATCH_SIZE)]
+            created += len(org_units)
+
+        org_unit_type = OrgUnitType.objects.create(name="Facility", depth=len(LEVELS))
+        facilities_count = max(count - created, 0)
+        Through = Group.org_units.through
+        for batch_start in range(0, facilities_count, BATCH_SIZE):
+            facilities = OrgUnit.objects.bulk_create(
+                OrgUnit(
+                    name=f"Facility {i}",
+                    source_ref=f"facility-{i}",
+                    org_unit_type=org_unit_type,
+                    version=version,
+                    parent_id=parent_ids[i % len(parent_ids)],
+                    validation_status=OrgUnit.VALIDATION_VALID,
+                    location=Point(random.uniform(-20, 40), random.uniform(-30, 30), 0),
+                )
+                for i in range(batch_start, min(batch_start + BATCH_SIZE, facilities_count))
+            )
+            Through.objects.bulk_create(
+                Through(group_id=groups[i % 2].id, orgunit_id=facility.id) for i, facility in enumerate(facilities)
+            )
+        return version
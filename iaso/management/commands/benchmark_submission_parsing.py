@@ -0,0 +1,181 @@
+import random
+import tempfile
+import uuid
+from io import BytesIO, StringIO
+from time import perf_counter
+from typing import Callable, Iterable, Tuple
+from unittest import mock
+
+from bs4 import BeautifulSoup as Soup  # type: ignore
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.test import RequestFactory, override_settings
+
+from hat.sync.views import form_upload
+from iaso.models import Form, FormVersion, Instance
+from iaso.utils import extract_form_version_id, flat_parse_xml_soup
+
+VERSION = "2024010101"
+QUESTION_TYPES = ["integer", "decimal", "text", "select_one", "date"]
+NAMESPACES = (
+    'xmlns:h="http://www.w3.org/1999/xhtml" xmlns:jr="http://openrosa.org/javarosa" '
+    'xmlns:orx="http://openrosa.org/xforms" xmlns:odk="http://www.opendatakit.org/xforms"'
+)
+
+
+def legacy_xml_file_to_json(instance: Instance, file):
+    """The BeautifulSoup parsing replaced by `iaso.odk.flat_xml`, used as the baseline"""
+    soup = Soup(StringIO(file.read().decode("utf-8")), "xml")
+    form_version_id = extract_form_version_id(soup)
+    form_version = instance.form.form_versions.filter(version_id=form_version_id).first() if form_version_id else None
+    if not form_version:
+        return flat_parse_xml_soup(soup, [], None)["flat_json"]
+    allowed_paths = set(form_version.questions_by_path().keys())
+    allowed_paths.update(instance.ALWAYS_ALLOWED_PATHS_XML)
+    repeat_groups = [rg["name"] for rg in form_version.repeat_groups()]
+    return flat_parse_xml_soup(soup, repeat_groups, allowed_paths)["flat_json"]
+
+
+def build_descriptor(groups: int, questions: int) -> dict:
+    """A form descriptor shaped like the ones of pyxform: metadata, groups of questions, a repeat group and meta"""
+    children = [{"name": name, "type": name} for name in ("start", "end", "today", "deviceid")]
+    for group in range(groups):
+        children.append(
+            {
+                "name": f"group_{group}",
+                "type": "group",
+                "children": [
+                    {"name": f"q_{group}_{question}", "type": QUESTION_TYPES[question % len(QUESTION_TYPES)]}
+                    for question in range(questions)
+                ],
+            }
+        )
+    children.append(
+        {
+            "name": "household_members",
+            "type": "repeat",
+            "children": [
+                {"name": "member_name", "type": "text"},
+                {"name": "member_age", "type": "integer"},
+                {"name": "member_sex", "type": "select_one"},
+            ],
+        }
+    )
+    children.append({"name": "meta", "type": "group", "children": [{"name": "instanceID", "type": "calculate"}]})
+    return {"name": "data", "type": "survey", "id_string": "benchmark", "version": VERSION, "children": children}
+
+
+def answer(question_type: str) -> str:
+    if question_type == "integer":
+        return str(random.randint(0, 500))
+    if question_type == "decimal":
+        return f"{random.uniform(0, 100):.2f}"
+    if question_type == "select_one":
+        return random.choice(["yes", "no", "dont_know"])
+    if question_type == "date":
+        return f"2024-{random.randint(1, 12):02d}-{random.randint(1, 28):02d}"
+    # some unanswered questions, some text needing escaping
+    return random.choice(["", "Centre de santé", "R&amp;D &lt;note&gt;"])
+
+
+def build_submission(descriptor: dict, members: int) -> bytes:
+    parts = [f'<?xml version=\'1.0\' ?><data id="benchmark" version="{VERSION}" {NAMESPACES}>']
+    parts.append(f"<formhub><uuid>{uuid.uuid4().hex}</uuid></formhub>")
+    parts.append("<start>2024-01-01T10:00:00.000+01:00</start><end>2024-01-01T10:20:00.000+01:00</end>")
+    parts.append(f"<today>2024-01-01</today><deviceid>{random.randint(10**14, 10**15)}</deviceid>")
+    for group in descriptor["children"]:
+        if group["type"] != "group" or group["name"] == "meta":
+            continue
+        parts.append(f"<{group['name']}>")
+        for question in group["children"]:
+            value = answer(question["type"])
+            parts.append(f"<{question['name']}>{value}</{question['name']}>" if value else f"<{question['name']}/>")
+        parts.append(f"</{group['name']}>")
+    for member in range(random.randint(0, members)):
+        parts.append(
+            f"<household_members><member_name>Member {member}</member_name>"
+            f"<member_age>{random.randint(0, 90)}</member_age><member_sex>{random.choice('mf')}</member_sex>"
+            "</household_members>"
+        )
+    parts.append(f"<meta><instanceID>uuid:{uuid.uuid4()}</instanceID></meta></data>")
+    return "".join(parts).encode("utf-8")
+
+
+class Command(BaseCommand):
+    help = (
+        "Parse a corpus of synthetic submissions with the BeautifulSoup and the lxml parsers, and report the time of "
+        "the parsing alone, of `get_and_save_json_of_xml` and of the upload to hat.sync's form_upload view. "
+        "The data is created in a transaction which is rolled back at the end."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--count", type=int, default=500, help="Number of submissions")
+        parser.add_argument("--groups", type=int, default=20, help="Number of groups of the form")
+        parser.add_argument("--questions", type=int, default=15, help="Number of questions per group")
+        parser.add_argument("--members", type=int, default=20, help="Maximum number of repeat group entries")
+
+    def handle(self, *args, **options):
+        if not settings.DEBUG:
+            raise CommandError("Cannot run the benchmark in non-debug mode")
+
+        descriptor = build_descriptor(options["groups"], options["questions"])
+        corpus = [build_submission(descriptor, options["members"]) for _ in range(options["count"])]
+        size = sum(len(submission) for submission in corpus) / len(corpus) / 1024
+        self.stdout.write(f"{len(corpus)} submissions of {size:.1f} KB on average")
+
+        # The uploaded files are written in a temporary directory instead of the configured storage
+        with tempfile.TemporaryDirectory() as media_root, override_settings(
+            DEFAULT_FILE_STORAGE="django.core.files.storage.FileSystemStorage",
+            MEDIA_ROOT=media_root,
+            MEDIA_URL="/media/",
+        ), transaction.atomic():
+            form = Form.objects.create(name="Submission parsing benchmark")
+            FormVersion.objects.create(form=form, version_id=VERSION, form_descriptor=descriptor)
+
+            instance = Instance(form=form)
+            parsed = [instance.xml_file_to_json(BytesIO(submission)) for submission in corpus]
+            if parsed != [legacy_xml_file_to_json(instance, BytesIO(submission)) for submission in corpus]:
+                raise CommandError("The parsers gave different results")
+
+            self.compare("Parsing", lambda: [instance.xml_file_to_json(BytesIO(s)) for s in corpus])
+
+            instance_ids = [
+                Instance.objects.create(form=form, file=ContentFile(submission, name=f"{uuid.uuid4()}.xml")).id
+                for submission in corpus
+            ]
+            self.compare(
+                "get_and_save_json_of_xml",
+                lambda: [i.get_and_save_json_of_xml() for i in Instance.objects.filter(id__in=instance_ids)],
+            )
+
+            # As the mobile application, the instances are created before their file is uploaded
+            file_names = [f"{uuid.uuid4()}.xml" for _ in corpus]
+            Instance.objects.bulk_create(Instance(form=form, file_name=file_name) for file_name in file_names)
+            self.compare("form_upload", lambda: self.upload(zip(file_names, corpus)))
+            transaction.set_rollback(True)
+
+    def compare(self, name: str, run: Callable[[], object]):
+        with mock.patch.object(Instance, "xml_file_to_json", legacy_xml_file_to_json):
+            legacy = self.measure(run)
+        current = self.measure(run)
+        self.stdout.write(
+            f"{name}: {legacy:.2f}s with BeautifulSoup, {current:.2f}s with lxml ({legacy / current:.1f}x)"
+        )
+
+    def measure(self, run: Callable[[], object]) -> float:
+        # Each run is rolled back, so the next one starts from the same data
+        with transaction.atomic():
+            start = perf_counter()
+            run()
+            duration = perf_counter() - start
+            transaction.set_rollback(True)
+        return duration
+
+    def upload(self, submissions: Iterable[Tuple[str, bytes]]):
+        factory = RequestFactory()
+        for file_name, submission in submissions:
+            file = SimpleUploadedFile(file_name, submission, content_type="text/xml")
+            form_upload(factory.post("/sync/form_upload/", {"xml_submission_file": file}))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from iaso.models import CompletenessRollup
+
+
+class Command(BaseCommand):
+    help = """Recompute the number of submissions per org unit, form and period used by the completeness stats
+
+    The counts are updated when the submissions are saved, run this periodically (e.g. nightly) to catch the changes
+    made in bulk, and once after enabling COMPLETENESS_STATS_USE_ROLLUP."""
+
+    def handle(self, *args, **kwargs):
+        CompletenessRollup.objects.refresh()
+        self.stdout.write(f"{CompletenessRollup.objects.count()} rows in the completeness stats rollup")
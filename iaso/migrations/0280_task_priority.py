@@ -0,0 +1,21 @@
+# Generated by Django 4.2.11 on 2026-10-18 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("iaso", "0279_merge_20240417_1319"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="task",
+            name="priority",
+            field=models.SmallIntegerField(choices=[(0, "Low"), (5, "Normal"), (10, "High")], default=5),
+        ),
+        migrations.AddIndex(
+            model_name="task",
+            index=models.Index(fields=["status", "priority", "created_at"], name="iaso_task_queue_idx"),
+        ),
+    ]
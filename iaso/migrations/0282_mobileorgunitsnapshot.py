@@ -0,0 +1,30 @@
+# Generated by Django 4.2.11 on 2026-10-18 11:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("iaso", "0281_task_heartbeat_at_attempts_checkpoint"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MobileOrgUnitSnapshot",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("key", models.TextField()),
+                ("fingerprint", models.TextField()),
+                ("etag", models.CharField(max_length=40)),
+                ("content", models.BinaryField()),
+                ("content_crc", models.BigIntegerField()),
+                ("content_length", models.BigIntegerField()),
+                ("created_at", models.DateTimeField(auto_now=True)),
+                ("project", models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to="iaso.project")),
+            ],
+            options={
+                "unique_together": {("project", "key")},
+            },
+        ),
+    ]
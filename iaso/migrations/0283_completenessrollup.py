@@ -0,0 +1,27 @@
+# Generated by Django 4.2.11 on 2026-10-18 13:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("iaso", "0282_mobileorgunitsnapshot"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="CompletenessRollup",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("period", models.TextField(blank=True, default="")),
+                ("instances_count", models.IntegerField(default=0)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                ("form", models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to="iaso.form")),
+                ("org_unit", models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to="iaso.orgunit")),
+            ],
+            options={
+                "unique_together": {("org_unit", "form", "period")},
+            },
+        ),
+    ]
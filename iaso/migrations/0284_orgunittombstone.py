@@ -0,0 +1,26 @@
+# Generated by Django 4.2.11 on 2026-10-18 20:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("iaso", "0283_completenessrollup"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="OrgUnitTombstone",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("org_unit_id", models.IntegerField()),
+                ("version_id", models.IntegerField(blank=True, null=True)),
+                ("deleted_at", models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                "indexes": [
+                    models.Index(fields=["version_id", "deleted_at"], name="orgunit_tombstone_version_idx"),
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 4.2.11 on 2026-10-18 21:30
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """Write the OrgUnitTombstone of the deleted org units with a statement level trigger, one INSERT per DELETE
+    statement whatever the number of deleted org units."""
+
+    dependencies = [
+        ("iaso", "0284_orgunittombstone"),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql="""
+CREATE OR REPLACE FUNCTION iaso_orgunit_write_tombstones() RETURNS trigger AS
+$F$
+BEGIN
+    INSERT INTO iaso_orgunittombstone (org_unit_id, version_id, deleted_at)
+    SELECT deleted_org_units.id, deleted_org_units.version_id, NOW() FROM deleted_org_units;
+    RETURN NULL;
+END;
+$F$ LANGUAGE plpgsql;""",
+            reverse_sql="""DROP FUNCTION iaso_orgunit_write_tombstones;""",
+        ),
+        migrations.RunSQL(
+            sql="""
+            CREATE TRIGGER iaso_orgunit_tombstones
+            AFTER DELETE
+            ON iaso_orgunit
+            REFERENCING OLD TABLE AS deleted_org_units
+            FOR EACH STATEMENT
+            EXECUTE PROCEDURE iaso_orgunit_write_tombstones();""",
+            reverse_sql="""
+            DROP TRIGGER iaso_orgunit_tombstones ON iaso_orgunit;""",
+        ),
+    ]
@@ -14,3 +14,6 @@ from .reports import Report, ReportVersion
 from .deduplication import EntityDuplicateAnalyzis, EntityDuplicate
 from .microplanning import Planning, Team
 from .payments import Payment, PotentialPayment, PaymentLot
+from .org_unit_snapshot import MobileOrgUnitSnapshot
+from .org_unit_tombstone import OrgUnitTombstone
+from .completeness_rollup import CompletenessRollup
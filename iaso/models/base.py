@@ -5,12 +5,10 @@ import re
 import typing
 from copy import copy
 from functools import reduce
-from io import StringIO
 from logging import getLogger
 from urllib.request import urlopen
 
 import django_cte
-from bs4 import BeautifulSoup as Soup  # type: ignore
 from django import forms as dj_forms
 from django.contrib import auth
 from django.contrib.auth import models as authModels
@@ -34,7 +32,7 @@ from hat.audit.models import INSTANCE_API, log_modification
 from hat.menupermissions.constants import MODULES
 from iaso.models.data_source import DataSource, SourceVersion
 from iaso.models.org_unit import OrgUnit, OrgUnitReferenceInstance
-from iaso.utils import extract_form_version_id, flat_parse_xml_soup
+from iaso.odk.flat_xml import NO_PLAN, SubmissionPlan, flat_parse_xml, get_submission_plan
 
 from .. import periods
 from ..utils.jsonlogic import jsonlogic_to_q
@@ -82,6 +80,17 @@ STATUS_TYPE_CHOICES = (
 )
 ALIVE_STATUSES = [QUEUED, RUNNING]
 
+# Task priorities, higher runs first. See `FairShareScheduler` in beanstalk_worker/services.py
+LOW_PRIORITY = 0
+NORMAL_PRIORITY = 5
+HIGH_PRIORITY = 10
+
+TASK_PRIORITY_CHOICES = (
+    (LOW_PRIORITY, _("Low")),
+    (NORMAL_PRIORITY, _("Normal")),
+    (HIGH_PRIORITY, _("High")),
+)
+
 
 class KilledException(Exception):
     pass
@@ -258,9 +267,18 @@ class Task(models.Model):
     progress_message = models.TextField(null=True, blank=True)
     should_be_killed = models.BooleanField(default=False)
     external = models.BooleanField(default=False)
+    priority = models.SmallIntegerField(choices=TASK_PRIORITY_CHOICES, default=NORMAL_PRIORITY)
+    # Lease of the worker running the task, renewed periodically by the worker (see `Heartbeat`) and on each progress
+    # report: if it isn't renewed for settings.TASK_LEASE_SECONDS the worker is considered dead, see
+    # `reap_expired_tasks` in beanstalk_worker/services.py
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.IntegerField(default=0)
+    # Free form state saved by the task so that it can resume after a crash, see `save_checkpoint`
+    checkpoint = models.JSONField(null=True, blank=True)
 
     class Meta:
         ordering = ["-created_at"]
+        indexes = [models.Index(fields=["status", "priority", "created_at"], name="iaso_task_queue_idx")]
 
     def __str__(self):
         return "%s - %s - %s -%s" % (
@@ -315,8 +333,19 @@ class Task(models.Model):
             self.progress_message = progress_message
         if end_value:
             self.end_value = end_value
+        self.heartbeat_at = timezone.now()
         self.save()
 
+    def save_checkpoint(self, checkpoint):
+        """Record how far the task went, to be able to resume from there if the worker crashes and the task is requeued.
+
+        Like the progress, it is saved on the worker connection so it is committed even when called from a transaction.
+        The task should only checkpoint work that has been committed.
+        """
+        self.checkpoint = checkpoint
+        self.heartbeat_at = timezone.now()
+        self.save(update_fields=["checkpoint", "heartbeat_at"])
+
     def report_success_with_result(self, message=None, result_data=None):
         logger.info(f"Task {self} reported success with message {message}")
         self.progress_message = message
@@ -937,6 +966,16 @@ class Instance(models.Model):
     def __str__(self):
         return "%s %s" % (self.form, self.name)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # What the instance counts for in the completeness rollup when loaded, see iaso/models/completeness_rollup.py.
+        # Read from __dict__ so a deferred field is not loaded.
+        loaded = instance.__dict__
+        if "org_unit_id" in loaded and "form_id" in loaded and "period" in loaded:
+            instance._completeness_key = (loaded["org_unit_id"], loaded["form_id"], loaded["period"])
+        return instance
+
     @property
     def is_instance_of_reference_form(self) -> bool:
         if not self.org_unit or not self.org_unit.org_unit_type:
@@ -1007,32 +1046,25 @@ class Instance(models.Model):
             self.save()
 
     def xml_file_to_json(self, file: typing.IO) -> typing.Dict[str, typing.Any]:
-        copy_io_utf8 = StringIO(file.read().decode("utf-8"))
-        soup = Soup(copy_io_utf8, "xml", from_encoding="utf-8")
-
-        form_version_id = extract_form_version_id(soup)
-        if form_version_id:
+        def get_plan(form_version_id: typing.Optional[str]) -> SubmissionPlan:
+            if not form_version_id:
+                return NO_PLAN
             # TODO: investigate: can self.form be None here? What's the expected behavior?
-            form_versions = self.form.form_versions.filter(version_id=form_version_id)  # type: ignore
-            form_version = form_versions.first()
-            if form_version:
-                questions_by_path = form_version.questions_by_path()
-                allowed_paths = set(questions_by_path.keys())
-                allowed_paths.update(self.ALWAYS_ALLOWED_PATHS_XML)
-                flat_results = flat_parse_xml_soup(
-                    soup, [rg["name"] for rg in form_version.repeat_groups()], allowed_paths
-                )
-                if len(flat_results["skipped_paths"]) > 0:
-                    logger.warning(
-                        f"skipped {len(flat_results['skipped_paths'])} paths while parsing instance {self.id}",
-                        flat_results,
-                    )
-                return flat_results["flat_json"]
-            else:
+            form_version = self.form.form_versions.filter(version_id=form_version_id).first()  # type: ignore
+            if not form_version:
                 # warn old form, but keep it working ? or throw error
-                return flat_parse_xml_soup(soup, [], None)["flat_json"]
-        else:
-            return flat_parse_xml_soup(soup, [], None)["flat_json"]
+                return NO_PLAN
+            return get_submission_plan(form_version, self.ALWAYS_ALLOWED_PATHS_XML)
+
+        flat_results = flat_parse_xml(file.read(), get_plan)
+        if len(flat_results["skipped_paths"]) > 0:
+            logger.warning(
+                "skipped %d paths while parsing instance %s: %s",
+                len(flat_results["skipped_paths"]),
+                self.id,
+                flat_results["skipped_paths"],
+            )
+        return flat_results["flat_json"]
 
     def get_and_save_json_of_xml(self):
         """
@@ -0,0 +1,118 @@
+import typing
+
+from django.db import connection, models, transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from iaso.models.base import Instance
+from iaso.models.forms import Form
+from iaso.models.org_unit import OrgUnit
+
+"""
+Number of submissions per org unit, form and period, read by the completeness stats API instead of counting the
+instances on each request (see `get_annotated_queryset` in iaso/api/completeness_stats.py).
+
+Rows are kept up to date when an instance is saved or deleted through the ORM. Queryset updates and raw SQL bypass
+the signals, so the whole table is also recomputed by the `refresh_completeness_rollup` task / management command,
+scheduled daily in cron.yaml.
+
+Only the instances counted by the completeness stats are taken into account: not deleted and with a file. The period
+of instances without period is stored as an empty string, so it can be part of the unique constraint.
+"""
+
+# Instances counted in the completeness stats, keep in sync with OU_COUNT_QUERY in iaso/api/completeness_stats.py
+COUNTED_INSTANCES = """
+    "iaso_instance"."file" IS NOT NULL AND NOT "iaso_instance"."file" = '' AND NOT "iaso_instance"."deleted"
+    AND "iaso_instance"."org_unit_id" IS NOT NULL AND "iaso_instance"."form_id" IS NOT NULL
+"""
+
+UPSERT_QUERY = f"""
+    INSERT INTO "iaso_completenessrollup" ("org_unit_id", "form_id", "period", "instances_count", "updated_at")
+    SELECT "iaso_instance"."org_unit_id", "iaso_instance"."form_id", COALESCE("iaso_instance"."period", ''), COUNT(*),
+        NOW()
+    FROM "iaso_instance"
+    WHERE {COUNTED_INSTANCES} {{where}}
+    GROUP BY 1, 2, 3
+    ON CONFLICT ("org_unit_id", "form_id", "period") DO UPDATE
+    SET "instances_count" = EXCLUDED."instances_count", "updated_at" = EXCLUDED."updated_at"
+    WHERE "iaso_completenessrollup"."instances_count" != EXCLUDED."instances_count"
+"""
+
+DELETE_STALE_QUERY = f"""
+    DELETE FROM "iaso_completenessrollup" AS rollup
+    WHERE NOT EXISTS (
+        SELECT 1 FROM "iaso_instance"
+        WHERE {COUNTED_INSTANCES}
+        AND "iaso_instance"."org_unit_id" = rollup."org_unit_id"
+        AND "iaso_instance"."form_id" = rollup."form_id"
+        AND COALESCE("iaso_instance"."period", '') = rollup."period"
+    ) {{where}}
+"""
+
+Key = typing.Tuple[typing.Optional[int], typing.Optional[int], typing.Optional[str]]
+
+
+class CompletenessRollupQuerySet(models.QuerySet):
+    def refresh(self, keys: typing.Optional[typing.Iterable[Key]] = None):
+        """Recompute the counts, for the given (org_unit_id, form_id, period) keys or for the whole table"""
+        instance_filter, rollup_filter, params = "", "", []
+        if keys is not None:
+            keys = {(org_unit_id, form_id, period or "") for org_unit_id, form_id, period in keys}
+            keys = [key for key in keys if key[0] is not None and key[1] is not None]
+            if not keys:
+                return
+            values = ", ".join(["(%s, %s, %s)"] * len(keys))
+            instance_filter = f"""AND ("iaso_instance"."org_unit_id", "iaso_instance"."form_id",
+                COALESCE("iaso_instance"."period", '')) IN ({values})"""
+            rollup_filter = f"""AND (rollup."org_unit_id", rollup."form_id", rollup."period") IN ({values})"""
+            params = [value for key in keys for value in key]
+
+        with connection.cursor() as cursor:
+            cursor.execute(UPSERT_QUERY.format(where=instance_filter), params)
+            cursor.execute(DELETE_STALE_QUERY.format(where=rollup_filter), params)
+
+
+class CompletenessRollup(models.Model):
+    org_unit = models.ForeignKey(OrgUnit, on_delete=models.CASCADE)
+    form = models.ForeignKey(Form, on_delete=models.CASCADE)
+    period = models.TextField(blank=True, default="")
+    instances_count = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = CompletenessRollupQuerySet.as_manager()
+
+    class Meta:
+        unique_together = [["org_unit", "form", "period"]]
+
+    def __str__(self):
+        return f"{self.org_unit_id} - {self.form_id} - {self.period}: {self.instances_count}"
+
+
+# The fields of an instance changing what it counts for
+COMPLETENESS_FIELDS = {"org_unit", "org_unit_id", "form", "form_id", "period", "file", "deleted"}
+
+
+@receiver(pre_save, sender=Instance)
+def load_completeness_key(sender, instance, update_fields=None, **kwargs):
+    # The instance may be moved to another org unit, form or period: the count of the previous one changes too. The
+    # previous key is remembered by Instance.from_db, it is only read here when these fields were deferred.
+    if instance.pk is None or getattr(instance, "_completeness_key", None) is not None:
+        return
+    if update_fields is None or COMPLETENESS_FIELDS.intersection(update_fields):
+        instance._completeness_key = (
+            Instance.objects.filter(pk=instance.pk).values_list("org_unit_id", "form_id", "period").first()
+        )
+
+
+@receiver(post_save, sender=Instance)
+@receiver(post_delete, sender=Instance)
+def refresh_completeness_rollup(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and not COMPLETENESS_FIELDS.intersection(update_fields):
+        return
+    key = (instance.org_unit_id, instance.form_id, instance.period)
+    keys = [key]
+    previous_key = getattr(instance, "_completeness_key", None)
+    if previous_key and previous_key != key:
+        keys.append(previous_key)
+    instance._completeness_key = key
+    transaction.on_commit(lambda: CompletenessRollup.objects.refresh(keys))
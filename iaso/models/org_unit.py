@@ -11,7 +11,7 @@ from django.contrib.gis.db.models.fields import MultiPolygonField, PointField
 from django.contrib.postgres.fields import ArrayField
 from django.contrib.postgres.indexes import GinIndex, GistIndex
 from django.core.exceptions import ValidationError
-from django.db import models, transaction
+from django.db import connection, models, transaction
 from django.db.models import Q, QuerySet
 from django.db.models.expressions import RawSQL
 from django.utils import timezone
@@ -70,6 +70,11 @@ def get_or_create_org_unit_type(name: str, depth: int, account: "Account", prefe
         return OrgUnitType.objects.filter(**out_defining_fields, projects=preferred_project).first()  # type: ignore
 
 
+MOVE_DESCENDANTS_QUERY = """
+    UPDATE iaso_orgunit SET path = %s::ltree || subpath(path, nlevel(%s::ltree)) WHERE path <@ %s::ltree
+"""
+
+
 class OrgUnitTypeQuerySet(models.QuerySet):
     def countries(self):
         return self.filter(category="COUNTRY")
@@ -252,6 +257,72 @@ class OrgUnitManager(models.Manager):
         q = reduce(operator.or_, queries)
         return q
 
+    def bulk_update_paths(self, org_units: typing.List["OrgUnit"], batch_size: int = 2000) -> None:
+        """Compute top-down the paths of org units created or moved in bulk and save them, then rewrite the paths of
+        the descendants in the database of the moved org units.
+
+        The org units are saved, with their new parent, but their path is still the one in the database (None for the
+        created ones). The path of an org unit which is not in org_units is its path in the database, below its closest
+        ancestor from org_units. As in `OrgUnit.calculate_paths`, org units whose parent has no path are skipped."""
+        ids = {id(org_unit) for org_unit in org_units}
+        by_pk = {str(org_unit.pk): org_unit for org_unit in org_units if org_unit.path is not None}
+        paths: typing.Dict[int, typing.Optional[typing.List[str]]] = {}
+        visiting = set()
+
+        def get_path(org_unit: "OrgUnit") -> typing.Optional[typing.List[str]]:
+            # walk up to the first ancestor whose path is known, then compute the paths down the chain
+            chain: typing.List["OrgUnit"] = []
+            node: typing.Optional["OrgUnit"] = org_unit
+            while node is not None and id(node) in ids and id(node) not in paths:
+                if id(node) in visiting:
+                    raise ValueError(f"Bad parents, {node} is its own ancestor")
+                visiting.add(id(node))
+                chain.append(node)
+                node = node.parent
+            if node is None:
+                path: typing.Optional[typing.List[str]] = []
+            elif id(node) in paths:
+                path = paths[id(node)]
+            else:
+                path = get_database_path(node)
+            for node in reversed(chain):
+                path = [*path, str(node.pk)] if path is not None else None
+                paths[id(node)] = path
+                visiting.discard(id(node))
+            return paths[id(org_unit)]
+
+        def get_database_path(org_unit: "OrgUnit") -> typing.Optional[typing.List[str]]:
+            if org_unit.path is None:
+                return None
+            old_path = list(org_unit.path)
+            for i in range(len(old_path) - 1, -1, -1):
+                ancestor = by_pk.get(old_path[i])
+                if ancestor is not None:
+                    path = get_path(ancestor)
+                    return [*path, *old_path[i + 1 :]] if path is not None else None
+            return old_path
+
+        changed: typing.List["OrgUnit"] = []
+        moved: typing.List[typing.Tuple[typing.List[str], typing.List[str]]] = []
+        for org_unit in org_units:
+            new_path = get_path(org_unit)
+            old_path = list(org_unit.path) if org_unit.path is not None else None
+            if new_path is None or new_path == old_path:
+                continue
+            org_unit.path = new_path
+            changed.append(org_unit)
+            if old_path is not None:
+                moved.append((old_path, new_path))
+        self.bulk_update(changed, ["path"], batch_size=batch_size)
+
+        # The deepest first, so each org unit is moved below its closest ancestor from org_units, the paths written
+        # above are not below any of the old paths.
+        moved.sort(key=lambda move: len(move[0]), reverse=True)
+        with connection.cursor() as cursor:
+            for old_path, new_path in moved:
+                old, new = ".".join(old_path), ".".join(new_path)
+                cursor.execute(MOVE_DESCENDANTS_QUERY, [new, old, old])
+
 
 class OrgUnit(TreeModel):
     VALIDATION_NEW = "NEW"
@@ -0,0 +1,164 @@
+import hashlib
+import struct
+import typing
+import zlib
+from datetime import timedelta
+
+from django.db import connection, models, transaction
+from django.db.models import Q
+from django.db.models.signals import m2m_changed
+from django.dispatch import receiver
+from django.utils import timezone
+
+from iaso.models.base import Group
+from iaso.models.org_unit import OrgUnit
+from iaso.models.project import Project
+
+"""
+Persistent snapshots of the pages served by the mobile org unit API (`MobileOrgUnitViewSet.list`).
+
+Serializing a whole pyramid (with its geometries) is expensive and thousands of devices request the same payload
+every morning, so each page is rendered once, stored compressed, and served as is until the org units change.
+
+A snapshot stores a *fingerprint* of the org units it was built from (count and last `updated_at` of the org units and
+their types), so any `OrgUnit.save()`, deletion or bulk update setting `updated_at` makes it stale. The group
+memberships are serialized too: the receiver below bumps the `updated_at` of the org units whose groups change, so
+they are also sent to the devices doing a delta sync, and drops the snapshots of the impacted projects (see
+`invalidate_for_versions`). The code changing the memberships in bulk must do the same.
+
+The content is stored as a raw deflate stream flushed at a byte boundary and without the closing brace of the JSON
+object. This allows to append per-request data (the user's roots) and wrap it into a valid gzip member without
+recompressing the whole pyramid.
+"""
+
+GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"  # deflate, no mtime, unknown OS
+STREAM_CHUNK_SIZE = 256 * 1024
+# Snapshots not rebuilt for this long are dropped when another snapshot of their project is stored
+SNAPSHOT_MAX_AGE = timedelta(days=30)
+
+
+class MobileOrgUnitSnapshotQuerySet(models.QuerySet):
+    def invalidate_for_versions(self, version_ids: typing.Iterable[typing.Optional[int]]):
+        """Drop, once the current transaction is committed, the snapshots of the projects serving these versions"""
+        version_ids = {version_id for version_id in version_ids if version_id is not None}
+        if not version_ids:
+            return
+        transaction.on_commit(
+            lambda: self.filter(project__account__default_version_id__in=version_ids).delete(), using=self.db
+        )
+
+
+class MobileOrgUnitSnapshot(models.Model):
+    project = models.ForeignKey(Project, on_delete=models.CASCADE)
+    # Identifies the variant of the payload: roots of the user if the download is limited to them, geometries, page
+    key = models.TextField()
+    fingerprint = models.TextField()
+    etag = models.CharField(max_length=40)
+    content = models.BinaryField()
+    content_crc = models.BigIntegerField()
+    content_length = models.BigIntegerField()
+    created_at = models.DateTimeField(auto_now=True)
+
+    objects = MobileOrgUnitSnapshotQuerySet.as_manager()
+
+    class Meta:
+        unique_together = [["project", "key"]]
+
+    def __str__(self):
+        return f"{self.project} - {self.key}"
+
+    @classmethod
+    def lock(cls, project: Project, key: str) -> None:
+        """Lock the snapshot of project and key until the end of the transaction
+
+        The requests finding it missing or stale take this lock and check it again before rebuilding it, so a single
+        one renders the pyramid while the others wait for it, instead of all rendering it at the same time and racing
+        to store it under the same unique key."""
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_xact_lock(%s, hashtext(%s))", [project.id, key])
+
+    @classmethod
+    def store(
+        cls, project: Project, key: str, fingerprint: str, chunks: typing.Iterable[bytes], audience: str = ""
+    ) -> "MobileOrgUnitSnapshot":
+        """Save as the snapshot for project and key a JSON object given as chunks, without its closing brace
+
+        The chunks are compressed as they come, so the uncompressed payload is never held in memory.
+
+        The other snapshots of the project are pruned: the ones of the same audience (keys starting with `audience`)
+        built from other org units, which are stale, and the ones not rebuilt for SNAPSHOT_MAX_AGE, whose roots or
+        page size are probably no longer requested."""
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        sha1 = hashlib.sha1()
+        crc = 0
+        length = 0
+        compressed = []
+        for chunk in chunks:
+            sha1.update(chunk)
+            crc = zlib.crc32(chunk, crc)
+            length += len(chunk)
+            compressed.append(compressor.compress(chunk))
+        compressed.append(compressor.flush(zlib.Z_FULL_FLUSH))
+        stale = Q(created_at__lt=timezone.now() - SNAPSHOT_MAX_AGE)
+        if audience:
+            stale |= Q(key__startswith=audience) & ~Q(fingerprint=fingerprint)
+        cls.objects.filter(stale, project=project).exclude(key=key).delete()
+        snapshot, _created = cls.objects.update_or_create(
+            project=project,
+            key=key,
+            defaults={
+                "fingerprint": fingerprint,
+                "etag": sha1.hexdigest(),
+                "content": b"".join(compressed),
+                "content_crc": crc,
+                "content_length": length,
+            },
+        )
+        return snapshot
+
+    def get_etag(self, suffix: bytes = b"}") -> str:
+        return f'"{self.etag}-{zlib.crc32(suffix):08x}"'
+
+    def stream(self, suffix: bytes = b"}", chunk_size: int = STREAM_CHUNK_SIZE) -> typing.Iterator[bytes]:
+        """The stored JSON object, closed by `suffix`, decompressed by chunks of at most `chunk_size` bytes"""
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        data = bytes(self.content)
+        while True:
+            chunk = decompressor.decompress(data, chunk_size)
+            data = decompressor.unconsumed_tail
+            if chunk:
+                yield chunk
+            if not data and len(chunk) < chunk_size:
+                break
+        yield suffix
+
+    def render(self, suffix: bytes = b"}", gzipped: bool = False) -> bytes:
+        """The stored JSON object, closed by `suffix`, as a gzip member if `gzipped`"""
+        content = bytes(self.content)
+        if not gzipped:
+            return b"".join(self.stream(suffix))
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        tail = compressor.compress(suffix) + compressor.flush()
+        crc = zlib.crc32(suffix, self.content_crc) & 0xFFFFFFFF
+        size = (self.content_length + len(suffix)) & 0xFFFFFFFF
+        return GZIP_HEADER + content + tail + struct.pack("<II", crc, size)
+
+
+@receiver(m2m_changed, sender=Group.org_units.through)
+def invalidate_snapshots_on_group_change(sender, instance, action, reverse, pk_set, **kwargs):
+    """Bump the `updated_at` of the org units whose groups changed, and drop the snapshots serving them"""
+    if reverse:  # org_unit.groups.add(...)
+        if action not in ("post_add", "post_remove", "post_clear"):
+            return
+        org_unit_ids = [instance.id]
+        version_ids = [instance.version_id]
+    elif action in ("post_add", "post_remove"):  # group.org_units.add(...)
+        org_unit_ids = pk_set
+        version_ids = [instance.source_version_id]
+    elif action == "pre_clear":  # the cleared org units are only known before the clear
+        org_unit_ids = sender.objects.filter(group_id=instance.id).values("orgunit_id")
+        version_ids = [instance.source_version_id]
+    else:
+        return
+    OrgUnit.objects.filter(id__in=org_unit_ids).update(updated_at=timezone.now())
+    MobileOrgUnitSnapshot.objects.invalidate_for_versions(version_ids)
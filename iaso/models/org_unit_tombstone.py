@@ -0,0 +1,37 @@
+from datetime import timedelta
+
+from django.db import models
+from django.utils import timezone
+
+"""
+Ids of the org units deleted from the database, so the devices syncing their pyramid with `last_sync` (see
+`MobileOrgUnitViewSet.list_changes`) remove them. The tombstones are kept for TOMBSTONE_RETENTION, a device which didn't
+sync for longer must download the whole pyramid again.
+
+The tombstones are written by a statement level trigger on iaso_orgunit (see the migration 0285), so the deletions of
+many org units (querysets, cascades, raw SQL) stay set based. The old ones are deleted by the
+`prune_org_unit_tombstones` task, scheduled daily in cron.yaml.
+"""
+
+TOMBSTONE_RETENTION = timedelta(days=90)
+
+
+class OrgUnitTombstoneQuerySet(models.QuerySet):
+    def prune(self):
+        """Delete the tombstones older than TOMBSTONE_RETENTION"""
+        return self.filter(deleted_at__lt=timezone.now() - TOMBSTONE_RETENTION).delete()
+
+
+class OrgUnitTombstone(models.Model):
+    org_unit_id = models.IntegerField()
+    # not a foreign key: the version may be deleted with its org units
+    version_id = models.IntegerField(null=True, blank=True)
+    deleted_at = models.DateTimeField(auto_now_add=True)
+
+    objects = OrgUnitTombstoneQuerySet.as_manager()
+
+    class Meta:
+        indexes = [models.Index(fields=["version_id", "deleted_at"], name="orgunit_tombstone_version_idx")]
+
+    def __str__(self):
+        return f"{self.org_unit_id} - {self.deleted_at}"
@@ -0,0 +1,148 @@
+"""
+Streaming flattener of the xml submissions, producing the same `flat_json` as `iaso.utils.flat_parse_xml_soup`.
+
+The submission is read with lxml `iterparse`: the leaves are stored when their end tag is read and each element is
+freed once handled, so no tree of the whole submission is built. The paths and repeat groups used to flatten the
+submissions of a form version are computed from its descriptor once, and cached per form version (id and last update)
+and always allowed paths by `get_submission_plan`.
+"""
+
+from io import BytesIO
+from typing import Any, Callable, Dict, FrozenSet, Iterable, List, NamedTuple, Optional
+
+from lxml import etree  # type: ignore
+
+from iaso.utils.lru_cache import LRUCache
+
+PLAN_CACHE_SIZE = 256
+
+
+class SubmissionPlan(NamedTuple):
+    repeat_groups: FrozenSet[str]
+    # None to keep all the paths
+    allowed_paths: Optional[FrozenSet[str]]
+
+
+NO_PLAN = SubmissionPlan(frozenset(), None)
+
+
+class Frame:
+    """An open element, with the same state as a `get_flat_children_tree` call on it"""
+
+    __slots__ = ("name", "path", "call_path", "target", "allowed_paths", "is_repeat", "has_children")
+
+    def __init__(self, name, path, call_path, target, allowed_paths, is_repeat=False):
+        self.name = name
+        self.path = path
+        # path of the parent, used to build the path of the children
+        self.call_path = call_path
+        # dict receiving the leaves
+        self.target = target
+        self.allowed_paths = allowed_paths
+        self.is_repeat = is_repeat
+        self.has_children = False
+
+
+def leaf_text(element) -> str:
+    # The children of a leaf are comments or processing instructions, skipped as in BeautifulSoup's `text`
+    return (element.text or "") + "".join(child.tail or "" for child in element)
+
+
+def parse(data: bytes, get_plan: Callable[[Optional[str]], SubmissionPlan], use_version: bool) -> Dict[str, Any]:
+    flat_json: Dict[str, Any] = {}
+    skipped_paths: List[str] = []
+    version = None
+    # comments and processing instructions outside of the root element
+    top_level_nodes = 0
+    document = Frame("[document]", "", "", flat_json, None)
+    stack: List[Frame] = []
+
+    # The submissions are decoded as utf-8, whatever their declared encoding
+    events = etree.iterparse(
+        BytesIO(data),
+        events=("start", "end", "comment", "pi"),
+        encoding="utf-8",
+        recover=True,
+        resolve_entities=False,
+    )
+    try:
+        for event, element in events:
+            if event == "start":
+                name = etree.QName(element).localname
+                if stack:
+                    parent = stack[-1]
+                else:
+                    if use_version and not top_level_nodes:
+                        version = element.get("version")
+                    plan = get_plan(version)
+                    document.allowed_paths = plan.allowed_paths
+                    parent = document
+                parent.has_children = True
+
+                if parent is document:
+                    path = ""
+                elif parent.name == "data":
+                    path = name
+                else:
+                    path = parent.call_path + "/" + name
+
+                if name in plan.repeat_groups:
+                    child_dict: Dict[str, Any] = {}
+                    parent.target.setdefault(name, []).append(child_dict)
+                    stack.append(Frame(name, path, parent.call_path, child_dict, None, is_repeat=True))
+                else:
+                    stack.append(Frame(name, path, path, parent.target, parent.allowed_paths))
+
+            elif event == "end":
+                frame = stack.pop()
+                if not frame.is_repeat and not frame.has_children:
+                    if not frame.allowed_paths or frame.path in frame.allowed_paths:
+                        frame.target[frame.name] = leaf_text(element)
+                    else:
+                        skipped_paths.append(frame.path)
+                # Free the handled elements
+                element.clear(keep_tail=True)
+                parent_element = element.getparent()
+                if parent_element is not None:
+                    while element.getprevious() is not None:
+                        del parent_element[0]
+
+            elif not stack:
+                top_level_nodes += 1
+    except etree.XMLSyntaxError:
+        # As BeautifulSoup, an empty submission gives an empty result
+        if events.root is not None:
+            raise
+
+    if version and (top_level_nodes or events.root.getroottree().docinfo.doctype):
+        # The version is only read from a document without other top level node, which is not known before the end
+        return parse(data, get_plan, use_version=False)
+    if version:
+        flat_json["_version"] = version
+    return {"flat_json": flat_json, "skipped_paths": skipped_paths}
+
+
+def flat_parse_xml(data: bytes, get_plan: Callable[[Optional[str]], SubmissionPlan]) -> Dict[str, Any]:
+    """
+    Parse an xml submission and return a flattened JSON-serializable representation of the data.
+
+    :param get_plan: called with the version of the submission (or None) to get the paths and repeat groups to use
+    :return: a dict with two keys: the flattened xml data in "flat_json", and a list of skipped paths in "skipped_paths"
+    """
+    return parse(data, get_plan, use_version=True)
+
+
+_plans: "LRUCache[SubmissionPlan]" = LRUCache(PLAN_CACHE_SIZE)
+
+
+def get_submission_plan(form_version, always_allowed_paths: Iterable[str]) -> SubmissionPlan:
+    """The repeat groups and allowed paths of the submissions of form_version, cached until it is updated"""
+    always_allowed_paths = frozenset(always_allowed_paths)
+    key = (form_version.id, form_version.updated_at, always_allowed_paths)
+    return _plans.get_or_compute(
+        key,
+        lambda: SubmissionPlan(
+            repeat_groups=frozenset(repeat_group["name"] for repeat_group in form_version.repeat_groups()),
+            allowed_paths=frozenset(form_version.questions_by_path()).union(always_allowed_paths),
+        ),
+    )
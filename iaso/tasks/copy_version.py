@@ -1,14 +1,101 @@
 import logging
 
+from django.db import connection, transaction
 from django.utils.translation import gettext as _
 
 from beanstalk_worker import task_decorator
-from iaso.models import OrgUnit, DataSource, SourceVersion, Group, GroupSet, ERRORED
+from iaso.models import OrgUnit, DataSource, SourceVersion, Group, GroupSet, ERRORED, LOW_PRIORITY
 
 logger = logging.getLogger(__name__)
 
+"""
+The copy is done set-based, with a few INSERT ... SELECT. For each copied table, a temporary table maps the id of each
+source row to the id of its copy, taken from the table sequence beforehand. The foreign keys and many to many links
+are then remapped with joins on these tables.
+
+The paths of the copied org units are computed from their new ids before the insert, with a recursive query walking
+the source pyramid from its roots.
+"""
+
+CREATE_IDS_TABLE = """
+    CREATE TEMPORARY TABLE {ids_table} ON COMMIT DROP AS
+    SELECT id AS old_id, nextval(pg_get_serial_sequence('{table}', 'id')) AS new_id
+    FROM {table} WHERE {where};
+    CREATE UNIQUE INDEX ON {ids_table} (old_id);
+    ANALYZE {ids_table};
+"""
+
+INSERT_COPIES = """
+    INSERT INTO {table} (id, {override_columns}, {columns})
+    SELECT ids.new_id, {override_values}, {source_columns}
+    FROM {table} source JOIN {ids_table} ids ON ids.old_id = source.id
+"""
+
+# Roots are the units without parent, or whose parent is not in the copied version
+COMPUTE_ORG_UNIT_PATHS = """
+    ALTER TABLE copy_version_orgunit_ids ADD COLUMN path ltree;
+    WITH RECURSIVE tree AS (
+        SELECT ids.old_id, text2ltree(ids.new_id::text) AS path
+        FROM copy_version_orgunit_ids ids JOIN iaso_orgunit ou ON ou.id = ids.old_id
+        WHERE ou.parent_id IS NULL OR ou.parent_id NOT IN (SELECT old_id FROM copy_version_orgunit_ids)
+        UNION ALL
+        SELECT ids.old_id, tree.path || ids.new_id::text
+        FROM tree
+        JOIN iaso_orgunit ou ON ou.parent_id = tree.old_id
+        JOIN copy_version_orgunit_ids ids ON ids.old_id = ou.id
+    )
+    UPDATE copy_version_orgunit_ids ids SET path = tree.path FROM tree WHERE ids.old_id = tree.old_id;
+"""
+
+NEW_PARENT_ID = """(
+    SELECT parent_ids.new_id FROM copy_version_orgunit_ids parent_ids WHERE parent_ids.old_id = source.parent_id
+)"""
+
+COPY_GROUP_SETS_GROUPS = """
+    INSERT INTO iaso_groupset_groups (groupset_id, group_id)
+    SELECT group_set_ids.new_id, group_ids.new_id
+    FROM iaso_groupset_groups link
+    JOIN copy_version_groupset_ids group_set_ids ON group_set_ids.old_id = link.groupset_id
+    JOIN copy_version_group_ids group_ids ON group_ids.old_id = link.group_id
+"""
+
+COPY_GROUPS_ORG_UNITS = """
+    INSERT INTO iaso_group_org_units (group_id, orgunit_id)
+    SELECT group_ids.new_id, org_unit_ids.new_id
+    FROM iaso_group_org_units link
+    JOIN copy_version_group_ids group_ids ON group_ids.old_id = link.group_id
+    JOIN copy_version_orgunit_ids org_unit_ids ON org_unit_ids.old_id = link.orgunit_id
+"""
+
+
+def create_ids_table(cursor, model, where, params):
+    """Reserve a new id for each row of the model table matching where, in the copy_version_<model>_ids table"""
+    table = model._meta.db_table
+    ids_table = f"copy_version_{model._meta.model_name}_ids"
+    cursor.execute(f"DROP TABLE IF EXISTS {ids_table}")
+    cursor.execute(CREATE_IDS_TABLE.format(ids_table=ids_table, table=table, where=where), params)
+    return ids_table
+
+
+def insert_copies(cursor, model, ids_table, overrides, params):
+    """Copy the rows listed in ids_table, with their new id and the overrides ({column: SQL expression})"""
+    quote = connection.ops.quote_name
+    columns = [field.column for field in model._meta.concrete_fields if field.column not in ("id", *overrides)]
+    cursor.execute(
+        INSERT_COPIES.format(
+            table=model._meta.db_table,
+            ids_table=ids_table,
+            override_columns=", ".join(quote(column) for column in overrides),
+            override_values=", ".join(overrides.values()),
+            columns=", ".join(quote(column) for column in columns),
+            source_columns=", ".join(f"source.{quote(column)}" for column in columns),
+        ),
+        params,
+    )
+    return cursor.rowcount
+
 
-@task_decorator(task_name="copy_version")
+@task_decorator(task_name="copy_version", priority=LOW_PRIORITY)
 def copy_version(
     source_source_id,
     source_version_number,
@@ -49,79 +136,43 @@ def copy_version(
         the_task.result = {"message": res_string}
         the_task.save()
         return
-    else:
+
+    with transaction.atomic(), connection.cursor() as cursor:
         OrgUnit.objects.filter(version=destination_version).delete()
         logger.debug(("%d org units records deleted" % destination_version_count).upper())
 
-    group_sets = GroupSet.objects.filter(source_version=source_version)
-    group_set_matching = {}
-    logger.debug("********* Copying groupsets")
-    for gs in group_sets:
-        old_id = gs.id
-        gs.id = None
-        gs.source_version = destination_version
-        gs.save()
-        group_set_matching[old_id] = gs.id
-    the_task.report_progress_and_stop_if_killed(progress_message=_("Copying groups"))
-
-    logger.debug("********* Copying groups")
-    groups = Group.objects.filter(source_version=source_version)
-    group_matching = {}
-    for g in groups:
-        old_id = g.id
-        original_group_sets = list(g.group_sets.all())
-        g.id = None
-        g.source_version = destination_version
-        g.save()
-
-        for gs in original_group_sets:
-            matching_gs = group_set_matching.get(gs.id)
-            g.group_sets.add(matching_gs)
-
-        group_matching[old_id] = g.id
-
-    source_units = OrgUnit.objects.filter(version=source_version)
-    source_units_count = source_units.count()
-    old_new_dict = {}
-    new_units = []
-    new_root_units = []
-    index = 0
-    logger.debug("group_matching", group_matching)
-    for unit in source_units:
-        original_groups = list(unit.groups.all())
-        old_id = unit.id
-        unit.id = None
-        unit.path = None
-        unit.version = destination_version
-        unit.save(skip_calculate_path=True)
-        new_units.append(unit)
-        old_new_dict[old_id] = unit.id
-        index = index + 1
-        for g in original_groups:
-            matching_group = group_matching[g.id]
-            unit.groups.add(matching_group)
-
-        if index % 100 == 0:
-            the_task.report_progress_and_stop_if_killed(
-                progress_value=index, end_value=source_units_count, progress_message=_("Copying org units")
-            )
-
-    index = 0
-    for unit in new_units:
-        if unit.parent_id is not None:
-            unit.parent_id = old_new_dict[unit.parent_id]
-            unit.save(skip_calculate_path=True)
-        else:
-            new_root_units.append(unit)
-
-        index = index + 1
-        if index % 100 == 0:
-            logger.debug("Parent fixed: %d" % index)
-            the_task.report_progress_and_stop_if_killed(progress_message=_("Fixing parents"))
-
-    for unit in new_root_units:
-        logger.debug(f"Setting path for the hierarchy starting with org unit {unit.name}")
-        unit.save(update_fields=["path"])
+        logger.debug("********* Copying groupsets")
+        version_overrides = {"source_version_id": "%s", "created_at": "NOW()", "updated_at": "NOW()"}
+        group_set_ids = create_ids_table(cursor, GroupSet, "source_version_id = %s", [source_version.id])
+        insert_copies(cursor, GroupSet, group_set_ids, version_overrides, [destination_version.id])
+        the_task.report_progress_and_stop_if_killed(progress_message=_("Copying groups"))
+
+        logger.debug("********* Copying groups")
+        # Only the groups without domain, as `Group.objects`
+        group_ids = create_ids_table(cursor, Group, "source_version_id = %s AND domain IS NULL", [source_version.id])
+        insert_copies(cursor, Group, group_ids, version_overrides, [destination_version.id])
+        cursor.execute(COPY_GROUP_SETS_GROUPS)
+        the_task.report_progress_and_stop_if_killed(progress_message=_("Copying org units"))
+
+        org_unit_ids = create_ids_table(cursor, OrgUnit, "version_id = %s", [source_version.id])
+        cursor.execute(COMPUTE_ORG_UNIT_PATHS)
+        copied_count = insert_copies(
+            cursor,
+            OrgUnit,
+            org_unit_ids,
+            {
+                "version_id": "%s",
+                "parent_id": NEW_PARENT_ID,
+                "path": "ids.path",
+                "created_at": "NOW()",
+                "updated_at": "NOW()",
+            },
+            [destination_version.id],
+        )
+        the_task.report_progress_and_stop_if_killed(
+            progress_value=copied_count, end_value=source_version_count, progress_message=_("Copying org units")
+        )
+        cursor.execute(COPY_GROUPS_ORG_UNITS)
 
     the_task.report_success(message="%d copied" % source_version_count)
 
@@ -0,0 +1,17 @@
+from beanstalk_worker import task_decorator
+from hat.audit import partitions
+from iaso.models import Task, LOW_PRIORITY
+
+# Same default as the `audit_partitions create` command
+MONTHS_IN_ADVANCE = 3
+
+
+@task_decorator(task_name="create_audit_partitions", priority=LOW_PRIORITY)
+def create_audit_partitions(task: Task):
+    """Background Task to create the partitions of the audit log for the coming months, see hat.audit.partitions"""
+    task.report_progress_and_stop_if_killed(progress_message="Creating the audit log partitions")
+    if not partitions.is_partitioned():
+        task.report_success(message=f"{partitions.TABLE} is not partitioned")
+        return
+    created = partitions.create_partitions(MONTHS_IN_ADVANCE)
+    task.report_success(message=f"Created {', '.join(created) or 'no partition'}")
@@ -1,4 +1,7 @@
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import hashlib
 import json
 import logging
 import time
@@ -6,6 +9,7 @@ from typing import Optional, Dict, Any, List
 
 from dhis2 import Api
 from django.contrib.gis.geos import Point, MultiPolygon, Polygon
+from django.db import transaction
 from django.utils.timezone import now
 
 from beanstalk_worker import task_decorator
@@ -16,6 +20,7 @@ from iaso.models import (
     SourceVersion,
     Group,
     GroupSet,
+    MobileOrgUnitSnapshot,
     Task,
 )
 
@@ -26,6 +31,25 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
+ORG_UNIT_FIELDS = (
+    "id,name,path,coordinates,geometry,parent,organisationUnitGroups[id,name],level,openingDate,closedDate"
+)
+PAGE_SIZE = 500
+# number of pages fetched at the same time from DHIS2
+FETCH_CONCURRENCY = 4
+BULK_BATCH_SIZE = 2000
+# fields of the existing org units overwritten by the import when update_existing is set
+IMPORTED_FIELDS = [
+    "name",
+    "org_unit_type",
+    "parent",
+    "opening_date",
+    "closed_date",
+    "location",
+    "geom",
+    "simplified_geom",
+]
+
 
 #  Define a few types around the Dhis2 API format to help dev
 
@@ -63,20 +87,22 @@ def get_api(options_or_url, login=None, password=None):
 
 
 def fetch_orgunits(api: Api) -> List[DhisOrgunit]:
-    orgunits: List[DhisOrgunit] = []
-
-    for page in api.get_paged(
-        "organisationUnits",
-        page_size=500,
-        params={
-            "fields": "id,name,path,coordinates,geometry,parent,organisationUnitGroups[id,name],level,openingDate,closedDate"
-        },
-    ):
-        orgunits.extend(page["organisationUnits"])
-        logger.info(
-            f'fetched {page["pager"]["page"]}/{page["pager"]["pageCount"]} '
-            f'({len(orgunits)}/{page["pager"]["total"]} records)'
-        )
+    """Fetch all the org units, the pages after the first one are fetched concurrently"""
+    params = {"fields": ORG_UNIT_FIELDS, "pageSize": PAGE_SIZE, "page": 1, "totalPages": True}
+    first_page = api.get("organisationUnits", params=params).json()
+    orgunits: List[DhisOrgunit] = list(first_page["organisationUnits"])
+    page_count = first_page["pager"]["pageCount"]
+    logger.info(f'fetched 1/{page_count} ({len(orgunits)}/{first_page["pager"]["total"]} records)')
+
+    def fetch_page(page_number):
+        return api.get("organisationUnits", params={**params, "page": page_number}).json()
+
+    with ThreadPoolExecutor(max_workers=FETCH_CONCURRENCY) as executor:
+        for page in executor.map(fetch_page, range(2, page_count + 1)):
+            orgunits.extend(page["organisationUnits"])
+            logger.info(
+                f'fetched {page["pager"]["page"]}/{page_count} ({len(orgunits)}/{page["pager"]["total"]} records)'
+            )
 
     # sorting orgunit according to their path ensure the parent are before the children
     orgunits_sorted = sorted(orgunits, key=lambda ou: ou["path"])
@@ -110,12 +136,12 @@ def orgunit_from_row(
     source,
     version,
     unit_dict,
-    group_dict,
     group_type_dict,
     validate,
     unknown_unit_type: OrgUnitType,  # fall back org unit type
     level_to_type: Dict[int, OrgUnitType],
 ) -> OrgUnit:
+    """Build the org unit of a row, it is not saved: see `save_org_units`"""
     org_unit = OrgUnit()
     org_unit.name = row["name"].strip()
     org_unit.sub_source = source.name
@@ -142,12 +168,6 @@ def orgunit_from_row(
     map_coordinates(row, org_unit)
     # if dhis2 version >= 2.32
     map_geometry(row, org_unit)
-    org_unit.save()
-
-    # org_unit should be saved before filling the groups
-    for dhis_group in row["organisationUnitGroups"]:
-        group = get_or_create_group(dhis_group, group_dict, version)
-        group.org_units.add(org_unit)
     return org_unit
 
 
@@ -276,7 +296,14 @@ def get_api_config(
 
 
 # TODO : remove force
-@task_decorator(task_name="dhis2_ou_importer")
+# Can be retried if the worker crashes: on restart it resumes in the version recorded in the checkpoint. The org units
+# and groups are saved in a single transaction, so they are either all imported again or, if the previous attempt
+# committed them, only the group sets are left to import.
+# There is no finer grained resume: an attempt which crashed before the commit fetches and stages the whole pyramid
+# from DHIS2 again. Committing level by level would leave org units without path or groups for the next attempt to
+# find, and the pyramid has to be fetched again anyway. The worker heartbeat keeps the lease of the task while the
+# transaction runs, so a slow import isn't requeued while it is still running.
+@task_decorator(task_name="dhis2_ou_importer", max_attempts=3)
 def dhis2_ou_importer(
     source_id: int,
     source_version_number: Optional[int],
@@ -289,6 +316,7 @@ def dhis2_ou_importer(
     update_mode: bool = False,
     task: Task = None,
     description="",
+    update_existing: bool = False,
 ) -> Task:
     the_task = task
     start = time.time()
@@ -300,7 +328,12 @@ def dhis2_ou_importer(
 
     the_task.report_progress_and_stop_if_killed(progress_message="Fetching org units")  # type: ignore
 
-    if source_version_number is None:
+    checkpoint = the_task.checkpoint or {}  # type: ignore
+    resume = "source_version_id" in checkpoint
+    if resume:
+        # A previous attempt crashed, continue where it stopped
+        version = SourceVersion.objects.get(id=checkpoint["source_version_id"])
+    elif source_version_number is None:
         last_version = source.versions.all().order_by("number").last()
         source_version_number = last_version.number + 1 if last_version else 0
         version = SourceVersion.objects.create(
@@ -308,8 +341,9 @@ def dhis2_ou_importer(
         )
     else:
         version, _created = SourceVersion.objects.get_or_create(number=source_version_number, data_source=source)
-    if OrgUnit.objects.filter(version=version).count() > 0 and not update_mode:
+    if OrgUnit.objects.filter(version=version).count() > 0 and not (update_mode or resume):
         raise Exception(f"Version {SourceVersion} is not Empty")
+    the_task.save_checkpoint({**checkpoint, "source_version_id": version.id})  # type: ignore
     if not source.default_version:
         source.default_version = version
         source.save()
@@ -325,7 +359,17 @@ def dhis2_ou_importer(
     # name of group to an orgunit type. If an orgunit belong to one of these group it will get that type
     group_type_dict: Dict[str, OrgUnitType] = {}
     error_count, unit_dict = import_orgunits_and_groups(
-        api, source, version, validate, continue_on_error, group_type_dict, start, update_mode, the_task
+        api,
+        source,
+        version,
+        validate,
+        continue_on_error,
+        group_type_dict,
+        start,
+        update_mode,
+        the_task,
+        resume,
+        update_existing,
     )
 
     end = time.time()
@@ -367,13 +411,121 @@ def get_org_unit_levels(api: Api) -> List[LeveLDict]:
     return levels
 
 
+def import_hash(org_unit: OrgUnit, parent_ref: Optional[str]) -> str:
+    """Hash of the fields set by the import, to find the existing org units that changed in DHIS2"""
+    values = [
+        org_unit.name,
+        org_unit.org_unit_type_id,
+        parent_ref,
+        org_unit.opening_date,
+        org_unit.closed_date,
+        *[
+            geometry.hex if geometry else None
+            for geometry in (org_unit.location, org_unit.geom, org_unit.simplified_geom)
+        ],
+    ]
+    return hashlib.sha1(repr(values).encode()).hexdigest()
+
+
+def save_org_units(created: List[OrgUnit], updated: List[OrgUnit], moved: List[OrgUnit], task):
+    """Insert the new org units level by level, so the parents have an id before their children, and write the
+    updated org units in bulk. Then compute the paths of the new and moved (updated with a new parent) org units in a
+    single top-down pass, which also rewrites the paths of the descendants of the moved ones."""
+    depths: Dict[int, int] = {}
+    levels: Dict[int, List[OrgUnit]] = defaultdict(list)
+    for org_unit in created:  # sorted by DHIS2 path, the parents come first
+        parent = org_unit.parent
+        depth = depths[id(parent)] + 1 if parent is not None and id(parent) in depths else 0
+        depths[id(org_unit)] = depth
+        levels[depth].append(org_unit)
+
+    for depth in sorted(levels):
+        for org_unit in levels[depth]:
+            if org_unit.parent is not None:
+                org_unit.parent_id = org_unit.parent.id
+        OrgUnit.objects.bulk_create(levels[depth], batch_size=BULK_BATCH_SIZE)
+        task.report_progress_and_stop_if_killed(progress_message=f"Saved level {depth + 1}/{len(levels)}")
+
+    for org_unit in updated:
+        org_unit.updated_at = now()
+        if org_unit.parent is not None:
+            org_unit.parent_id = org_unit.parent.id
+    OrgUnit.objects.bulk_update(updated, [*IMPORTED_FIELDS, "updated_at"], batch_size=BULK_BATCH_SIZE)
+
+    OrgUnit.objects.bulk_update_paths([*created, *moved], batch_size=BULK_BATCH_SIZE)
+
+
+def assign_groups(
+    groups_per_org_unit: Dict[str, List[DhisGroup]],
+    unit_dict: Dict[str, OrgUnit],
+    group_dict: Dict[str, Group],
+    version: SourceVersion,
+):
+    """Create the missing groups and add the org units to their groups, in bulk"""
+    dhis2_groups: Dict[str, DhisGroup] = {}
+    for dhis2_org_unit_groups in groups_per_org_unit.values():
+        for dhis2_group in dhis2_org_unit_groups:
+            dhis2_groups.setdefault(dhis2_group["name"], dhis2_group)
+
+    for group in Group.objects.filter(source_version=version, name__in=dhis2_groups.keys()):
+        if group.name not in group_dict and group.source_ref == dhis2_groups[group.name]["id"]:
+            group_dict[group.name] = group
+    missing_groups = [
+        Group(name=name, source_version=version, source_ref=dhis2_group["id"])
+        for name, dhis2_group in dhis2_groups.items()
+        if name not in group_dict
+    ]
+    for group in Group.objects.bulk_create(missing_groups):
+        group_dict[group.name] = group
+
+    membership = Group.org_units.through
+    memberships = {
+        (group_dict[dhis2_group["name"]].id, unit_dict[source_ref].id)
+        for source_ref, dhis2_org_unit_groups in groups_per_org_unit.items()
+        for dhis2_group in dhis2_org_unit_groups
+    }
+    org_unit_ids = sorted({org_unit_id for _group_id, org_unit_id in memberships})
+    for index in range(0, len(org_unit_ids), BULK_BATCH_SIZE):
+        memberships.difference_update(
+            membership.objects.filter(orgunit_id__in=org_unit_ids[index : index + BULK_BATCH_SIZE]).values_list(
+                "group_id", "orgunit_id"
+            )
+        )
+    membership.objects.bulk_create(
+        [membership(group_id=group_id, orgunit_id=org_unit_id) for group_id, org_unit_id in memberships],
+        batch_size=BULK_BATCH_SIZE,
+        ignore_conflicts=True,
+    )
+    # The memberships are added without the m2m_changed signal, bump the org units for the mobile delta sync
+    added_ids = sorted({org_unit_id for _group_id, org_unit_id in memberships})
+    for index in range(0, len(added_ids), BULK_BATCH_SIZE):
+        OrgUnit.objects.filter(id__in=added_ids[index : index + BULK_BATCH_SIZE]).update(updated_at=now())
+
+
 def import_orgunits_and_groups(
-    api, source, version, validate, continue_on_error, group_type_dict, start, update_mode, task
+    api,
+    source,
+    version,
+    validate,
+    continue_on_error,
+    group_type_dict,
+    start,
+    update_mode,
+    task,
+    resume=False,
+    update_existing=False,
 ):
+    """Import the org units of the DHIS2 instance in version
+
+    The rows are first staged in memory, then all the changes are saved in bulk in a single transaction.
+    In update mode, only the org units not present in the version are created, unless update_existing is set: then
+    the existing org units which changed in DHIS2 are updated too (the unchanged ones are not written).
+    """
     index = 0
     error_count = 0
-    skip_count = 0
-    orgunits = fetch_orgunits(api)
+    # The previous attempt committed the org units and their groups, only the group sets are left
+    org_units_saved = resume and task.checkpoint.get("org_units_saved")
+    orgunits = [] if org_units_saved else fetch_orgunits(api)
     task.report_progress_and_stop_if_killed(
         progress_value=0, end_value=len(orgunits), progress_message="Importing org units"
     )
@@ -397,16 +549,26 @@ def import_orgunits_and_groups(
             out.projects.set(source_projects)
         level_to_type[out.depth] = out
 
-    group_dict = {}
+    group_dict: Dict[str, Group] = {}
+    if org_units_saved:
+        # the groups of the org units, which the group sets are made of
+        group_dict = {
+            group.name: group for group in Group.objects.filter(source_version=version, source_ref__isnull=False)
+        }
     unit_dict = {ou.source_ref: ou for ou in version.orgunit_set.all()}
+    refs_by_id = {ou.id: source_ref for source_ref, ou in unit_dict.items()}
     created_ou = {}
+    updated_ou = {}
+    moved_ou = []
+    groups_per_org_unit: Dict[str, List[DhisGroup]] = {}
 
     for row in orgunits:
-        # In update mode we only create non-present OrgUnit, but we don't update existing one.
+        source_ref = row["id"].strip()
+        existing = source_ref in unit_dict
+        # In update mode we only create non-present OrgUnit, but we don't update existing one, unless update_existing.
         # in not update mode the version should be empty, so explode
-        if row["id"].strip() in unit_dict:
+        if existing and (source_ref in groups_per_org_unit or not (update_mode and update_existing)):
             if update_mode:
-                skip_count += 1
                 continue
             else:
                 assert False, "not here"
@@ -417,20 +579,33 @@ def import_orgunits_and_groups(
                 source,
                 version,
                 unit_dict,
-                group_dict,
                 group_type_dict,
                 validate,
                 unknown_unit_type,
                 level_to_type,
             )
-            unit_dict[org_unit.source_ref] = org_unit
-            created_ou[org_unit.source_ref] = org_unit
-
         except Exception as e:
             logger.exception(f"Error importing row {index:d}: {row}")
             if not continue_on_error:
                 raise e
             error_count += 1
+            index += 1
+            continue
+
+        if existing:
+            current = unit_dict[source_ref]
+            new_parent = org_unit.parent
+            new_parent_ref = new_parent.source_ref if new_parent else None
+            if import_hash(org_unit, new_parent_ref) != import_hash(current, refs_by_id.get(current.parent_id)):
+                if new_parent_ref != refs_by_id.get(current.parent_id):
+                    moved_ou.append(current)
+                for field in IMPORTED_FIELDS:
+                    setattr(current, field, getattr(org_unit, field))
+                updated_ou[source_ref] = current
+        else:
+            unit_dict[source_ref] = org_unit
+            created_ou[source_ref] = org_unit
+        groups_per_org_unit[source_ref] = row["organisationUnitGroups"]
 
         # log progress every 100 orgunits
         if index % 100 == 0:
@@ -441,17 +616,24 @@ def import_orgunits_and_groups(
 
         index += 1
 
-    logger.debug(f"Created {index} OrgUnits")
+    # All the changes are committed together, a crashed attempt leaves the version as it was
+    with transaction.atomic():
+        save_org_units(list(created_ou.values()), list(updated_ou.values()), moved_ou, task)
+        assign_groups(groups_per_org_unit, unit_dict, group_dict, version)
+        # Create a group that represent all the Orgunit imported
+        if created_ou and update_mode:
+            g = Group.objects.create(name=f"Imported on {now().strftime('%d/%m/%Y %H:%M:%S')}", source_version=version)
+            g.org_units.set(created_ou.values())
+    task.save_checkpoint({**(task.checkpoint or {}), "org_units_saved": True})
+    if updated_ou:
+        MobileOrgUnitSnapshot.objects.invalidate_for_versions([version.id])
+
+    logger.debug(f"Created {len(created_ou)} OrgUnits, updated {len(updated_ou)} OrgUnits")
 
     task.report_progress_and_stop_if_killed(
-        progress_message=f"Created {index} OrgUnits", progress_value=index, end_value=index
+        progress_message=f"Created {len(created_ou)} OrgUnits", progress_value=index, end_value=index
     )
 
-    # Create a group that represent all the Orgunit imported
-    if created_ou and update_mode:
-        g = Group.objects.create(name=f"Imported on {now().strftime('%d/%m/%Y %H:%M:%S')}", source_version=version)
-        g.org_units.set(created_ou.values())
-
     load_groupsets(api, version, group_dict)
     # If there is nothing in the fallback type, delete it.
     if unknown_unit_type.orgunit_set.count() == 0:
@@ -11,35 +11,45 @@ skipped.
 This task generates a .zip file containing all this data for a given app id an user.
 This .zip file can then be parsed by the mobile app, thus simulating a user's
 first login on the mobile app.
+
+The API views are called in-process, as the user (no HTTP request to our own
+server, no token), and their JSON pages are written directly into the zip file.
+The files of the form versions, form attachments and reports are the same for
+all the users, they are taken from a cache shared by the exports, see
+iaso/tasks/utils/mobile_app_setup_artifacts.py.
 """
 
 import json
 import logging
 import os
 import re
-import requests
-from urllib.parse import urlencode, urlparse, urlunparse
 import uuid
 import zipfile
+from urllib.parse import urlencode, urlparse
 
 from beanstalk_worker import task_decorator
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.urls import resolve
 from django.utils.translation import gettext as _
-from rest_framework_simplejwt.tokens import RefreshToken  # type: ignore
+from rest_framework.test import APIRequestFactory, force_authenticate
 
-from iaso.models import Project
+from iaso.models import Project, HIGH_PRIORITY, FormAttachment, FormVersion, ReportVersion
 from iaso.tasks.utils.mobile_app_setup_api_calls import API_CALLS
+from iaso.tasks.utils.mobile_app_setup_artifacts import ArtifactCache
 from iaso.utils.encryption import encrypt_file
-from iaso.utils.iaso_api_client import IasoClient
 from iaso.utils.s3_client import upload_file_to_s3
 
 logger = logging.getLogger(__name__)
 
 SERVER = f"https://{settings.DNS_DOMAIN}"
 
+# Requests built for the in-process calls, with the host of the server so the absolute URLs are the same as through
+# HTTP
+request_factory = APIRequestFactory(HTTP_HOST=settings.DNS_DOMAIN)
+
 
-@task_decorator(task_name="export_mobile_app_setup")
+@task_decorator(task_name="export_mobile_app_setup", priority=HIGH_PRIORITY)
 def export_mobile_app_setup_for_user(
     user_id,
     project_id,
@@ -58,25 +68,28 @@ def export_mobile_app_setup_for_user(
     # setup
     export_name = f"mobile-app-export-{uuid.uuid4()}"
     tmp_dir = os.path.join("/tmp", export_name)
-    iaso_client = IasoClient(server_url=SERVER)
+    os.makedirs(tmp_dir, exist_ok=True)
+    zipfile_name = f"{export_name}.zip"
+    logger.info(f"Writing results to {os.path.join(tmp_dir, zipfile_name)}")
+    artifacts = ArtifactCache()
+    artifacts.prune()
 
-    app_info = _get_project_app_details(iaso_client, tmp_dir, project.app_id)
-    feature_flags = [flag["code"] for flag in app_info["feature_flags"]]
+    with zipfile.ZipFile(os.path.join(tmp_dir, zipfile_name), "w", zipfile.ZIP_DEFLATED) as zipf:
+        app_info = _get_project_app_details(zipf, project.app_id)
+        feature_flags = [flag["code"] for flag in app_info["feature_flags"]]
 
-    the_task.report_progress_and_stop_if_killed(progress_value=1)
+        the_task.report_progress_and_stop_if_killed(progress_value=1)
 
-    if app_info["needs_authentication"]:
-        logger.info("Authentication required, authenticating iaso_client")
-        refresh = RefreshToken.for_user(user)
-        iaso_client.authenticate_with_token(str(refresh.access_token))
+        # Public endpoints are called anonymously, as the mobile app does
+        api_user = user if app_info["needs_authentication"] else None
 
-    the_task.report_progress_and_stop_if_killed(progress_value=2)
+        the_task.report_progress_and_stop_if_killed(progress_value=2)
 
-    for call in API_CALLS:
-        _get_resource(iaso_client, call, tmp_dir, project.app_id, feature_flags)
-        the_task.report_progress_and_stop_if_killed(progress_value=the_task.progress_value + 1)
+        for call in API_CALLS:
+            _get_resource(zipf, artifacts, api_user, call, project.app_id, feature_flags)
+            the_task.report_progress_and_stop_if_killed(progress_value=the_task.progress_value + 1)
 
-    s3_object_name = _compress_and_upload_to_s3(tmp_dir, export_name, password)
+    s3_object_name = _encrypt_and_upload_to_s3(tmp_dir, zipfile_name, password)
 
     the_task.report_success_with_result(
         message=f"Mobile app setup zipfile was created for user {user.username} and project {project.name}.",
@@ -85,10 +98,11 @@ def export_mobile_app_setup_for_user(
     return the_task
 
 
-def _get_project_app_details(iaso_client, tmp_dir, app_id):
+def _get_project_app_details(zipf, app_id):
     logger.info("Getting app info (feature flags etc)")
     # Public endpoint, no auth needed
-    app_info = iaso_client.get(f"/api/apps/current/?app_id={app_id}")
+    content = _call_endpoint(None, "/api/apps/current/", {"app_id": app_id}, "app.json")
+    app_info = json.loads(content)
 
     logger.info("App summary:")
     logger.info(f"\tName: {app_info['name']}")
@@ -100,24 +114,19 @@ def _get_project_app_details(iaso_client, tmp_dir, app_id):
         logger.info(f"\t\t{flag['code']}: {flag['name']}")
     logger.info("")
 
-    logger.info(f"Writing results to {tmp_dir}")
-    if not os.path.exists(tmp_dir):
-        os.makedirs(tmp_dir)
-
-    with open(os.path.join(tmp_dir, "app.json"), "w") as json_file:
-        json.dump(app_info, json_file)
+    zipf.writestr("app.json", content)
 
     return app_info
 
 
-def _get_resource(iaso_client, call, tmp_dir, app_id, feature_flags):
+def _get_resource(zipf, artifacts, user, call, app_id, feature_flags):
     if ("required_feature_flag" in call) and call["required_feature_flag"] not in feature_flags:
         logger.info(f"{call['filename']}: not writing, feature flag missing.")
         return
 
     page = 1
     while page == 1 or (isinstance(result, dict) and result.get("has_next", False)):
-        query_params = call.get("query_params", {})
+        query_params = dict(call.get("query_params", {}))
         query_params["app_id"] = app_id
 
         filename = None
@@ -129,29 +138,30 @@ def _get_resource(iaso_client, call, tmp_dir, app_id, feature_flags):
         else:
             filename = call["filename"] + ".json"
 
-        url = urlunparse(("", "", call["path"], "", urlencode(query_params), ""))
-        result = _call_endpoint(iaso_client, url, filename)
+        content = _call_endpoint(user, call["path"], query_params, filename)
+        result = json.loads(content)
+
+        if isinstance(result, dict) and "count" in result:
+            logger.info(f"\tTotal count: {result['count']}")
+        if isinstance(result, dict) and "pages" in result:
+            logger.info(f"\tTotal pages: {result['pages']}")
 
         # Before saving, for certain resources we need to:
-        # 1. Download the attached files
+        # 1. Add the attached files
         # 2. Rewrite the file URLs to make them appear on a local disk, to facilitate
         #    fetching them in the mobile app.
+        # The other pages are written as returned by the API.
         if call["filename"] == "formversions":
-            _download_form_versions(iaso_client, tmp_dir, result["form_versions"])
-            for record in result["form_versions"]:
-                record["file"] = "forms/" + _extract_filename_from_url(record["file"])
+            _add_form_versions(zipf, artifacts, result["form_versions"])
+            content = json.dumps(result)
         if call["filename"] == "reports":
-            _download_reports(iaso_client, tmp_dir, result)
-            for record in result:
-                record["url"] = "reports/" + _extract_filename_from_url(record["url"])
+            _add_reports(zipf, artifacts, result)
+            content = json.dumps(result)
         if call["filename"] == "formattachments":
-            _download_form_attachments(iaso_client, tmp_dir, result["results"], app_id)
-            for record in result["results"]:
-                # don't use _extract_filename_from_url to preserve subpath
-                record["file"] = "formattachments/" + urlparse(record["file"]).path.split("/form_attachments/")[-1]
+            _add_form_attachments(zipf, artifacts, user, result["results"], app_id)
+            content = json.dumps(result)
 
-        with open(os.path.join(tmp_dir, filename), "w") as json_file:
-            json.dump(result, json_file)
+        zipf.writestr(filename, content)
 
         page += 1
 
@@ -163,114 +173,87 @@ def _extract_filename_from_url(url):
     return urlparse(url).path.split("/")[-1]
 
 
-def _call_endpoint(iaso_client, url, filename):
-    logger.info(f"{filename}: GET {url}")
-    result = iaso_client.get(url)
+def _extract_form_attachment_path(url):
+    # don't use _extract_filename_from_url to preserve subpath
+    return "formattachments/" + urlparse(url).path.split("/form_attachments/")[-1]
 
-    if isinstance(result, dict) and "count" in result:
-        logger.info(f"\tTotal count: {result['count']}")
-    if isinstance(result, dict) and "pages" in result:
-        logger.info(f"\tTotal pages: {result['pages']}")
 
-    return result
+def _call_endpoint(user, path, query_params, filename):
+    """Call the API view of path in-process and return the content of its response
 
+    If user is None, the call is anonymous."""
+    logger.info(f"{filename}: GET {path}?{urlencode(query_params)}")
+    request = request_factory.get(path, query_params, secure=True)
+    if user is not None:
+        force_authenticate(request, user=user)
+    match = resolve(path)
+    response = match.func(request, *match.args, **match.kwargs)
+    if hasattr(response, "render"):
+        response.render()
+    # the large org unit snapshots are streamed
+    content = b"".join(response.streaming_content) if response.streaming else response.content
+    if response.status_code != 200:
+        raise Exception(f"GET {path} returned {response.status_code}: {content[:1000]!r}")
+    return content
 
-def _download_form_attachments(iaso_client, tmp_dir, resources, app_id):
-    if len(resources) == 0:
+
+def _add_files(zipf, artifacts, files):
+    """Add the (archive name, cache key, FieldFile) to the zip file, from the shared artifact cache"""
+    if not files:
         return
+    paths = artifacts.get_paths((key, field_file) for _archive_name, key, field_file in files)
+    for (archive_name, _key, _field_file), path in zip(files, paths):
+        logger.info(f"\tADD {archive_name}")
+        zipf.write(path, archive_name)
 
-    # create subfolder for downloaded files
-    os.makedirs(os.path.join(tmp_dir, "formattachments"))
-    for resource in resources:
-        form_id = resource["form_id"]
-        os.makedirs(os.path.join(tmp_dir, "formattachments", str(form_id)))
-        url = resource["file"]
-        filename = _extract_filename_from_url(url)
-
-        logger.info(f"\tDOWNLOAD {url}")
-        attachment_file = None
-        # S3 urls contain a signature and don't work with additional auth headers
-        if "s3.amazonaws" in url:
-            attachment_file = requests.get(url)
-        else:
-            attachment_file = requests.get(url, headers=iaso_client.headers)
 
-        logger.info(f"\tDOWNLOAD manifest")
-        manifest_file = requests.get(
-            SERVER + f"/api/forms/{form_id}/manifest/?app_id={app_id}",
-            headers=iaso_client.headers,
-        )
+def _add_form_attachments(zipf, artifacts, user, resources, app_id):
+    if len(resources) == 0:
+        return
 
-        with open(os.path.join(tmp_dir, "formattachments", str(form_id), filename), mode="wb") as f:
-            f.write(attachment_file.content)
+    attachments = FormAttachment.objects.in_bulk([resource["id"] for resource in resources])
+    files = []
+    for resource in resources:
+        archive_name = _extract_form_attachment_path(resource["file"])
+        attachment = attachments[resource["id"]]
+        files.append((archive_name, f"formattachment-{attachment.md5}", attachment.file))
+        resource["file"] = archive_name
+    _add_files(zipf, artifacts, files)
+
+    for form_id in sorted({resource["form_id"] for resource in resources}):
+        logger.info(f"\tmanifest of form {form_id}")
+        content = _call_endpoint(user, f"/api/forms/{form_id}/manifest/", {"app_id": app_id}, "manifest.xml")
         # For the manifest.xml, rewrite the `downloadUrl` to the local file path
-        with open(os.path.join(tmp_dir, "formattachments", str(form_id), "manifest.xml"), mode="w") as f:
-            content = manifest_file.content.decode("utf-8")
-            url_regex = r"(?<=<downloadUrl>)(.*?)(?=</downloadUrl>)"
-            download_url = re.search(url_regex, content).group()
-            # don't use _extract_filename_from_url to preserve subpath
-            new_download_url = "formattachments/" + urlparse(download_url).path.split("/form_attachments/")[-1]
-            f.write(re.sub(url_regex, new_download_url, content))
+        url_regex = r"(?<=<downloadUrl>)(.*?)(?=</downloadUrl>)"
+        manifest = re.sub(url_regex, lambda match: _extract_form_attachment_path(match.group()), content.decode())
+        zipf.writestr(f"formattachments/{form_id}/manifest.xml", manifest)
 
 
-def _download_form_versions(iaso_client, tmp_dir, form_versions):
-    if len(form_versions) == 0:
-        return
-
-    os.makedirs(os.path.join(tmp_dir, "forms"))
+def _add_form_versions(zipf, artifacts, form_versions):
+    form_version_files = FormVersion.objects.in_bulk([form_version["id"] for form_version in form_versions])
+    files = []
     for form_version in form_versions:
-        _download_and_save_file(
-            iaso_client,
-            tmp_dir,
-            url=form_version["file"],
-            non_s3_url=form_version["file"],
-            folder_name="forms",
-        )
+        archive_name = "forms/" + _extract_filename_from_url(form_version["file"])
+        version = form_version_files[form_version["id"]]
+        key = f"formversion-{version.id}-{version.updated_at.isoformat()}-{version.file.name}"
+        files.append((archive_name, key, version.file))
+        form_version["file"] = archive_name
+    _add_files(zipf, artifacts, files)
 
 
-def _download_reports(iaso_client, tmp_dir, reports):
-    if len(reports) == 0:
-        return
-
-    os.makedirs(os.path.join(tmp_dir, "reports"))
+def _add_reports(zipf, artifacts, reports):
+    report_versions = ReportVersion.objects.in_bulk([report["version_id"] for report in reports])
+    files = []
     for report in reports:
-        _download_and_save_file(
-            iaso_client,
-            tmp_dir,
-            url=report["url"],
-            non_s3_url=SERVER + report["url"],
-            folder_name="reports",
-        )
-
-
-def _download_and_save_file(iaso_client, tmp_dir, folder_name, url, non_s3_url):
-    filename = _extract_filename_from_url(url)
-    response = None
-    # S3 urls contain a signature and don't work with additional auth headers
-    if "s3.amazonaws" in url:
-        logger.info(f"\tDOWNLOAD {url}")
-        response = requests.get(url)
-    else:
-        logger.info(f"\tDOWNLOAD {non_s3_url}")
-        response = requests.get(non_s3_url, headers=iaso_client.headers)
-
-    with open(os.path.join(tmp_dir, folder_name, filename), mode="wb") as f:
-        f.write(response.content)
-
-
-def _compress_and_upload_to_s3(tmp_dir, export_name, password):
-    zipfile_name = f"{export_name}.zip"
-    logger.info(f"Creating zipfile {zipfile_name}")
+        archive_name = "reports/" + _extract_filename_from_url(report["url"])
+        version = report_versions[report["version_id"]]
+        key = f"reportversion-{version.id}-{version.updated_at.isoformat()}-{version.file.name}"
+        files.append((archive_name, key, version.file))
+        report["url"] = archive_name
+    _add_files(zipf, artifacts, files)
 
-    with zipfile.ZipFile(os.path.join(tmp_dir, zipfile_name), "w", zipfile.ZIP_DEFLATED) as zipf:
-        # add all files in /tmp directory to the .zip file
-        for root, _dirs, files in os.walk(tmp_dir):
-            for file in files:
-                if file != zipfile_name:
-                    file_path = os.path.join(root, file)
-                    archive_name = os.path.relpath(file_path, tmp_dir)
-                    zipf.write(file_path, archive_name)
 
+def _encrypt_and_upload_to_s3(tmp_dir, zipfile_name, password):
     logger.info("Encrypting zipfile")
     encrypted_file_path = encrypt_file(
         file_path=tmp_dir,
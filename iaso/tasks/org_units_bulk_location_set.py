@@ -13,6 +13,7 @@ from django.db.models import Q, QuerySet
 
 from beanstalk_worker import task_decorator
 from hat.audit import models as audit_models
+from hat.audit.writer import audit_writer
 from iaso.api.org_unit_search import build_org_units_queryset
 from iaso.models import Task, OrgUnit, DataSource
 from iaso.utils.gis import convert_2d_point_to_3d
@@ -38,7 +39,7 @@ def update_single_org_unit_location_from_bulk(user: Optional[User], org_unit: Or
     org_unit.location = convert_2d_point_to_3d(org_unit.instance_center) if org_unit.instance_center else None
     logger.info(f"updating {org_unit.name} {org_unit.id} with {org_unit.location}")
     org_unit.save()
-    audit_models.log_modification(original_copy, org_unit, source=audit_models.ORG_UNIT_API_BULK, user=user)
+    audit_writer.log(original_copy, org_unit, source=audit_models.ORG_UNIT_API_BULK, user=user)
 
 
 @task_decorator(task_name="org_unit_bulk_location_set")
@@ -98,6 +99,7 @@ def org_units_bulk_location_set(
                 user,
                 org_unit,
             )
+        audit_writer.flush()
 
         task.report_success(message="%d modified" % total)
 
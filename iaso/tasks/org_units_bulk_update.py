@@ -3,11 +3,14 @@ from time import time
 from typing import Optional, List
 
 from django.db import transaction
+from django.utils import timezone
 
 from beanstalk_worker import task_decorator
 from hat.audit import models as audit_models
+from hat.audit.writer import audit_writer
 from iaso.api.org_unit_search import build_org_units_queryset
-from iaso.models import Task, OrgUnit, DataSource, OrgUnitType, Group
+from iaso.models import Task, OrgUnit, DataSource, OrgUnitType, Group, MobileOrgUnitSnapshot, LOW_PRIORITY
+from iaso.tasks.utils.chunks import run_by_chunks
 
 
 def update_single_unit_from_bulk(
@@ -32,10 +35,46 @@ def update_single_unit_from_bulk(
 
     org_unit.save()
 
-    audit_models.log_modification(original_copy, org_unit, source=audit_models.ORG_UNIT_API_BULK, user=user)
-
-
-@task_decorator(task_name="org_unit_bulk_update")
+    audit_writer.log(original_copy, org_unit, source=audit_models.ORG_UNIT_API_BULK, user=user)
+
+
+def update_chunk_from_bulk(
+    user, org_unit_ids, *, validation_status, org_unit_type, groups_added, groups_removed
+) -> int:
+    """Apply the bulk modification to a chunk of org units using a constant number of queries.
+
+    Used by the chunked mode of org_units_bulk_update, should be run in a transaction."""
+    org_units = list(OrgUnit.objects.filter(pk__in=org_unit_ids).order_by("pk"))
+    originals = [deepcopy(org_unit) for org_unit in org_units]
+    now = timezone.now()
+    for org_unit in org_units:
+        if validation_status is not None:
+            org_unit.validation_status = validation_status
+        if org_unit_type is not None:
+            org_unit.org_unit_type = org_unit_type
+        org_unit.updated_at = now  # bulk_update doesn't handle auto_now
+    # None of these fields impact the path, so there is no need to call save() to recompute it
+    OrgUnit.objects.bulk_update(org_units, ["validation_status", "org_unit_type", "updated_at"])
+
+    Membership = Group.org_units.through
+    if groups_added:
+        Membership.objects.bulk_create(
+            [Membership(group_id=group.id, orgunit_id=org_unit.id) for group in groups_added for org_unit in org_units],
+            ignore_conflicts=True,
+        )
+    if groups_removed:
+        Membership.objects.filter(group__in=groups_removed, orgunit_id__in=org_unit_ids).delete()
+    if groups_added or groups_removed:
+        # The queries on the through table don't send m2m_changed, do what its receivers would do
+        groups = groups_added + groups_removed
+        MobileOrgUnitSnapshot.objects.invalidate_for_versions({group.source_version_id for group in groups})
+
+    audit_writer.log_many(zip(originals, org_units), source=audit_models.ORG_UNIT_API_BULK, user=user)
+    audit_writer.flush()
+    return len(org_units)
+
+
+@task_decorator(task_name="org_unit_bulk_update", priority=LOW_PRIORITY, max_attempts=3)
 def org_units_bulk_update(
     app_id: Optional[str],
     select_all: bool,
@@ -47,8 +86,14 @@ def org_units_bulk_update(
     groups_ids_removed: Optional[List[int]],
     validation_status: Optional[str],
     task: Task,
+    chunk_size: Optional[int] = None,
 ):
-    """Background Task to bulk update org units."""
+    """Background Task to bulk update org units.
+
+    By default all the org units are modified one by one in a single transaction. If `chunk_size` is set, they are
+    modified by chunks of that size, each chunk in its own transaction with bulk queries. Progress is checkpointed
+    after each chunk so that a task requeued after a crash resumes after the last committed chunk.
+    """
     start = time()
     task.report_progress_and_stop_if_killed(progress_message="Searching for Org Units to modify")
 
@@ -82,6 +127,19 @@ def org_units_bulk_update(
 
     total = queryset.count()
 
+    if chunk_size:
+        org_units_bulk_update_by_chunks(
+            queryset,
+            task,
+            chunk_size,
+            validation_status=validation_status,
+            org_unit_type_id=org_unit_type_id,
+            groups_ids_added=groups_ids_added,
+            groups_ids_removed=groups_ids_removed,
+        )
+        task.report_success(message="%d modified" % total)
+        return
+
     # FIXME Task don't handle rollback properly if task is killed by user or other error
     with transaction.atomic():
         for index, org_unit in enumerate(queryset.iterator()):
@@ -95,5 +153,30 @@ def org_units_bulk_update(
                 groups_ids_added=groups_ids_added,
                 groups_ids_removed=groups_ids_removed,
             )
+        audit_writer.flush()
 
         task.report_success(message="%d modified" % total)
+
+
+def org_units_bulk_update_by_chunks(
+    queryset, task: Task, chunk_size: int, *, validation_status, org_unit_type_id, groups_ids_added, groups_ids_removed
+):
+    user = task.launcher
+    org_unit_type = OrgUnitType.objects.get(pk=org_unit_type_id) if org_unit_type_id is not None else None
+    groups_added = [Group.objects.get(pk=group_id) for group_id in groups_ids_added or []]
+    groups_removed = [Group.objects.get(pk=group_id) for group_id in groups_ids_removed or []]
+
+    run_by_chunks(
+        task,
+        queryset.values_list("id", flat=True),
+        chunk_size,
+        lambda chunk: update_chunk_from_bulk(
+            user,
+            chunk,
+            validation_status=validation_status,
+            org_unit_type=org_unit_type,
+            groups_added=groups_added,
+            groups_removed=groups_removed,
+        ),
+        "org units",
+    )
@@ -4,6 +4,7 @@ from typing import List
 from django.db import transaction
 from beanstalk_worker import task_decorator
 from hat.audit import models as audit_models
+from hat.audit.writer import audit_writer
 from iaso.api.payments.serializers import PaymentLotAuditLogger
 from iaso.models import Task
 from iaso.models.base import ERRORED
@@ -21,7 +22,7 @@ def update_payment_from_bulk(user, payment, *, status, api):
         payment.status = status
     payment.save()
 
-    audit_models.log_modification(original_copy, payment, source=source, user=user)
+    audit_writer.log(original_copy, payment, source=source, user=user)
 
 
 @task_decorator(task_name="payments_bulk_update")
@@ -82,6 +83,7 @@ def payments_bulk_update(
                     progress_message=res_string, end_value=total, progress_value=index
                 )
                 update_payment_from_bulk(user, payment, status=status, api=api)
+            audit_writer.flush()
             # Update PaymentLot status if needed. Since the bulk update doesn't necessarily include
             # all Payments, we need to check if the status changed
             old_payment_lot_status = payment_lot.status
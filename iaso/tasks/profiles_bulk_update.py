@@ -1,6 +1,6 @@
 from copy import deepcopy
 from time import time
-from typing import Optional, List
+from typing import Dict, Optional, List
 
 from django.contrib.auth.models import User
 from django.db import transaction
@@ -10,8 +10,10 @@ from rest_framework.exceptions import PermissionDenied
 from django.shortcuts import get_object_or_404
 from beanstalk_worker import task_decorator
 from hat.audit import models as audit_models
-from iaso.models import Task, Profile, Project, UserRole, OrgUnit
+from hat.audit.writer import audit_writer
+from iaso.models import Task, Profile, Project, UserRole, OrgUnit, LOW_PRIORITY
 from iaso.api.profiles import get_filtered_profiles
+from iaso.tasks.utils.chunks import run_by_chunks
 from hat.menupermissions import models as permission
 from hat.menupermissions.models import CustomPermissionSupport
 
@@ -114,10 +116,114 @@ def update_single_profile_from_bulk(
 
     profile.save()
 
-    audit_models.log_modification(original_copy, profile, source=audit_models.PROFILE_API_BULK, user=user)
+    audit_writer.log(original_copy, profile, source=audit_models.PROFILE_API_BULK, user=user)
 
 
-@task_decorator(task_name="profiles_bulk_update")
+def resolve_bulk_targets(
+    user: User,
+    managed_org_units: Optional[List[int]],
+    *,
+    projects_ids_added: Optional[List[int]],
+    projects_ids_removed: Optional[List[int]],
+    roles_id_added: Optional[List[int]],
+    roles_id_removed: Optional[List[int]],
+    teams_id_added: Optional[List[int]],
+    teams_id_removed: Optional[List[int]],
+    location_ids_added: Optional[List[int]],
+    location_ids_removed: Optional[List[int]],
+) -> Dict[str, list]:
+    """Check the permissions and load the roles, projects, teams and org units to add or remove, once for all the
+    profiles. Applies the same rules as update_single_profile_from_bulk, which does it for each profile."""
+    account_id = user.iaso_profile.account.id
+    targets: Dict[str, list] = {}
+
+    def roles(role_ids, check_rights):
+        result = []
+        for role_id in role_ids or []:
+            role = get_object_or_404(UserRole, id=role_id, account_id=account_id)
+            if check_rights and not user.has_perm(permission.USERS_ADMIN):
+                for p in role.group.permissions.all():
+                    CustomPermissionSupport.assert_right_to_assign(user, p.codename)
+            result.append(role)
+        return result
+
+    targets["roles_added"] = roles(roles_id_added, check_rights=True)
+    targets["roles_removed"] = roles(roles_id_removed, check_rights=False)
+
+    for key, project_ids in (("projects_added", projects_ids_added), ("projects_removed", projects_ids_removed)):
+        if project_ids is not None and not user.has_perm(permission.USERS_ADMIN):
+            raise PermissionDenied(
+                f"User with permission {permission.USERS_MANAGED} cannot changed project attributions"
+            )
+        projects = [Project.objects.get(pk=project_id) for project_id in project_ids or []]
+        targets[key] = [p for p in projects if p.account and p.account.id == account_id]
+
+    for key, team_ids, verb in (("teams_added", teams_id_added, "add"), ("teams_removed", teams_id_removed, "remove")):
+        if team_ids is not None and not user.has_perm(permission.TEAMS):
+            raise PermissionDenied(f"User without the permission {permission.TEAMS} cannot {verb} users to team")
+        teams = [Team.objects.get(pk=team_id) for team_id in team_ids or []]
+        targets[key] = [
+            team
+            for team in teams
+            if team.manager.iaso_profile.account
+            and team.manager.iaso_profile.account.id == account_id
+            and team.type == TeamType.TEAM_OF_USERS
+        ]
+
+    for key, location_ids in (("locations_added", location_ids_added), ("locations_removed", location_ids_removed)):
+        for location_id in location_ids or []:
+            if managed_org_units and len(managed_org_units) > 0 and location_id not in managed_org_units:
+                raise PermissionDenied(
+                    f"User with permission {permission.USERS_MANAGED} cannot change OrgUnits outside of their own "
+                    f"health pyramid"
+                )
+        targets[key] = [OrgUnit.objects.get(pk=location_id) for location_id in location_ids or []]
+
+    return targets
+
+
+def update_chunk_from_bulk(user: User, profile_ids: List[int], targets: Dict[str, list], language: Optional[str]):
+    """Apply the bulk modification to a chunk of profiles using a constant number of queries.
+
+    Used by the chunked mode of profiles_bulk_update, should be run in a transaction."""
+    profiles = list(Profile.objects.filter(pk__in=profile_ids).order_by("pk"))
+    originals = [deepcopy(profile) for profile in profiles]
+    user_ids = [profile.user_id for profile in profiles]
+
+    def link(through, field, target_field, targets_list, objects):
+        through.objects.bulk_create(
+            [through(**{field: o.id, target_field: t.id}) for t in targets_list for o in objects], ignore_conflicts=True
+        )
+
+    def unlink(through, field, target_field, targets_list, ids):
+        if targets_list:
+            through.objects.filter(
+                **{f"{field}__in": ids, f"{target_field}__in": [t.id for t in targets_list]}
+            ).delete()
+
+    RoleLink = Profile.user_roles.through
+    ProjectLink = Profile.projects.through
+    OrgUnitLink = Profile.org_units.through
+    TeamLink = Team.users.through
+    link(RoleLink, "profile_id", "userrole_id", targets["roles_added"], profiles)
+    unlink(RoleLink, "profile_id", "userrole_id", targets["roles_removed"], profile_ids)
+    link(ProjectLink, "profile_id", "project_id", targets["projects_added"], profiles)
+    unlink(ProjectLink, "profile_id", "project_id", targets["projects_removed"], profile_ids)
+    link(TeamLink, "user_id", "team_id", targets["teams_added"], [profile.user for profile in profiles])
+    unlink(TeamLink, "user_id", "team_id", targets["teams_removed"], user_ids)
+    link(OrgUnitLink, "profile_id", "orgunit_id", targets["locations_added"], profiles)
+    unlink(OrgUnitLink, "profile_id", "orgunit_id", targets["locations_removed"], profile_ids)
+
+    if language is not None:
+        for profile in profiles:
+            profile.language = language
+        Profile.objects.bulk_update(profiles, ["language"])
+
+    audit_writer.log_many(zip(originals, profiles), source=audit_models.PROFILE_API_BULK, user=user)
+    audit_writer.flush()
+
+
+@task_decorator(task_name="profiles_bulk_update", priority=LOW_PRIORITY, max_attempts=3)
 def profiles_bulk_update(
     select_all: bool,
     selected_ids: List[int],
@@ -140,8 +246,14 @@ def profiles_bulk_update(
     projects: Optional[List[int]],
     user_roles: Optional[List[int]],
     task: Task,
+    chunk_size: Optional[int] = None,
 ):
-    """Background Task to bulk update profiles."""
+    """Background Task to bulk update profiles.
+
+    By default all the profiles are modified one by one in a single transaction. If `chunk_size` is set, they are
+    modified by chunks of that size, each chunk in its own transaction with bulk queries. Progress is checkpointed
+    after each chunk so that a task requeued after a crash resumes after the last committed chunk.
+    """
     start = time()
     task.report_progress_and_stop_if_killed(progress_message="Searching for Profiles to modify")
 
@@ -178,13 +290,35 @@ def profiles_bulk_update(
 
     total = queryset.count()
 
+    managed_org_units = None
+    if user and not user.has_perm(permission.USERS_ADMIN):
+        managed_org_units = OrgUnit.objects.hierarchy(user.iaso_profile.org_units.all()).values_list("id", flat=True)
+
+    if chunk_size:
+        targets = resolve_bulk_targets(
+            user,
+            managed_org_units,
+            projects_ids_added=projects_ids_added,
+            projects_ids_removed=projects_ids_removed,
+            roles_id_added=roles_id_added,
+            roles_id_removed=roles_id_removed,
+            teams_id_added=teams_id_added,
+            teams_id_removed=teams_id_removed,
+            location_ids_added=location_ids_added,
+            location_ids_removed=location_ids_removed,
+        )
+        run_by_chunks(
+            task,
+            queryset.values_list("id", flat=True),
+            chunk_size,
+            lambda chunk: update_chunk_from_bulk(user, chunk, targets, language),
+            "profiles",
+        )
+        task.report_success(message="%d modified" % total)
+        return
+
     # FIXME Task don't handle rollback properly if task is killed by user or other error
     with transaction.atomic():
-        managed_org_units = None
-        if user and not user.has_perm(permission.USERS_ADMIN):
-            managed_org_units = OrgUnit.objects.hierarchy(user.iaso_profile.org_units.all()).values_list(
-                "id", flat=True
-            )
         for index, profile in enumerate(queryset.iterator()):
             res_string = "%.2f sec, processed %i profiles" % (time() - start, index)
             task.report_progress_and_stop_if_killed(progress_message=res_string, end_value=total, progress_value=index)
@@ -202,5 +336,6 @@ def profiles_bulk_update(
                 location_ids_removed=location_ids_removed,
                 language=language,
             )
+        audit_writer.flush()
 
         task.report_success(message="%d modified" % total)
@@ -0,0 +1,10 @@
+from beanstalk_worker import task_decorator
+from iaso.models import OrgUnitTombstone, Task, LOW_PRIORITY
+
+
+@task_decorator(task_name="prune_org_unit_tombstones", priority=LOW_PRIORITY)
+def prune_org_unit_tombstones(task: Task):
+    """Background Task to delete the tombstones of the org units deleted before TOMBSTONE_RETENTION"""
+    task.report_progress_and_stop_if_killed(progress_message="Pruning the org unit tombstones")
+    count, _ = OrgUnitTombstone.objects.prune()
+    task.report_success(message=f"{count} org unit tombstones deleted")
@@ -0,0 +1,13 @@
+from time import time
+
+from beanstalk_worker import task_decorator
+from iaso.models import CompletenessRollup, Task, LOW_PRIORITY
+
+
+@task_decorator(task_name="refresh_completeness_rollup", priority=LOW_PRIORITY)
+def refresh_completeness_rollup(task: Task):
+    """Background Task to recompute all the counts used by the completeness stats, see CompletenessRollup"""
+    start = time()
+    task.report_progress_and_stop_if_killed(progress_message="Refreshing the completeness stats rollup")
+    CompletenessRollup.objects.refresh()
+    task.report_success(message=f"Completeness stats rollup refreshed in {time() - start:.2f} sec")
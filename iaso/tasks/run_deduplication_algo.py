@@ -7,7 +7,7 @@ from iaso.api.deduplication.algos import run_algo, POSSIBLE_ALGORITHMS  # type:
 logger = logging.getLogger(__name__)
 
 
-@task_decorator(task_name="run_deduplication_algo")
+@task_decorator(task_name="run_deduplication_algo", max_attempts=3)
 def run_deduplication_algo(algo_name=None, algo_params=None, task=None):
     """Background Task to run deduplication algo."""
     started_at = datetime.now()
@@ -0,0 +1,31 @@
+from bisect import bisect_right
+from time import time
+from typing import Callable, Iterable, List
+
+from django.db import transaction
+
+from iaso.models import Task
+
+
+def run_by_chunks(
+    task: Task, ids: Iterable[int], chunk_size: int, update_chunk: Callable[[List[int]], None], name: str
+):
+    """Call `update_chunk` on the ids, sorted, by chunks of `chunk_size`, each chunk in its own transaction.
+
+    The last id of each committed chunk is checkpointed, so a task requeued after a crash resumes after it.
+    """
+    start = time()
+    ids = sorted(set(ids))
+    total = len(ids)
+    # Resume after the last chunk committed by a previous attempt
+    last_id = (task.checkpoint or {}).get("last_id")
+    first = bisect_right(ids, last_id) if last_id is not None else 0
+
+    for index in range(first, total, chunk_size):
+        chunk = ids[index : index + chunk_size]
+        with transaction.atomic():
+            update_chunk(chunk)
+        task.save_checkpoint({"last_id": chunk[-1]})
+        done = index + len(chunk)
+        res_string = "%.2f sec, processed %i %s" % (time() - start, done, name)
+        task.report_progress_and_stop_if_killed(progress_message=res_string, end_value=total, progress_value=done)
@@ -0,0 +1,74 @@
+"""
+Files shared by the mobile app setup bundles of all the users: form versions, form attachments and reports.
+
+They are the same for every user of a project, so they are read from the storage once and kept on the local disk of
+the worker, under a key identifying their content (the md5 of the attachments, the id and last update of the form
+and report versions). The bundles then only add the local copy to their zip file.
+
+The copies not used for MOBILE_SETUP_ARTIFACTS_MAX_AGE_DAYS are removed by `prune`.
+"""
+
+import hashlib
+import logging
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List, Tuple
+
+from django.conf import settings
+from django.db.models.fields.files import FieldFile
+
+logger = logging.getLogger(__name__)
+
+READ_CONCURRENCY = 8
+
+
+class ArtifactCache:
+    def __init__(self, directory: str = None):
+        self.directory = directory or settings.MOBILE_SETUP_ARTIFACTS_DIR
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(key.encode()).hexdigest())
+
+    def get_paths(self, artifacts: Iterable[Tuple[str, FieldFile]]) -> List[str]:
+        """Local paths of the (key, file) artifacts, the missing ones being read from the storage in parallel"""
+        artifacts = list(artifacts)
+        paths = [self.path(key) for key, _field_file in artifacts]
+        missing = {}
+        for path, (key, field_file) in zip(paths, artifacts):
+            if os.path.exists(path):
+                # keep track of the last use, for `prune`
+                os.utime(path)
+            else:
+                missing[path] = field_file
+        if missing:
+            logger.info(f"\tREAD {len(missing)} files from the storage, {len(paths) - len(missing)} in cache")
+            with ThreadPoolExecutor(max_workers=READ_CONCURRENCY) as executor:
+                list(executor.map(self.store, missing.keys(), missing.values()))
+        return paths
+
+    def store(self, path: str, field_file: FieldFile):
+        # Written in a temporary file then renamed, so concurrent exports never read a partial copy
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f, field_file.storage.open(field_file.name, "rb") as source:
+                for chunk in iter(lambda: source.read(1024 * 1024), b""):
+                    f.write(chunk)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def prune(self, max_age_days: int = None):
+        """Remove the copies not used for max_age_days"""
+        if max_age_days is None:
+            max_age_days = settings.MOBILE_SETUP_ARTIFACTS_MAX_AGE_DAYS
+        limit = time.time() - max_age_days * 24 * 3600
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.is_file() and entry.stat().st_mtime < limit:
+                    os.remove(entry.path)
+            except FileNotFoundError:  # removed by another export
+                pass
@@ -1,4 +1,5 @@
 import importlib
+import json
 import typing
 from unittest import mock
 
@@ -111,6 +112,10 @@ class APITestCase(BaseAPITestCase, IasoTestCaseMixin):
         self.client = APIClient()
 
     def assertJSONResponse(self, response: typing.Any, expected_status_code: int):
+        if isinstance(response, StreamingHttpResponse):
+            self.assertEqual(expected_status_code, response.status_code)
+            self.assertEqual("application/json", response["Content-Type"])
+            return json.loads(b"".join(response.streaming_content))
         self.assertIsInstance(response, HttpResponse)
         self.assertEqual(expected_status_code, response.status_code, try_json(response))
 
@@ -8,6 +8,7 @@ from django.db import connection
 import iaso.models.base as base
 from beanstalk_worker.services import TestTaskService
 from iaso import models as m
+from iaso.api.deduplication.algos.levenshtein import ENTITY_KEYS_TABLE
 from iaso.models.deduplication import ValidationStatus
 from iaso.test import APITestCase
 
@@ -643,3 +644,71 @@ class EntitiesDuplicationAPITestCase(APITestCase):
         response = self.client.get(f"/api/entityduplicates/")
 
         self.assertEqual(response.data["results"], [])
+
+    def run_analyze(self, parameters):
+        response = self.client.post(
+            "/api/entityduplicates_analyzes/",
+            {
+                "entity_type_id": self.default_entity_type.id,
+                "fields": ["Prenom", "Nom", "Age"],
+                "algorithm": "levenshtein",
+                "parameters": parameters,
+            },
+            format="json",
+        )
+        self.assertEqual(response.status_code, 201)
+        TestTaskService().run_all()
+        return m.EntityDuplicateAnalyzis.objects.get(id=response.data["analyze_id"])
+
+    def test_analyzes_with_blocking(self):
+        self.client.force_authenticate(self.user_with_default_ou_rw)
+
+        analyze = self.run_analyze({"blocking": True})
+
+        self.assertEqual(analyze.task.status, "SUCCESS")
+        self.assertEqual(analyze.duplicates.count(), 6)
+        self.assertFalse(m.EntityDuplicate.objects.filter(entity1=self.far_entity).exists())
+        self.assertFalse(m.EntityDuplicate.objects.filter(entity2=self.far_entity).exists())
+
+    def test_analyzes_incremental(self):
+        self.client.force_authenticate(self.user_with_default_ou_rw)
+        first_analyze = self.run_analyze({"incremental": True})
+        self.assertEqual(first_analyze.duplicates.count(), 6)
+        # forget the results, to check that the next analyze doesn't compare the already analyzed entities again
+        first_analyze.duplicates.all().delete()
+
+        create_instance_and_entity(
+            self, "new_entity", {"Prenom": "same_instance", "Nom": "iaso", "Age": 20}, "2020022401"
+        )
+        second_analyze = self.run_analyze({"incremental": True})
+
+        self.assertEqual(second_analyze.task.status, "SUCCESS")
+        self.assertEqual(second_analyze.duplicates.count(), 4)
+        self.assertEqual(second_analyze.duplicates.exclude(entity1=self.new_entity).count(), 0)
+
+    @mock.patch("iaso.api.deduplication.algos.levenshtein.STREAMING_BATCH_SIZE", 2)
+    def test_analyzes_streaming_with_blocking(self):
+        self.client.force_authenticate(self.user_with_default_ou_rw)
+
+        analyze = self.run_analyze({"streaming": True, "blocking": True})
+
+        self.assertEqual(analyze.task.status, "SUCCESS")
+        self.assertEqual(analyze.duplicates.count(), 6)
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT to_regclass(%s)", [ENTITY_KEYS_TABLE])
+            self.assertIsNone(cursor.fetchone()[0])
+
+    @mock.patch("iaso.api.deduplication.algos.levenshtein.STREAMING_BATCH_SIZE", 2)
+    def test_analyzes_streaming(self):
+        self.client.force_authenticate(self.user_with_default_ou_rw)
+
+        analyze = self.run_analyze({"streaming": True})
+
+        self.assertEqual(analyze.task.status, "SUCCESS")
+        self.assertIsNotNone(analyze.finished_at)
+        self.assertEqual(analyze.duplicates.count(), 6)
+        self.assertEqual(analyze.task.end_value, 3)  # 5 entities of the default entity type, by batches of 2
+        self.assertEqual(analyze.task.checkpoint["last_entity_id"], self.same_entity_in_other_ou.id)
+        self.assertEqual(
+            analyze.duplicates.get(entity1=self.close_entity, entity2=self.same_entity_1).similarity_score, 78
+        )
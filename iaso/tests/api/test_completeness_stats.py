@@ -6,8 +6,11 @@
 from typing import Any
 
 from django.contrib.auth.models import User, Permission
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 
-from iaso.models import Account, Form, OrgUnitType, OrgUnit, Instance
+from iaso.models import Account, Form, OrgUnitType, OrgUnit, Instance, CompletenessRollup
 from iaso.models.base import Profile
 from iaso.models.microplanning import Team
 from iaso.test import APITestCase
@@ -895,3 +898,77 @@ class CompletenessStatsAPITestCase(APITestCase):
             # check that the result have effectly zero submission
             ou = r["org_unit"]["id"]
             self.assertEqual(Instance.objects.filter(form=self.form_hs_4, org_unit_id=ou).count(), 0)
+
+    def test_rollup_maintained_on_instance_save(self):
+        CompletenessRollup.objects.refresh()
+        rollup = CompletenessRollup.objects.get(org_unit=self.as_abb_ou, form=self.form_hs_4, period="")
+        self.assertEqual(rollup.instances_count, 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.create_form_instance(form=self.form_hs_4, org_unit=self.as_abb_ou)
+        rollup.refresh_from_db()
+        self.assertEqual(rollup.instances_count, 3)
+
+        # moving a submission updates the count of both org units
+        with self.captureOnCommitCallbacks(execute=True):
+            self.instance_2.org_unit = self.hopital_aaa_ou
+            self.instance_2.save()
+        rollup.refresh_from_db()
+        self.assertEqual(rollup.instances_count, 2)
+        moved = CompletenessRollup.objects.get(org_unit=self.hopital_aaa_ou, form=self.form_hs_4, period="")
+        self.assertEqual(moved.instances_count, 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.instance_2.deleted = True
+            self.instance_2.save()
+        self.assertFalse(CompletenessRollup.objects.filter(id=moved.id).exists())
+
+    def test_rollup_not_refreshed_on_unrelated_save(self):
+        instance = Instance.objects.get(id=self.instance_2.id)
+        with self.captureOnCommitCallbacks() as callbacks:
+            instance.save(update_fields=["json"])
+        self.assertEqual(callbacks, [])
+
+        # the previous key is read from the loaded instance, not from the database
+        instance.org_unit = self.hopital_aaa_ou
+        with self.captureOnCommitCallbacks() as callbacks, self.assertNumQueries(1):
+            instance.save(update_fields=["org_unit"])
+        self.assertEqual(len(callbacks), 1)
+
+    def test_rollup_same_results(self):
+        self.client.force_authenticate(self.user)
+        for params in [
+            {"org_unit_validation_status": "VALID,NEW", "limit": 10},
+            {"parent_org_unit_id": 4, "limit": 10, "org_unit_validation_status": "VALID,NEW"},
+            {"org_unit_type_ids": self.org_unit_type_aire_sante.id, "period": "202001"},
+        ]:
+            expected = self.assertJSONResponse(self.client.get("/api/v2/completeness_stats/", params), 200)
+            CompletenessRollup.objects.refresh()
+            with override_settings(COMPLETENESS_STATS_USE_ROLLUP=True):
+                response = self.client.get("/api/v2/completeness_stats/", params)
+            self.assertEqual(self.assertJSONResponse(response, 200), expected, params)
+
+    def test_query_count_does_not_depend_on_page_size(self):
+        """Benchmark of the number of queries per page size: children and shapes are fetched for the whole page"""
+        self.client.force_authenticate(self.user)
+        query_counts = {}
+        for limit in [1, 2]:
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.get(
+                    "/api/v2/completeness_stats/",
+                    {"org_unit_type_ids": self.org_unit_type_district.id, "limit": limit},
+                )
+            self.assertEqual(len(self.assertJSONResponse(response, 200)["results"]), limit)
+            query_counts[limit] = len(context.captured_queries)
+        self.assertEqual(len(set(query_counts.values())), 1, query_counts)
+
+        query_counts = {}
+        for org_unit_type in [self.org_unit_type_country, self.org_unit_type_district]:  # 1 and 2 rows with a shape
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.get(
+                    "/api/v2/completeness_stats/",
+                    {"org_unit_type_ids": org_unit_type.id, "as_location": True},
+                )
+            self.assertJSONResponse(response, 200)
+            query_counts[org_unit_type.name] = len(context.captured_queries)
+        self.assertEqual(len(set(query_counts.values())), 1, query_counts)
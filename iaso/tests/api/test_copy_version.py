@@ -1,6 +1,6 @@
 from beanstalk_worker.services import TestTaskService
 from iaso.test import APITestCase
-from ...models import OrgUnit, OrgUnitType, Account, Project, SourceVersion, DataSource, Task
+from ...models import OrgUnit, OrgUnitType, Account, Project, SourceVersion, DataSource, Task, Group, GroupSet
 
 
 class CopyVersionTestCase(APITestCase):
@@ -139,3 +139,48 @@ class CopyVersionTestCase(APITestCase):
         self.assertEqual(response.status_code, 200)
         body = response.json()
         self.assertEqual(body["status"], "KILLED")
+
+    def test_copy_version_hierarchy_and_groups(self):
+        """The parents, paths, groups and group sets of the copies point to the copies"""
+        old_version = SourceVersion.objects.get(number=1, data_source=self.source)
+        myagi = OrgUnit.objects.get(version=old_version, name="Myagi")
+        daniel = OrgUnit.objects.create(version=old_version, name="Daniel", parent=myagi, source_ref="balance")
+        robby = OrgUnit.objects.create(version=old_version, name="Robby", parent=daniel)
+        group = Group.objects.create(name="Miyagi-Do", source_version=old_version)
+        group.org_units.set([daniel, robby])
+        group_set = GroupSet.objects.create(name="Dojos", source_version=old_version)
+        group_set.groups.add(group)
+
+        self.client.force_authenticate(self.johnny)
+        data = {
+            "source_source_id": self.source.id,
+            "destination_source_id": self.source.id,
+            "source_version_number": 1,
+            "destination_version_number": 2,
+        }
+        response = self.client.post("/api/copyversion/", data=data, format="json")
+        self.assertEqual(response.status_code, 200)
+        TestTaskService().run_all()
+
+        task = Task.objects.get(id=response.json()["task"]["id"])
+        self.assertEqual(task.status, "SUCCESS")
+        self.assertEqual(task.progress_message, "3 copied")
+
+        new_myagi, new_daniel, new_robby = [
+            OrgUnit.objects.get(version=self.new_version, name=name) for name in ["Myagi", "Daniel", "Robby"]
+        ]
+        self.assertIsNone(new_myagi.parent)
+        self.assertEqual(new_daniel.parent, new_myagi)
+        self.assertEqual(new_robby.parent, new_daniel)
+        self.assertEqual(new_daniel.source_ref, "balance")
+        self.assertEqual(str(new_robby.path), f"{new_myagi.id}.{new_daniel.id}.{new_robby.id}")
+
+        new_group = Group.objects.get(source_version=self.new_version)
+        self.assertNotEqual(new_group.id, group.id)
+        self.assertEqual(new_group.name, "Miyagi-Do")
+        self.assertQuerysetEqual(new_group.org_units.order_by("id"), [new_daniel, new_robby])
+        new_group_set = GroupSet.objects.get(source_version=self.new_version)
+        self.assertQuerysetEqual(new_group_set.groups.all(), [new_group])
+        # the source version is untouched
+        self.assertQuerysetEqual(group.org_units.order_by("id"), [daniel, robby])
+        self.assertEqual(OrgUnit.objects.filter(version=old_version).count(), 3)
@@ -1,6 +1,7 @@
 from copy import deepcopy
 
-from hat.audit.models import log_modification
+from hat.audit.models import INSTANCE_API, ModificationBlob, log_modification
+from hat.audit.writer import AuditWriter
 from iaso import models as m
 from iaso.test import APITestCase
 
@@ -192,3 +193,31 @@ class LogsAPITestCase(APITestCase):
         self.client.force_authenticate(user_superuser)
         response = self.client.get(f"/api/logs/{modification.id}/")
         self.assertJSONResponse(response, 200)
+
+    def test_blob_values_resolved(self):
+        """The large values stored as blobs by the audit writer are returned in full by the logs API"""
+        self.jane.is_superuser = True
+        self.jane.save()
+        self.client.force_authenticate(self.jane)
+        answers = {f"question_{i}": "answer" * 10 for i in range(50)}
+        instance = self.create_form_instance(form=self.reference_form, json=answers)
+        original = deepcopy(instance)
+        instance.json = {**answers, "question_0": "updated"}
+        instance.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            AuditWriter(async_mode=False).log(original, instance, source=INSTANCE_API, user=self.jane)
+        self.assertEqual(ModificationBlob.objects.count(), 2)
+
+        response = self.client.get(
+            "/api/logs/",
+            {"fields": "new_value,past_value,field_diffs", "contentType": "iaso.instance", "objectId": instance.id},
+        )
+        log_entry = self.assertJSONResponse(response, 200)["list"][0]
+        self.assertEqual(log_entry["past_value"][0]["fields"]["json"], answers)
+        self.assertEqual(log_entry["new_value"][0]["fields"]["json"], instance.json)
+        # the whole snapshot is kept for the submission history
+        self.assertEqual(log_entry["new_value"][0]["fields"]["form"], self.reference_form.id)
+        self.assertEqual(log_entry["field_diffs"]["modified"]["json"], {"before": answers, "after": instance.json})
+
+        response = self.client.get(f"/api/logs/{log_entry['id']}/")
+        self.assertEqual(self.assertJSONResponse(response, 200)["new_value"][0]["fields"]["json"], instance.json)
@@ -1,7 +1,13 @@
+import gzip
+import json
+from datetime import timedelta
+from unittest import mock
+
 import time_machine
 
 from django.contrib.gis.geos import Polygon, MultiPolygon, Point
 from django.core.cache import cache
+from django.utils import timezone
 
 from iaso.api.query_params import APP_ID, LIMIT, PAGE, IDS
 from iaso.models import (
@@ -12,8 +18,10 @@ from iaso.models import (
     FormVersion,
     Group,
     Instance,
+    MobileOrgUnitSnapshot,
     OrgUnit,
     OrgUnitReferenceInstance,
+    OrgUnitTombstone,
     OrgUnitType,
     Project,
     SourceVersion,
@@ -217,6 +225,242 @@ class MobileOrgUnitAPITestCase(APITestCase):
         self.assertNotIn("previous", j)
         self.assertEqual(len(j["orgUnits"]), 3)
 
+    def test_snapshot_etag(self):
+        self.client.force_authenticate(self.user)
+        response = self.client.get(BASE_URL, data={APP_ID: BASE_APP_ID})
+        self.assertJSONResponse(response, 200)
+        etag = response["ETag"]
+        self.assertEqual(MobileOrgUnitSnapshot.objects.filter(project=self.project).count(), 1)
+
+        response = self.client.get(BASE_URL, data={APP_ID: BASE_APP_ID}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # the roots are added per user, they are part of the ETag but not of the snapshot
+        self.user.iaso_profile.org_units.set([self.goku])
+        response = self.client.get(BASE_URL, data={APP_ID: BASE_APP_ID}, HTTP_IF_NONE_MATCH=etag)
+        j = self.assertJSONResponse(response, 200)
+        self.assertEqual([self.goku.id], j["roots"])
+        self.assertNotEqual(etag, response["ETag"])
+        self.assertEqual(MobileOrgUnitSnapshot.objects.filter(project=self.project).count(), 1)
+
+    def test_snapshot_rebuilt_when_org_units_change(self):
+        self.client.force_authenticate(self.user)
+        response = self.client.get(BASE_URL, data={APP_ID: BASE_APP_ID})
+        etag = response["ETag"]
+
+        self.bardock.name = "Bardock Sr"
+        self.bardock.save()
+        response = self.client.get(BASE_URL, data={APP_ID: BASE_APP_ID}, HTTP_IF_NONE_MATCH=etag)
+        j = self.assertJSONResponse(response, 200)
+        self.assertEqual(j["orgUnits"][0]["name"], "Bardock Sr")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.group_2.org_units.remove(self.bardock)
+        self.assertFalse(MobileOrgUnitSnapshot.objects.filter(project=self.project).exists())
+        response = self.client.get(BASE_URL, data={APP_ID: BASE_APP_ID})
+        j = self.assertJSONResponse(response, 200)
+        self.assertEqual(j["orgUnits"][0]["groups"], [])
+
+    def test_snapshot_rebuilt_once(self):
+        self.client.force_authenticate(self.user)
+        response = self.client.get(BASE_URL, data={APP_ID: BASE_APP_ID})
+        snapshot = MobileOrgUnitSnapshot.objects.get(project=self.project)
+        MobileOrgUnitSnapshot.objects.filter(id=snapshot.id).update(fingerprint="stale")
+
+        # a concurrent request rebuilds the snapshot while this one waits for the lock
+        def rebuilt_meanwhile(project, key):
+            MobileOrgUnitSnapshot.objects.filter(id=snapshot.id).update(fingerprint=snapshot.fingerprint)
+
+        with mock.patch.object(MobileOrgUnitSnapshot, "lock", side_effect=rebuilt_meanwhile) as lock:
+            with mock.patch.object(MobileOrgUnitSnapshot, "store") as store:
+                second_response = self.client.get(BASE_URL, data={APP_ID: BASE_APP_ID})
+        lock.assert_called_once_with(self.project, snapshot.key)
+        store.assert_not_called()
+        self.assertEqual(self.assertJSONResponse(second_response, 200), self.assertJSONResponse(response, 200))
+
+    def test_snapshot_gzip(self):
+        self.client.force_authenticate(self.user)
+        plain = self.client.get(BASE_URL, data={APP_ID: BASE_APP_ID, LIMIT: 2, PAGE: 1})
+        response = self.client.get(BASE_URL, data={APP_ID: BASE_APP_ID, LIMIT: 2, PAGE: 1}, HTTP_ACCEPT_ENCODING="gzip")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        plain_json = self.assertJSONResponse(plain, 200)
+        self.assertEqual(json.loads(gzip.decompress(response.content)), plain_json)
+        self.assertEqual([self.raditz.id, self.goku.id], plain_json["roots"])
+
+    @mock.patch("iaso.api.mobile.org_units.STREAM_CHUNK_SIZE", 100)
+    def test_snapshot_streaming_response(self):
+        self.client.force_authenticate(self.user)
+        plain = self.client.get(BASE_URL, data={APP_ID: BASE_APP_ID}, HTTP_ACCEPT_ENCODING="gzip")
+        response = self.client.get(BASE_URL, data={APP_ID: BASE_APP_ID})
+
+        self.assertTrue(response.streaming)
+        self.assertEqual(self.assertJSONResponse(response, 200), json.loads(gzip.decompress(plain.content)))
+
+    def test_snapshot_stream(self):
+        content = b'{"orgUnits":[' + b",".join(b'{"id":%d}' % i for i in range(1000)) + b"]"
+        snapshot = MobileOrgUnitSnapshot.store(self.project, "key", "fingerprint", [content[:10], content[10:]])
+
+        chunks = list(snapshot.stream(b"}", chunk_size=1000))
+        self.assertTrue(all(len(chunk) <= 1000 for chunk in chunks))
+        self.assertEqual(b"".join(chunks), content + b"}")
+        self.assertEqual(snapshot.render(b"}"), content + b"}")
+
+    def test_snapshot_pruned(self):
+        store = MobileOrgUnitSnapshot.store
+        store(self.project, "all-10-1-", "old", [b"{"], audience="all-")
+        store(self.project, "all-10-2-", "old", [b"{"], audience="all-")
+        store(self.project, "roots:1-10-1-", "other", [b"{"], audience="roots:1-")
+        abandoned = store(self.project, "roots:2-10-1-", "other", [b"{"], audience="roots:2-")
+        MobileOrgUnitSnapshot.objects.filter(id=abandoned.id).update(created_at=timezone.now() - timedelta(days=31))
+
+        store(self.project, "all-10-1-", "new", [b"{"], audience="all-")
+
+        snapshots = MobileOrgUnitSnapshot.objects.filter(project=self.project).order_by("key")
+        self.assertEqual(
+            [(s.key, s.fingerprint) for s in snapshots], [("all-10-1-", "new"), ("roots:1-10-1-", "other")]
+        )
+
+    def test_compact(self):
+        self.client.force_authenticate(self.user)
+        response = self.client.get(BASE_URL, data={APP_ID: BASE_APP_ID, "compact": "true"})
+        j = self.assertJSONResponse(response, 200)
+        self.assertEqual([self.raditz.id, self.goku.id], j["roots"])
+        self.assertEqual(len(j["orgUnits"]), 1)
+        columns = j["orgUnits"][0]
+        self.assertEqual(columns["name"], ["Bardock", "Raditz", "Son Gohan", "Son Goten"])
+        self.assertNotIn("org_unit_type_name", columns)
+        ids = [self.bardock.id, self.raditz.id, self.gohan.id, self.goten.id]
+        self.assertEqual(columns["id"], [ids[0]] + [b - a for a, b in zip(ids, ids[1:])])
+        self.assertEqual(columns["parent_id"], [None, self.bardock.id, None, None])
+        self.assertEqual(j["orgUnitTypes"][str(columns["org_unit_type_id"][0])], self.bardock.org_unit_type.name)
+
+    def test_changes_since_last_sync(self):
+        self.client.force_authenticate(self.user)
+        last_sync = timezone.now()
+        self.bardock.name = "Bardock Sr"
+        self.bardock.save()
+        self.goten.validation_status = OrgUnit.VALIDATION_REJECTED
+        self.goten.save()
+
+        response = self.client.get(BASE_URL, data={APP_ID: BASE_APP_ID, "last_sync": last_sync.isoformat()})
+        j = self.assertJSONResponse(response, 200)
+        self.assertEqual([org_unit["name"] for org_unit in j["orgUnits"]], ["Bardock Sr"])
+        self.assertEqual(j["deleted"], [self.goten.id])
+        self.assertEqual([self.raditz.id, self.goku.id], j["roots"])
+        self.assertLess(j["sync_cursor"], timezone.now().isoformat())
+
+        next_sync = (timezone.now() + timedelta(minutes=1)).isoformat()
+        response = self.client.get(BASE_URL, data={APP_ID: BASE_APP_ID, "last_sync": next_sync})
+        j = self.assertJSONResponse(response, 200)
+        self.assertEqual(j["orgUnits"], [])
+        self.assertEqual(j["deleted"], [])
+
+    def test_changes_since_last_sync_deleted(self):
+        self.client.force_authenticate(self.user)
+        last_sync = timezone.now()
+        goten_id = self.goten.id
+        self.goten.delete()
+
+        response = self.client.get(BASE_URL, data={APP_ID: BASE_APP_ID, "last_sync": last_sync.isoformat()})
+        j = self.assertJSONResponse(response, 200)
+        self.assertFalse(j["full_resync"])
+        self.assertEqual(j["deleted"], [goten_id])
+
+    def test_changes_since_last_sync_group_membership(self):
+        self.client.force_authenticate(self.user)
+        last_sync = timezone.now()
+        group = Group.objects.create(name="Saiyans", source_version=self.sw_version_2)
+        group.org_units.add(self.goku)
+        self.group_2.org_units.remove(self.bardock)
+
+        response = self.client.get(BASE_URL, data={APP_ID: BASE_APP_ID, "last_sync": last_sync.isoformat()})
+        org_units = {org_unit["id"]: org_unit for org_unit in self.assertJSONResponse(response, 200)["orgUnits"]}
+        self.assertEqual(sorted(org_units), sorted([self.bardock.id, self.goku.id]))
+        self.assertEqual(sorted(org_units[self.goku.id]["groups"]), sorted([self.group_2.id, group.id]))
+        self.assertEqual(org_units[self.bardock.id]["groups"], [])
+
+    def test_org_unit_tombstones(self):
+        goten_id = self.goten.id
+        OrgUnit.objects.filter(id=goten_id).delete()
+        tombstone = OrgUnitTombstone.objects.get(org_unit_id=goten_id)
+        self.assertEqual(tombstone.version_id, self.sw_version_2.id)
+
+        OrgUnitTombstone.objects.prune()
+        self.assertTrue(OrgUnitTombstone.objects.exists())
+        OrgUnitTombstone.objects.update(deleted_at=timezone.now() - timedelta(days=91))
+        OrgUnitTombstone.objects.prune()
+        self.assertFalse(OrgUnitTombstone.objects.exists())
+
+    def test_changes_since_last_sync_full_resync(self):
+        self.client.force_authenticate(self.user)
+        response = self.client.get(BASE_URL, data={APP_ID: BASE_APP_ID})
+        roots_hash = self.assertJSONResponse(response, 200)["roots_hash"]
+        last_sync = timezone.now().isoformat()
+
+        params = {APP_ID: BASE_APP_ID, "last_sync": last_sync, "roots_hash": roots_hash}
+        j = self.assertJSONResponse(self.client.get(BASE_URL, data=params), 200)
+        self.assertFalse(j["full_resync"])
+        self.assertEqual(j["roots_hash"], roots_hash)
+
+        self.user.iaso_profile.org_units.set([self.goku])
+        j = self.assertJSONResponse(self.client.get(BASE_URL, data=params), 200)
+        self.assertTrue(j["full_resync"])
+        self.assertEqual(j["roots"], [self.goku.id])
+        self.assertNotIn("orgUnits", j)
+
+        old_sync = (timezone.now() - timedelta(days=365)).isoformat()
+        j = self.assertJSONResponse(self.client.get(BASE_URL, data={APP_ID: BASE_APP_ID, "last_sync": old_sync}), 200)
+        self.assertTrue(j["full_resync"])
+
+    def test_changes_since_last_sync_invalid(self):
+        self.client.force_authenticate(self.user)
+        response = self.client.get(BASE_URL, data={APP_ID: BASE_APP_ID, "last_sync": "yesterday"})
+        self.assertJSONResponse(response, 400)
+
+    def test_create_org_units(self):
+        self.client.force_authenticate(self.user)
+        data = [
+            {
+                "id": "d7b4b3d5-9e9b-4d2a-8a4b-0f5b7f3c2a11",
+                "name": "Capsule Corp lab",
+                "parent_id": "5f1c4a9e-3f0b-4c55-8b8e-1f0c6f3f6e22",
+                "org_unit_type_id": self.on_earth.id,
+                "latitude": 50.8,
+                "longitude": 4.3,
+                "created_at": 1675099611.938,
+                "updated_at": 1675099611.938,
+            },
+            {
+                "id": "5f1c4a9e-3f0b-4c55-8b8e-1f0c6f3f6e22",
+                "name": "Capsule Corp",
+                "parent_id": str(self.goku.id),
+                "org_unit_type_id": self.super_saiyans.id,
+                "created_at": 1675099600.0,
+                "updated_at": 1675099600.0,
+            },
+        ]
+        response = self.client.post(f"{BASE_URL}?app_id={BASE_APP_ID}", data=data, format="json")
+        j = self.assertJSONResponse(response, 200)
+        self.assertEqual([org_unit["name"] for org_unit in j], ["Capsule Corp", "Capsule Corp lab"])
+
+        capsule_corp = OrgUnit.objects.get(uuid="5f1c4a9e-3f0b-4c55-8b8e-1f0c6f3f6e22")
+        lab = OrgUnit.objects.get(uuid="d7b4b3d5-9e9b-4d2a-8a4b-0f5b7f3c2a11")
+        self.assertEqual(lab.parent, capsule_corp)
+        self.assertEqual(capsule_corp.parent, self.goku)
+        goku_path = OrgUnit.objects.get(id=self.goku.id).path
+        self.assertEqual(str(lab.path), f"{goku_path}.{capsule_corp.id}.{lab.id}")
+        self.assertEqual(lab.validation_status, OrgUnit.VALIDATION_NEW)
+        self.assertEqual(lab.version, self.sw_version_2)
+        self.assertEqual(lab.creator, self.user)
+        self.assertEqual(lab.location.y, 50.8)
+
+        # pushing the same org units again doesn't create duplicates
+        response = self.client.post(f"{BASE_URL}?app_id={BASE_APP_ID}", data=data, format="json")
+        self.assertEqual(self.assertJSONResponse(response, 200), [])
+        self.assertEqual(OrgUnit.objects.filter(uuid__in=[ou["id"] for ou in data]).count(), 2)
+
     def test_boundingbox(self):
         self.client.force_authenticate(self.user)
         response = self.client.get(BOUNDINGXBOX_URL, data={APP_ID: BASE_APP_ID})
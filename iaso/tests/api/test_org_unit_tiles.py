@@ -0,0 +1,107 @@
+from django.contrib.gis.geos import MultiPolygon, Point, Polygon
+from django.core.cache import cache
+
+from iaso import models as m
+from iaso.test import APITestCase
+
+BASE_URL = "/api/orgunits/tiles/"
+
+
+class OrgUnitTilesAPITestCase(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.account = account = m.Account.objects.create(name="Account")
+        cls.project = project = m.Project.objects.create(name="Project", app_id="tiles.project", account=account)
+        source = m.DataSource.objects.create(name="Source")
+        source.projects.add(project)
+        cls.version = version = m.SourceVersion.objects.create(data_source=source, number=1)
+        cls.other_version = m.SourceVersion.objects.create(data_source=source, number=2)
+        account.default_version = version
+        account.save()
+        cls.district = district = m.OrgUnitType.objects.create(name="District")
+        cls.health_facility = health_facility = m.OrgUnitType.objects.create(name="Health facility")
+        project.unit_types.add(district, health_facility)
+
+        cls.district_ou = m.OrgUnit.objects.create(
+            name="District",
+            org_unit_type=district,
+            version=version,
+            validation_status=m.OrgUnit.VALIDATION_VALID,
+            simplified_geom=MultiPolygon(Polygon([(4, 50), (4, 51), (5, 51), (4, 50)])),
+        )
+        cls.health_facility_ou = m.OrgUnit.objects.create(
+            name="Health facility",
+            org_unit_type=health_facility,
+            parent=cls.district_ou,
+            version=version,
+            validation_status=m.OrgUnit.VALIDATION_VALID,
+            location=Point(4.5, 50.5, 100),
+        )
+        cls.user = cls.create_user_with_profile(username="user", account=account, permissions=["iaso_org_units"])
+
+    def setUp(self):
+        cache.clear()
+
+    def assertTile(self, response, empty):
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "application/vnd.mapbox-vector-tile")
+        self.assertEqual(response.content == b"", empty)
+
+    def test_tile(self):
+        self.client.force_authenticate(self.user)
+
+        self.assertTile(self.client.get(f"{BASE_URL}0/0/0.mvt"), empty=False)
+        # The org units are in the tile 8/131/86, not in the top left corner of the world
+        self.assertTile(self.client.get(f"{BASE_URL}8/131/86.mvt"), empty=False)
+        self.assertTile(self.client.get(f"{BASE_URL}8/0/0.mvt"), empty=True)
+
+    def test_filters(self):
+        self.client.force_authenticate(self.user)
+
+        response = self.client.get(f"{BASE_URL}0/0/0.mvt", {"orgUnitTypeId": f"{self.district.id}"})
+        self.assertTile(response, empty=False)
+        response = self.client.get(f"{BASE_URL}0/0/0.mvt", {"version_id": self.other_version.id})
+        self.assertTile(response, empty=True)
+        response = self.client.get(f"{BASE_URL}0/0/0.mvt", {"validation_status": m.OrgUnit.VALIDATION_REJECTED})
+        self.assertTile(response, empty=True)
+
+    def test_invalid_params(self):
+        self.client.force_authenticate(self.user)
+
+        self.assertEqual(self.client.get(f"{BASE_URL}1/2/0.mvt").status_code, 404)
+        self.assertEqual(self.client.get(f"{BASE_URL}0/0/0.mvt", {"orgUnitTypeId": "a,b"}).status_code, 400)
+
+    def test_other_account(self):
+        other_account = m.Account.objects.create(name="Other account")
+        other_user = self.create_user_with_profile(
+            username="other", account=other_account, permissions=["iaso_org_units"]
+        )
+        self.client.force_authenticate(other_user)
+
+        self.assertTile(self.client.get(f"{BASE_URL}0/0/0.mvt"), empty=True)
+
+    def test_without_permission(self):
+        no_permission = self.create_user_with_profile(username="no_permission", account=self.account)
+        self.client.force_authenticate(no_permission)
+
+        self.assertEqual(self.client.get(f"{BASE_URL}0/0/0.mvt").status_code, 403)
+
+    def test_anonymous(self):
+        self.assertEqual(self.client.get(f"{BASE_URL}0/0/0.mvt").status_code, 401)
+        self.assertEqual(self.client.get(f"{BASE_URL}0/0/0.mvt", {"app_id": "unknown"}).status_code, 401)
+        self.assertTile(self.client.get(f"{BASE_URL}0/0/0.mvt", {"app_id": "tiles.project"}), empty=False)
+
+        self.project.needs_authentication = True
+        self.project.save()
+        self.assertEqual(self.client.get(f"{BASE_URL}0/0/0.mvt", {"app_id": "tiles.project"}).status_code, 401)
+
+    def test_tile_across_the_antimeridian(self):
+        """The tile bounds are compared in geometry, a geography box of a whole hemisphere is not a box"""
+        self.client.force_authenticate(self.user)
+        self.health_facility_ou.location = Point(179.9, -16.5, 0)
+        self.health_facility_ou.save()
+
+        response = self.client.get(f"{BASE_URL}1/1/1.mvt", {"orgUnitTypeId": f"{self.health_facility.id}"})
+        self.assertTile(response, empty=False)
+        response = self.client.get(f"{BASE_URL}1/0/1.mvt", {"orgUnitTypeId": f"{self.health_facility.id}"})
+        self.assertTile(response, empty=True)
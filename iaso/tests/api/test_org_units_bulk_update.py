@@ -336,6 +336,68 @@ class OrgUnitsBulkUpdateAPITestCase(APITestCase):
 
         self.assertEqual(5, am.Modification.objects.count())
 
+    @tag("iaso_only")
+    def test_org_unit_bulkupdate_by_chunks(self):
+        """POST /orgunits/bulkupdate/ with chunk_size: each chunk is committed with bulk queries"""
+        self.client.force_authenticate(self.yoda)
+        response = self.client.post(
+            f"/api/tasks/create/orgunitsbulkupdate/",
+            data={
+                "select_all": True,
+                "validation_status": m.OrgUnit.VALIDATION_REJECTED,
+                "unselected_ids": [self.jedi_council_brussels.pk, self.jedi_council_endor.pk],
+                "groups_added": [self.another_group.pk],
+                "groups_removed": [self.elite_group.pk],
+                "chunk_size": 2,
+            },
+            format="json",
+        )
+        self.assertJSONResponse(response, 201)
+        task = self.assertValidTaskAndInDB(response.json()["task"], status="QUEUED", name="org_unit_bulk_update")
+
+        task = self.runAndValidateTask(task, "SUCCESS")
+
+        self.assertEqual(task.progress_value, 3)
+        self.assertEqual(task.end_value, 3)
+        self.assertIn("last_id", task.checkpoint)
+        self.jedi_council_corruscant.refresh_from_db()
+        self.assertEqual(self.jedi_council_corruscant.validation_status, m.OrgUnit.VALIDATION_REJECTED)
+        self.assertNotIn(self.elite_group, self.jedi_council_corruscant.groups.all())
+        self.assertIn(self.another_group, self.jedi_council_corruscant.groups.all())
+        for jedi_council in [self.jedi_council_endor, self.jedi_council_brussels]:
+            jedi_council.refresh_from_db()
+            self.assertEqual(jedi_council.validation_status, m.OrgUnit.VALIDATION_VALID)
+            self.assertNotIn(self.another_group, jedi_council.groups.all())
+
+        self.assertEqual(3, am.Modification.objects.count())
+        modification = am.Modification.objects.get(object_id=self.jedi_council_corruscant.pk)
+        self.assertEqual(am.ORG_UNIT_API_BULK, modification.source)
+        self.assertEqual(self.yoda, modification.user)
+        self.assertEqual(m.OrgUnit.VALIDATION_VALID, modification.past_value[0]["fields"]["validation_status"])
+        self.assertEqual(m.OrgUnit.VALIDATION_REJECTED, modification.new_value[0]["fields"]["validation_status"])
+
+    @tag("iaso_only")
+    def test_org_unit_bulkupdate_by_chunks_resume(self):
+        """A requeued chunked task skips the org units before its checkpoint"""
+
+        self.client.force_authenticate(self.yoda)
+        response = self.client.post(
+            f"/api/tasks/create/orgunitsbulkupdate/",
+            data={"select_all": True, "validation_status": m.OrgUnit.VALIDATION_REJECTED, "chunk_size": 1},
+            format="json",
+        )
+        self.assertJSONResponse(response, 201)
+        task = Task.objects.get(id=response.json()["task"]["id"])
+        ids = sorted(m.OrgUnit.objects.filter_for_user_and_app_id(self.yoda, None).values_list("id", flat=True))
+        task.checkpoint = {"last_id": ids[1]}
+        task.save()
+
+        self.runAndValidateTask(task, "SUCCESS")
+
+        self.assertEqual(len(ids) - 2, am.Modification.objects.count())
+        for org_unit in m.OrgUnit.objects.filter(id__in=ids[:2]):
+            self.assertEqual(org_unit.validation_status, m.OrgUnit.VALIDATION_VALID)
+
     def test_task_kill(self):
         """Launch the task and then kill it
         Note this actually doesn't work if it's killwed while in the transaction part.
@@ -308,6 +308,37 @@ class OrgUnitsBulkUpdateAPITestCase(APITestCase):
             self.chewy.iaso_profile.user_roles.all(),
         )
 
+    def test_profile_bulkupdate_select_some_by_chunks(self):
+        """POST /api/tasks/create/profilesbulkupdate/ with chunk_size: each chunk is committed with bulk queries"""
+        self.client.force_authenticate(self.yoda)
+        operation_payload = {
+            "select_all": False,
+            "selected_ids": [self.luke.iaso_profile.pk, self.chewy.iaso_profile.pk],
+            "language": "fr",
+            "location_ids_added": [self.jedi_council_corruscant.pk],
+            "location_ids_removed": [self.jedi_council_endor.pk],
+            "projects_ids_added": [self.project.pk, self.project_3.pk],
+            "projects_ids_removed": [self.project_2.pk],
+            "roles_id_added": [self.user_role.pk],
+            "roles_id_removed": [self.user_role_2.pk],
+            "chunk_size": 1,
+        }
+        response = self.client.post(f"/api/tasks/create/profilesbulkupdate/", data=operation_payload, format="json")
+
+        self.assertJSONResponse(response, 201)
+        task = self.assertValidTaskAndInDB(response.json()["task"], status="QUEUED", name="profiles_bulk_update")
+
+        task = self.runAndValidateTask(task, "SUCCESS")
+        self.assertEqual(task.progress_value, 2)
+
+        for user in [self.luke, self.chewy]:
+            profile = m.Profile.objects.get(user=user)
+            self.assertEqual(profile.language, "fr")
+            self.assertEqual(list(profile.org_units.all()), [self.jedi_council_corruscant])
+            self.assertEqual(list(profile.projects.all()), [self.project])
+            self.assertEqual(list(profile.user_roles.all()), [self.user_role])
+        self.assertEqual(2, am.Modification.objects.filter(source=am.PROFILE_API_BULK).count())
+
     @tag("iaso_only")
     def test_profile_bulkupdate_user_managed_cannot_add_projects(self):
         """POST /api/tasks/create/profilesbulkupdate/ cannot add projects as user manager"""
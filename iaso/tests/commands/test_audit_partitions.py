@@ -0,0 +1,68 @@
+import csv
+import gzip
+import os
+import tempfile
+from datetime import datetime, timezone
+from io import StringIO
+
+from django.contrib.contenttypes.models import ContentType
+from django.core import management
+from django.db import connection
+
+from hat.audit import partitions
+from hat.audit.models import Modification
+from iaso import models as m
+from iaso.test import TestCase
+
+
+class AuditPartitionsTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.org_unit = m.OrgUnit.objects.create(name="Org unit")
+        cls.modification = Modification.objects.create(
+            content_type=ContentType.objects.get_for_model(m.OrgUnit),
+            object_id=cls.org_unit.id,
+            past_value=[],
+            new_value=[],
+            source="test",
+        )
+
+    def test_create(self):
+        names = [partition.name for partition in partitions.list_partitions()]
+        self.assertEqual(names[0], "audit_modification_legacy")
+        self.assertEqual(names[-1], "audit_modification_default")
+
+        now = datetime.now(timezone.utc)
+        management.call_command("audit_partitions", "create", months=6, stdout=StringIO())
+        last = partitions.list_partitions()[-2]
+        self.assertEqual(last.name, f"audit_modification_p{partitions.add_months(now, 6):%Y%m}")
+        self.assertEqual(partitions.create_partitions(6), [])
+
+    def test_create_moves_default_rows(self):
+        last = partitions.list_partitions()[-2]
+        created_at = partitions.add_months(last.end, 2)
+        Modification.objects.filter(id=self.modification.id).update(created_at=created_at)
+        self.assertEqual(self.count_rows("audit_modification_default"), 1)
+
+        partitions.create_partitions(0, now=created_at)
+        self.assertEqual(self.count_rows("audit_modification_default"), 0)
+        self.assertEqual(self.count_rows(f"audit_modification_p{created_at:%Y%m}"), 1)
+        self.assertEqual(Modification.objects.get().created_at, created_at)
+
+    def count_rows(self, table):
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT count(*) FROM {table}")
+            return cursor.fetchone()[0]
+
+    def test_archive(self):
+        detached = partitions.detach_partitions(before=partitions.add_months(datetime.now(timezone.utc), 1))
+        self.assertEqual(detached, ["audit_modification_legacy"])
+        self.assertFalse(Modification.objects.exists())
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = partitions.archive_partition("audit_modification_legacy", directory)
+            self.assertEqual(os.path.basename(path), "audit_modification_legacy.csv.gz")
+            with gzip.open(path, "rt") as archive:
+                rows = list(csv.DictReader(archive))
+        self.assertEqual([row["object_id"] for row in rows], [str(self.org_unit.id)])
+        self.assertEqual(partitions.list_detached_partitions(), [])
@@ -1,9 +1,10 @@
 from pathlib import Path
 
+import fiona  # type: ignore
 from django.contrib.gis.geos import MultiPolygon, Point, Polygon
 
 from iaso import models as m
-from iaso.gpkg.export_gpkg import org_units_to_gpkg_bytes, source_to_gpkg
+from iaso.gpkg.export_gpkg import export_org_units_to_gpkg, org_units_to_gpkg_bytes, source_to_gpkg
 from iaso.gpkg.import_gpkg import import_gpkg_file
 from iaso.test import TestCase
 
@@ -129,3 +130,29 @@ class GPKGExport(TestCase):
 
         self.assertEqual(orgs.count(), 2)
         org_units_to_gpkg_bytes(orgs)
+
+    def test_export_layers(self):
+        """Rows are written per chunk, a layer may be spread over several chunks"""
+        m.OrgUnit.objects.create(
+            name="ou4", version=self.version, org_unit_type=m.OrgUnitType.objects.get(name="type2")
+        )
+        export_org_units_to_gpkg(self.filename, self.version.orgunit_set.all(), chunk_size=1)
+
+        self.assertEqual(fiona.listlayers(self.filename), ["level-2-type1", "level-4-type2", "level-999-Unknown"])
+        with fiona.open(self.filename, layer="level-4-type2") as layer:
+            records = list(layer)
+        rows = [record["properties"] for record in records]
+        geometry_types = [record["geometry"]["type"] if record["geometry"] else None for record in records]
+        ou1 = m.OrgUnit.objects.get(name="ou1")
+        ou2 = m.OrgUnit.objects.get(name="ou2")
+        group1 = m.Group.objects.get(name="group1")
+        self.assertEqual([row["name"] for row in rows], ["ou2", "ou4"])
+        self.assertEqual(geometry_types, ["MultiPolygon", None])
+        self.assertEqual(rows[0]["id"], ou2.id)
+        self.assertEqual(rows[0]["ref"], f"iaso#{ou2.id}")
+        self.assertEqual(rows[0]["parent"], "ou1 (type1)")
+        self.assertEqual(rows[0]["parent_ref"], ou1.source_ref)
+        self.assertEqual(rows[0]["group_refs"], f"iaso#{group1.id}, my_group_ref")
+        self.assertEqual(rows[0]["group_names"], "group1, group2")
+        self.assertIsNone(rows[1]["parent_ref"])
+        self.assertIsNone(rows[1]["group_refs"])
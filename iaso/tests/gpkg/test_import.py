@@ -371,3 +371,86 @@ class GPKGImportSimplifiedGroup(TestCase):
                 validation_status="new",
                 description="",
             )
+
+
+class GPKGBulkImport(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.account = Account.objects.create(name="a")
+        cls.project = Project.objects.create(name="Project 1", account=cls.account, app_id="test_app_id")
+
+    def test_minimal_import(self):
+        import_gpkg_file(
+            "./iaso/tests/fixtures/gpkg/minimal.gpkg",
+            project_id=self.project.id,
+            source_name="test",
+            version_number=1,
+            validation_status="new",
+            description="",
+            bulk=True,
+        )
+        self.assertEqual(OrgUnit.objects.all().count(), 3)
+        self.assertEqual(Group.objects.all().count(), 2)
+        self.assertEqual(3, Modification.objects.filter(content_type__model="orgunit").count())
+
+        root = OrgUnit.objects.get(parent=None)
+        self.assertEqual(root.name, "District Betare Oya")
+        self.assertEqual(str(root.path), f"{root.pk}")
+        c = root.orgunit_set.get()
+        self.assertEqual(c.name, "AS Tongo Gadima")
+        self.assertEqual(str(c.path), f"{root.pk}.{c.pk}")
+        c2 = c.orgunit_set.get()
+        self.assertEqual(c2.name, "CSI de Garga-Sarali")
+        self.assertEqual(str(c2.path), f"{root.pk}.{c.pk}.{c2.pk}")
+        self.assertEqual(c2.location, Point(13.9993, 5.1795, 0.0, srid=4326))
+        self.assertQuerySetEqual(
+            c2.groups.all().order_by("source_ref"),
+            ["<Group: Group A | test  1 >", "<Group: Group B | test  1 >"],
+            transform=repr,
+        )
+        # the audit records the org units with their parent
+        mod = Modification.objects.get(content_type__model="orgunit", object_id=c2.id)
+        self.assertEqual(mod.past_value, [])
+        self.assertEqual(mod.new_value[0]["fields"]["parent"], c.id)
+
+    def test_modify_existing(self):
+        """Existing org units are moved with their descendants which are not in the GPKG"""
+        source = DataSource.objects.create(name="hey")
+        version = SourceVersion.objects.create(number=2, data_source=source)
+        ou = OrgUnit.objects.create(name="bla", source_ref="cdd3e94c-3c2a-4ab1-8900-be97f82347de", version=version)
+        g = Group.objects.create(source_version=version, source_ref="group_b", name="Previous name of group B")
+        ou.groups.set([g])
+        ou2 = OrgUnit.objects.create(name="bla2", source_ref="3c24c6ca-3012-4d38-abe8-6d620fe1deb8", version=version)
+        child = OrgUnit.objects.create(name="child", version=version, parent=ou2)
+        grandchild = OrgUnit.objects.create(name="grandchild", version=version, parent=child)
+
+        import_gpkg_file(
+            "./iaso/tests/fixtures/gpkg/minimal.gpkg",
+            project_id=self.project.id,
+            source_name="hey",
+            version_number=2,
+            validation_status="new",
+            description="",
+            bulk=True,
+        )
+
+        self.assertEqual(OrgUnit.objects.all().count(), 5)
+        self.assertEqual(3, Modification.objects.filter(content_type__model="orgunit").count())
+        ou.refresh_from_db()
+        self.assertEqual(ou.name, "District Betare Oya")
+        self.assertQuerySetEqual(ou.groups.all(), [])
+        mod = Modification.objects.get(content_type__model="orgunit", object_id=ou.id)
+        self.assertEqual(mod.past_value[0]["fields"]["name"], "bla")
+        self.assertEqual(mod.new_value[0]["fields"]["name"], "District Betare Oya")
+
+        ou2.refresh_from_db()
+        self.assertEqual(ou2.name, "CSI de Garga-Sarali")
+        self.assertEqual(ou2.groups.count(), 2)
+        area = ou2.parent
+        self.assertEqual(area.name, "AS Tongo Gadima")
+        self.assertEqual(area.parent, ou)
+        self.assertEqual(str(ou2.path), f"{ou.pk}.{area.pk}.{ou2.pk}")
+        child.refresh_from_db()
+        grandchild.refresh_from_db()
+        self.assertEqual(str(child.path), f"{ou.pk}.{area.pk}.{ou2.pk}.{child.pk}")
+        self.assertEqual(str(grandchild.path), f"{ou.pk}.{area.pk}.{ou2.pk}.{child.pk}.{grandchild.pk}")
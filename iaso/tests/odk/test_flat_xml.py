@@ -0,0 +1,79 @@
+import glob
+from datetime import datetime
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock
+
+from bs4 import BeautifulSoup as Soup  # type: ignore
+from django.test import SimpleTestCase
+
+from iaso.odk.flat_xml import NO_PLAN, SubmissionPlan, flat_parse_xml, get_submission_plan
+from iaso.utils import extract_form_version_id, flat_parse_xml_soup
+
+PLAN = SubmissionPlan(
+    repeat_groups=frozenset(["hh_repeat", "rep"]),
+    allowed_paths=frozenset(["a", "g/a", "g/h/i", "meta", "meta/instanceID"]),
+)
+
+SUBMISSIONS = [
+    '<?xml version="1.0"?><!-- comment --><data version="1"><a>1</a></data>',
+    '<data version="1"><a>1</a></data><!-- trailing comment -->',
+    '<data version="1"/>',
+    '<data id="x"><a>x<!-- comment -->y</a><b/><c><![CDATA[<z>]]></c></data>',
+    '<?xml version="1.0" encoding="ISO-8859-1"?><data version="1"><a>été</a></data>',
+    '<form version="1"><g><a>1</a><rep><x>1</x><y><z>2</z></y></rep><rep><x>3</x></rep></g><data><q>9</q></data></form>',
+    '<data version="1"><rep/><rep><rep><x>n</x></rep></rep><g><h><i>deep</i></h></g><b>skipped</b></data>',
+    '<data version="1" xmlns:orx="http://openrosa.org/xforms"><orx:meta><orx:instanceID>u</orx:instanceID></orx:meta></data>',
+    '<data version="1"><a>&amp;&lt;&#233;</a><g><a>  spaced  </a></g></data>',
+    "",
+]
+
+
+def parse_with_soup(data: bytes, plan: SubmissionPlan):
+    soup = Soup(StringIO(data.decode("utf-8")), "xml")
+    if not extract_form_version_id(soup):
+        plan = NO_PLAN
+    return flat_parse_xml_soup(soup, list(plan.repeat_groups), plan.allowed_paths)["flat_json"]
+
+
+class FlatXmlTestCase(SimpleTestCase):
+    def test_same_as_soup(self):
+        submissions = [submission.encode("utf-8") for submission in SUBMISSIONS]
+        for path in glob.glob("iaso/tests/fixtures/**/*.xml", recursive=True):
+            with open(path, "rb") as xml_file:
+                submissions.append(xml_file.read())
+
+        for submission in submissions:
+            for plan in (PLAN, NO_PLAN):
+                with self.subTest(submission=submission[:60], plan=plan):
+                    flat_json = flat_parse_xml(submission, lambda version: plan if version else NO_PLAN)["flat_json"]
+                    self.assertEqual(list(flat_json.items()), list(parse_with_soup(submission, plan).items()))
+
+    def test_skipped_paths(self):
+        get_plan = mock.Mock(return_value=PLAN)
+        result = flat_parse_xml(b'<data version="2"><a>1</a><b>2</b><g><c>3</c></g></data>', get_plan)
+
+        get_plan.assert_called_once_with("2")
+        self.assertEqual(result["flat_json"], {"a": "1", "_version": "2"})
+        self.assertEqual(result["skipped_paths"], ["b", "g/c"])
+
+    def test_plan_cache(self):
+        form_version = SimpleNamespace(
+            id=-1,
+            updated_at=datetime(2024, 1, 1),
+            repeat_groups=mock.Mock(return_value=[{"name": "rep", "type": "repeat"}]),
+            questions_by_path=mock.Mock(return_value={"a": {}, "g/b": {}}),
+        )
+        plan = get_submission_plan(form_version, {"meta"})
+        self.assertEqual(plan, SubmissionPlan(frozenset(["rep"]), frozenset(["a", "g/b", "meta"])))
+        self.assertIs(get_submission_plan(form_version, {"meta"}), plan)
+        form_version.questions_by_path.assert_called_once()
+
+        form_version.updated_at = datetime(2024, 1, 2)
+        get_submission_plan(form_version, {"meta"})
+        self.assertEqual(form_version.questions_by_path.call_count, 2)
+
+        # the plan also depends on the paths always allowed
+        plan = get_submission_plan(form_version, {"meta", "instanceID"})
+        self.assertEqual(plan.allowed_paths, frozenset(["a", "g/b", "meta", "instanceID"]))
+        self.assertEqual(form_version.questions_by_path.call_count, 3)
@@ -1,35 +1,19 @@
+import hashlib
+import json
 import os
 import zipfile
 
+from django.core.files.uploadedfile import SimpleUploadedFile, UploadedFile
+from django.http import StreamingHttpResponse
 from django.test import TestCase
 from unittest import mock
 
 from django.contrib.auth.models import User
-from iaso.models import Account, Project, Task, ERRORED, SUCCESS
+from iaso.models import Account, Form, FormAttachment, FormVersion, Project, Task, ERRORED, SUCCESS
 from iaso.tasks.export_mobile_app_setup_for_user import export_mobile_app_setup_for_user
 from iaso.utils.encryption import decrypt_file
 
 
-def mocked_iaso_client_get(*args, **kwargs):
-    url = args[0]
-    if url.startswith("/api/apps/current/"):
-        return {
-            "id": "org.bluesquare.trypelim",
-            "name": "Trypelim",
-            "app_id": "org.bluesquare.trypelim",
-            "feature_flags": [{"name": "Mobile: Show entities screen)", "code": "ENTITY"}],
-            "needs_authentication": True,
-        }
-    elif url.startswith("/api/formversions/"):
-        return {"form_versions": []}
-    elif url.startswith("/api/formattachments/"):
-        return {"results": []}
-    else:
-        print(args)
-        # for all other calls, return an empty array
-        return []
-
-
 def _get_files_in_zipfile(zip_path, zip_name):
     decrypted_file_path = decrypt_file(
         file_path=zip_path,
@@ -38,7 +22,7 @@ def _get_files_in_zipfile(zip_path, zip_name):
         password="supersecret",
     )
     with zipfile.ZipFile(decrypted_file_path, "r") as zip_ref:
-        return zip_ref.namelist()
+        return {name: zip_ref.read(name) for name in zip_ref.namelist()}
 
 
 class ExportMobileAppSetupForUserTest(TestCase):
@@ -53,13 +37,19 @@ class ExportMobileAppSetupForUserTest(TestCase):
             account=Account.objects.first(),
         )
 
-    @mock.patch("iaso.tasks.export_mobile_app_setup_for_user.IasoClient")
-    @mock.patch("boto3.client")
-    def test_export(self, mock_s3_client, MockIasoClient):
-        iaso_client_mock = mock.MagicMock()
-        iaso_client_mock.get.side_effect = mocked_iaso_client_get
-        MockIasoClient.return_value = iaso_client_mock
+        self.form = Form.objects.create(name="Form")
+        self.form.projects.add(self.project)
+        with open("iaso/tests/fixtures/form_rapide_1666691000.xml") as xml_file:
+            FormVersion.objects.create(form=self.form, version_id="1", file=UploadedFile(xml_file))
+        FormAttachment.objects.create(
+            form=self.form,
+            name="logo.png",
+            file=SimpleUploadedFile("logo.png", b"logo"),
+            md5=hashlib.md5(b"logo").hexdigest(),
+        )
 
+    @mock.patch("boto3.client")
+    def test_export(self, mock_s3_client):
         s3_client_mock = mock.MagicMock()
         s3_client_mock.upload_file.return_value = None
         mock_s3_client.return_value = s3_client_mock
@@ -83,17 +73,47 @@ class ExportMobileAppSetupForUserTest(TestCase):
         zip_name = self.task.result["data"].replace("file:export-files/", "")
         folder_name = zip_name.replace(".zip", "")
         zip_path = os.path.join("/tmp", folder_name)
-        # breakpoint()
         created_files = _get_files_in_zipfile(zip_path, zip_name)
         self.assertIn("app.json", created_files)
-        self.assertIn("entities-1.json", created_files)
-        self.assertIn("entitytypes-1.json", created_files)
         self.assertIn("formattachments.json", created_files)
         self.assertIn("forms.json", created_files)
         self.assertIn("formversions.json", created_files)
         self.assertIn("groups.json", created_files)
         self.assertIn("orgunits-1.json", created_files)
         self.assertIn("orgunittypes.json", created_files)
-        self.assertIn("storage-blacklisted.json", created_files)
-        self.assertIn("storage-passwords.json", created_files)
-        self.assertIn("workflows.json", created_files)
+        # the project doesn't have the ENTITY feature flag
+        self.assertNotIn("entities-1.json", created_files)
+
+        # the files are added, and their URLs rewritten to their path in the zip file
+        form_versions = json.loads(created_files["formversions.json"])["form_versions"]
+        self.assertEqual(len(form_versions), 1)
+        self.assertIn(form_versions[0]["file"], created_files)
+        attachments = json.loads(created_files["formattachments.json"])["results"]
+        attachment_path = attachments[0]["file"]
+        self.assertTrue(attachment_path.startswith(f"formattachments/{self.form.id}/logo"))
+        self.assertEqual(created_files[attachment_path], b"logo")
+        manifest = created_files[f"formattachments/{self.form.id}/manifest.xml"].decode()
+        self.assertIn(f"<downloadUrl>{attachment_path}</downloadUrl>", manifest)
+
+    @mock.patch("iaso.api.mobile.org_units.STREAM_CHUNK_SIZE", 1)
+    @mock.patch("boto3.client")
+    def test_export_streamed_org_units(self, mock_s3_client):
+        mock_s3_client.return_value = mock.MagicMock()
+
+        with mock.patch(
+            "iaso.api.mobile.org_units.StreamingHttpResponse", wraps=StreamingHttpResponse
+        ) as streaming_response:
+            export_mobile_app_setup_for_user(
+                user_id=self.user.id,
+                project_id=self.project.id,
+                password="supersecret",
+                task=self.task,
+                _immediate=True,
+            )
+        streaming_response.assert_called()
+
+        self.task.refresh_from_db()
+        self.assertEquals(self.task.status, SUCCESS)
+        zip_name = self.task.result["data"].replace("file:export-files/", "")
+        created_files = _get_files_in_zipfile(os.path.join("/tmp", zip_name.replace(".zip", "")), zip_name)
+        self.assertIn("orgUnits", json.loads(created_files["orgunits-1.json"]))
@@ -0,0 +1,54 @@
+import os
+import tempfile
+import time
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.db.models.fields.files import FieldFile
+from django.test import SimpleTestCase
+from unittest import mock
+
+from iaso.tasks.utils.mobile_app_setup_artifacts import ArtifactCache
+
+
+class ArtifactCacheTest(SimpleTestCase):
+    def setUp(self):
+        self.storage_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.storage = FileSystemStorage(location=self.storage_dir.name)
+        self.cache = ArtifactCache(self.cache_dir.name)
+
+    def tearDown(self):
+        self.storage_dir.cleanup()
+        self.cache_dir.cleanup()
+
+    def field_file(self, name, content):
+        name = self.storage.save(name, ContentFile(content))
+        return FieldFile(None, mock.MagicMock(storage=self.storage), name)
+
+    def test_get_paths(self):
+        form = self.field_file("form.xml", b"<form/>")
+        logo = self.field_file("logo.png", b"logo")
+
+        paths = self.cache.get_paths([("form-1", form), ("logo-md5", logo)])
+        with open(paths[0], "rb") as f:
+            self.assertEqual(f.read(), b"<form/>")
+        with open(paths[1], "rb") as f:
+            self.assertEqual(f.read(), b"logo")
+
+        # Shared by the next exports: the storage is not read again
+        with mock.patch.object(self.storage, "open") as mock_open:
+            self.assertEqual(self.cache.get_paths([("logo-md5", logo), ("form-1", form)]), paths[::-1])
+            mock_open.assert_not_called()
+
+    def test_prune(self):
+        [old_path, recent_path] = self.cache.get_paths(
+            [("old", self.field_file("old.xml", b"old")), ("recent", self.field_file("recent.xml", b"recent"))]
+        )
+        ten_days_ago = time.time() - 10 * 24 * 3600
+        os.utime(old_path, (ten_days_ago, ten_days_ago))
+
+        self.cache.prune(max_age_days=7)
+
+        self.assertFalse(os.path.exists(old_path))
+        self.assertTrue(os.path.exists(recent_path))
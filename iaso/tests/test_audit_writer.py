@@ -0,0 +1,102 @@
+from copy import deepcopy
+from unittest import mock
+
+from django.contrib.gis.geos import MultiPolygon, Polygon
+from django.db import transaction
+
+from hat.audit.models import ORG_UNIT_API_BULK, Modification, ModificationBlob
+from hat.audit.writer import AuditWriter
+from iaso import models as m
+from iaso.test import TestCase
+
+
+class AuditWriterTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.account = m.Account.objects.create(name="Account")
+        cls.user = cls.create_user_with_profile(username="user", account=cls.account)
+        # large enough to be stored as a blob
+        polygon = MultiPolygon(Polygon([(0, 0), *((i / 300, 1) for i in range(300)), (1, 0), (0, 0)]))
+        cls.org_unit = m.OrgUnit.objects.create(name="Before", geom=polygon, simplified_geom=polygon)
+
+    def log_rename(self, writer, name):
+        original = deepcopy(self.org_unit)
+        self.org_unit.name = name
+        self.org_unit.save()
+        writer.log(original, self.org_unit, source=ORG_UNIT_API_BULK, user=self.user)
+
+    def test_diff(self):
+        writer = AuditWriter(async_mode=False)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.log_rename(writer, "After")
+            self.assertEqual(Modification.objects.count(), 0)
+        modification = Modification.objects.get()
+
+        self.assertEqual(modification.object_id, str(self.org_unit.id))
+        self.assertEqual(modification.user, self.user)
+        self.assertEqual(modification.past_value[0]["fields"], {"name": "Before", "updated_at": mock.ANY})
+        self.assertEqual(modification.new_value[0]["fields"], {"name": "After", "updated_at": mock.ANY})
+        self.assertEqual(modification.field_diffs()["modified"]["name"], {"before": "Before", "after": "After"})
+
+    def test_large_values_stored_once(self):
+        writer = AuditWriter(async_mode=False)
+        with self.captureOnCommitCallbacks(execute=True):
+            writer.log(None, self.org_unit, source=ORG_UNIT_API_BULK)
+            writer.log(None, self.org_unit, source=ORG_UNIT_API_BULK)
+
+        self.assertEqual(Modification.objects.count(), 2)
+        blob = ModificationBlob.objects.get()
+        for modification in Modification.objects.all():
+            fields = modification.new_value[0]["fields"]
+            self.assertEqual(fields["geom"], {"$blob": blob.hash})
+            self.assertEqual(fields["simplified_geom"], {"$blob": blob.hash})
+        self.assertIn("MULTIPOLYGON", blob.value)
+
+    def test_flush(self):
+        writer = AuditWriter(async_mode=False, batch_size=2)
+        self.log_rename(writer, "One")
+        self.assertEqual(Modification.objects.count(), 0)
+        self.log_rename(writer, "Two")
+        self.assertEqual(Modification.objects.count(), 2)
+        self.log_rename(writer, "Three")
+        writer.flush()
+        self.assertEqual(Modification.objects.count(), 3)
+
+    def test_rollback(self):
+        writer = AuditWriter(async_mode=False)
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    self.log_rename(writer, "Rolled back")
+                    raise ValueError()
+            except ValueError:
+                pass
+            self.log_rename(writer, "Committed")
+        modification = Modification.objects.get()
+        self.assertEqual(modification.new_value[0]["fields"]["name"], "Committed")
+
+    def test_flush_in_rolled_back_savepoint(self):
+        writer = AuditWriter(async_mode=False, batch_size=2)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.log_rename(writer, "Outer")
+            try:
+                with transaction.atomic():
+                    # the second entry flushes the batch of the savepoint, not the one of the outer transaction
+                    self.log_rename(writer, "Inner one")
+                    self.log_rename(writer, "Inner two")
+                    raise ValueError()
+            except ValueError:
+                pass
+        modification = Modification.objects.get()
+        self.assertEqual(modification.new_value[0]["fields"]["name"], "Outer")
+
+    @mock.patch("hat.audit.writer.write_entries")
+    def test_async(self, write_entries):
+        writer = AuditWriter(async_mode=True)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.log_rename(writer, "After")
+        writer.wait()
+
+        write_entries.assert_called_once()
+        [(modification, _blobs)] = write_entries.call_args[0][0]
+        self.assertEqual(modification.new_value[0]["fields"]["name"], "After")
@@ -7,7 +7,7 @@ from django.core import management
 
 from hat.audit.models import Modification
 from iaso import models as m
-from iaso.models import OrgUnit, Group, GroupSet, Task, Account, DataSource, SUCCESS, Project
+from iaso.models import OrgUnit, Group, GroupSet, Task, Account, DataSource, SUCCESS, RUNNING, Project
 from iaso.tasks.dhis2_ou_importer import dhis2_ou_importer
 from iaso.test import TestCase
 
@@ -314,6 +314,115 @@ class TaskTests(TestCase, DHIS2TestMixin):
         # assert that path has been generated for all org units
         self.assertEqual(0, OrgUnit.objects.filter(path=None).count())
 
+    @responses.activate
+    def test_import_resume(self):
+        """A requeued task resumes in the version of its checkpoint"""
+        self.setup_responses(orgunit_fixture_name="orgunits", groupsets_fixture_name="groupsets")
+        kwargs = dict(
+            source_id=self.source.id,
+            source_version_number=None,
+            force=False,
+            validate=False,
+            continue_on_error=False,
+            url="https://play.dhis2.org/2.30",
+            login="admin",
+            password="district",
+            _immediate=True,
+        )
+        task = Task.objects.create(name="dhis2_ou_importer", launcher=self.user, account=self.account)
+        dhis2_ou_importer(task=task, **kwargs)
+        task.refresh_from_db()
+        version_id = task.checkpoint["source_version_id"]
+
+        # simulate a crash while saving the org units: their transaction is rolled back
+        OrgUnit.objects.filter(version_id=version_id).delete()
+        m.Group.objects.filter(source_version_id=version_id).delete()
+        m.GroupSet.objects.filter(source_version_id=version_id).delete()
+        task.status = RUNNING
+        task.checkpoint = {"source_version_id": version_id}
+        task.save()
+        dhis2_ou_importer(task=task, **kwargs)
+
+        task.refresh_from_db()
+        self.assertEqual(task.status, SUCCESS, task.result)
+        self.assertEqual(self.source.versions.count(), 1)
+        self.assertEqual(OrgUnit.objects.filter(version_id=version_id).count(), 4)
+        healthcenter = OrgUnit.objects.get(version_id=version_id, source_ref="LOpWauwwghf")
+        self.assertEqual(healthcenter.parent.name, "Gorama Mende")
+        self.assertEqual(0, OrgUnit.objects.filter(path=None).count())
+
+    @responses.activate
+    def test_import_resume_group_sets(self):
+        """A task requeued after its org units were saved only imports the group sets, with the existing groups"""
+        self.setup_responses(orgunit_fixture_name="orgunits", groupsets_fixture_name="groupsets")
+        kwargs = dict(
+            source_id=self.source.id,
+            source_version_number=None,
+            force=False,
+            validate=False,
+            continue_on_error=False,
+            url="https://play.dhis2.org/2.30",
+            login="admin",
+            password="district",
+            _immediate=True,
+        )
+        task = Task.objects.create(name="dhis2_ou_importer", launcher=self.user, account=self.account)
+        dhis2_ou_importer(task=task, **kwargs)
+        task.refresh_from_db()
+        version_id = task.checkpoint["source_version_id"]
+        self.assertTrue(task.checkpoint["org_units_saved"])
+        group_ids = sorted(m.Group.objects.filter(source_version_id=version_id).values_list("id", flat=True))
+
+        # simulate a crash while importing the group sets
+        m.GroupSet.objects.filter(source_version_id=version_id).delete()
+        task.status = RUNNING
+        task.save()
+        dhis2_ou_importer(task=task, **kwargs)
+
+        task.refresh_from_db()
+        self.assertEqual(task.status, SUCCESS, task.result)
+        self.assertEqual(m.GroupSet.objects.filter(source_version_id=version_id).count(), 4)
+        self.assertEqual(
+            sorted(m.Group.objects.filter(source_version_id=version_id).values_list("id", flat=True)), group_ids
+        )
+        self.assertEqual(OrgUnit.objects.filter(version_id=version_id).count(), 4)
+
+    @responses.activate
+    def test_update_existing_moved_under_new_parent(self):
+        """An existing org unit moved below an org unit created by the same import gets its path, and its descendants"""
+        self.setup_responses(orgunit_fixture_name="orgunits", groupsets_fixture_name=None)
+
+        version = m.SourceVersion.objects.create(data_source=self.source, number=1)
+        healthcenter = OrgUnit.objects.create(name="Health center", source_ref="LOpWauwwghf", version=version)
+        child = OrgUnit.objects.create(name="Not in DHIS2", source_ref="child", version=version, parent=healthcenter)
+
+        task = Task.objects.create(name="dhis2_ou_importer", launcher=self.user, account=self.account)
+        dhis2_ou_importer(
+            source_id=self.source.id,
+            source_version_number=1,
+            force=False,
+            validate=False,
+            continue_on_error=False,
+            url="https://play.dhis2.org/2.30",
+            login="admin",
+            password="district",
+            update_mode=True,
+            update_existing=True,
+            task=task,
+            _immediate=True,
+        )
+
+        task.refresh_from_db()
+        self.assertEqual(task.status, SUCCESS, task.result)
+        ancestors = [OrgUnit.objects.get(version=version, source_ref=ref) for ref in ["ImspTQPwCqd", "kJq2mPyFEHo"]]
+        chiefdom = OrgUnit.objects.get(version=version, source_ref="KXSqt7jv6DU")
+        healthcenter.refresh_from_db()
+        child.refresh_from_db()
+        self.assertEqual(healthcenter.parent, chiefdom)
+        expected_path = [str(ou.id) for ou in [*ancestors, chiefdom, healthcenter]]
+        self.assertEqual(list(healthcenter.path), expected_path)
+        self.assertEqual(list(child.path), [*expected_path, str(child.id)])
+
     @responses.activate
     def test_update(self):
         """Testfile with Shape with hole and with multi polygon"""
@@ -494,3 +603,46 @@ class TaskTests(TestCase, DHIS2TestMixin):
         self.assertEqual(ou_c.name, "original c")
 
         self.assertEqual(OrgUnit.objects.count(), 4)
+
+    @responses.activate
+    def test_update_existing(self):
+        """With update_existing, the existing org units are updated, but only if they changed in DHIS2"""
+        self.setup_responses(orgunit_fixture_name="orgunits_strange_geom", groupsets_fixture_name=None)
+
+        version = m.SourceVersion.objects.create(data_source=self.source, number=1)
+        OrgUnit.objects.create(name="original c", source_ref="c", version=version)
+        kwargs = dict(
+            source_id=self.source.id,
+            source_version_number=1,
+            force=False,
+            validate=False,
+            continue_on_error=False,
+            url="https://play.dhis2.org/2.30",
+            login="admin",
+            password="district",
+            update_mode=True,
+            update_existing=True,
+            _immediate=True,
+        )
+
+        task = Task.objects.create(name="dhis2_ou_importer", launcher=self.user, account=self.account)
+        dhis2_ou_importer(task=task, **kwargs)
+
+        task.refresh_from_db()
+        self.assertEqual(task.status, SUCCESS, task.result)
+        self.assertEqual(OrgUnit.objects.count(), 4)
+        ou_c = OrgUnit.objects.get(source_ref="c")
+        self.assertEqual(ou_c.name, "Multi 2 polygon with one hole each")
+        self.assertAlmostEqual(ou_c.geom.area, 0.019948936631078506)
+        self.assertEqual(ou_c.groups.count(), 2)
+        self.assertEqual(0, OrgUnit.objects.filter(path=None).count())
+
+        # Nothing changed in DHIS2 since the previous import: nothing is written
+        updated_at = dict(OrgUnit.objects.values_list("source_ref", "updated_at"))
+        task = Task.objects.create(name="dhis2_ou_importer", launcher=self.user, account=self.account)
+        dhis2_ou_importer(task=task, **kwargs)
+
+        task.refresh_from_db()
+        self.assertEqual(task.status, SUCCESS, task.result)
+        self.assertEqual(updated_at, dict(OrgUnit.objects.values_list("source_ref", "updated_at")))
+        self.assertEqual(OrgUnit.objects.count(), 4)
@@ -0,0 +1,179 @@
+import time
+from datetime import timedelta
+from unittest import mock
+
+from django.test import override_settings
+from django.utils import timezone
+
+from beanstalk_worker import task_decorator
+from beanstalk_worker.services import FairShareScheduler, Heartbeat, TestTaskService
+from iaso import models as m
+from iaso.models.base import QUEUED, RUNNING, SUCCESS, ERRORED, HIGH_PRIORITY, LOW_PRIORITY, NORMAL_PRIORITY
+from iaso.test import TestCase
+
+
+@task_decorator(task_name="fake_task")
+def fake_task(task=None):
+    task.report_success("done")
+
+
+@task_decorator(task_name="fake_urgent_task", priority=HIGH_PRIORITY)
+def fake_urgent_task(task=None):
+    task.report_success("done")
+
+
+@task_decorator(task_name="fake_resumable_task", max_attempts=2)
+def fake_resumable_task(task=None):
+    task.report_success(f"resumed from {task.checkpoint}")
+
+
+class TaskServiceTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.account = m.Account.objects.create(name="Account")
+        cls.user = cls.create_user_with_profile(username="user", account=cls.account)
+        cls.other_account = m.Account.objects.create(name="Other account")
+        cls.other_user = cls.create_user_with_profile(username="other_user", account=cls.other_account)
+
+    def test_claim_next_marks_task_running(self):
+        task = fake_task(user=self.user)
+        self.assertEqual(task.status, QUEUED)
+
+        claimed = TestTaskService().claim_next()
+
+        self.assertEqual(claimed.id, task.id)
+        self.assertEqual(claimed.status, RUNNING)
+        self.assertIsNotNone(claimed.started_at)
+        task.refresh_from_db()
+        self.assertEqual(task.status, RUNNING)
+
+    def test_claim_next_never_returns_the_same_task_twice(self):
+        first = fake_task(user=self.user)
+        second = fake_task(user=self.user)
+        task_service = TestTaskService()
+
+        # FIFO: the oldest task is claimed first
+        self.assertEqual(task_service.claim_next().id, first.id)
+        self.assertEqual(task_service.claim_next().id, second.id)
+        self.assertIsNone(task_service.claim_next())
+
+    def test_run_all(self):
+        tasks = [fake_task(user=self.user) for _ in range(3)]
+
+        count = TestTaskService().run_all()
+
+        self.assertEqual(count, 3)
+        for task in tasks:
+            task.refresh_from_db()
+            self.assertEqual(task.status, SUCCESS)
+            self.assertEqual(task.progress_message, "done")
+
+    def test_run_skips_task_not_queued(self):
+        task = fake_task(user=self.user)
+        task.status = RUNNING
+        task.save()
+
+        TestTaskService().run("iaso.tests.test_task_service", "fake_task", task.id, [], {})
+
+        task.refresh_from_db()
+        self.assertEqual(task.status, RUNNING)
+
+    def test_decorator_priority(self):
+        self.assertEqual(fake_task(user=self.user).priority, NORMAL_PRIORITY)
+        self.assertEqual(fake_urgent_task(user=self.user).priority, HIGH_PRIORITY)
+
+    def test_claim_next_follows_priority_weights(self):
+        normal = fake_task(user=self.user)
+        urgent = fake_urgent_task(user=self.user)
+        task_service = TestTaskService()
+
+        task_service.scheduler = FairShareScheduler(weights={HIGH_PRIORITY: 1, NORMAL_PRIORITY: 0})
+        self.assertEqual(task_service.claim_next().id, urgent.id)
+        # only normal tasks are left, they are picked whatever their weight
+        self.assertEqual(task_service.claim_next().id, normal.id)
+
+    def test_claim_next_is_fair_between_accounts(self):
+        # the first account already has a task running and another one queued before the other account's task
+        m.Task.objects.create(account=self.account, launcher=self.user, name="big_bulk_update", status=RUNNING)
+        busy = fake_task(user=self.user)
+        idle = fake_task(user=self.other_user)
+
+        task_service = TestTaskService()
+        self.assertEqual(task_service.claim_next().id, idle.id)
+        self.assertEqual(task_service.claim_next().id, busy.id)
+
+    def test_queue_stats(self):
+        fake_task(user=self.user)
+        fake_urgent_task(user=self.user)
+        low = m.Task.objects.create(account=self.account, name="low", priority=LOW_PRIORITY)
+        task_service = TestTaskService()
+        task_service.scheduler = FairShareScheduler(weights={LOW_PRIORITY: 1, NORMAL_PRIORITY: 0, HIGH_PRIORITY: 0})
+        self.assertEqual(task_service.claim_next().id, low.id)
+
+        stats = task_service.queue_stats()
+
+        self.assertEqual(stats[HIGH_PRIORITY]["queued"]["count"], 1)
+        self.assertEqual(stats[NORMAL_PRIORITY]["queued"]["count"], 1)
+        self.assertNotIn("queued", stats[LOW_PRIORITY])
+        self.assertEqual(stats[LOW_PRIORITY]["started"]["count"], 1)
+        self.assertGreaterEqual(stats[LOW_PRIORITY]["started"]["avg_wait"], 0)
+
+    def test_claim_next_starts_lease(self):
+        fake_task(user=self.user)
+
+        task = TestTaskService().claim_next()
+
+        self.assertEqual(task.attempts, 1)
+        self.assertEqual(task.heartbeat_at, task.started_at)
+
+    def test_report_progress_renews_lease(self):
+        fake_task(user=self.user)
+        task = TestTaskService().claim_next()
+        task.heartbeat_at = timezone.now() - timedelta(hours=2)
+        task.save()
+
+        task.report_progress_and_stop_if_killed(progress_message="working")
+
+        task.refresh_from_db()
+        self.assertGreater(task.heartbeat_at, timezone.now() - timedelta(minutes=1))
+
+    def test_heartbeat_renews_lease(self):
+        # the heartbeat thread has its own connection, which doesn't see the data of the test transaction
+        queryset = mock.Mock()
+        with Heartbeat(queryset, 42, 0.01) as heartbeat:
+            time.sleep(0.1)
+        self.assertFalse(heartbeat.thread.is_alive())
+        queryset.filter.assert_called_with(id=42, status=RUNNING)
+        self.assertGreater(queryset.filter.return_value.update.call_count, 1)
+
+    @override_settings(TASK_LEASE_SECONDS=60)
+    def test_reap_expired_tasks(self):
+        fake_resumable_task(user=self.user)
+        fake_task(user=self.user)
+        alive = fake_task(user=self.user)
+        task_service = TestTaskService()
+        resumable, not_resumable, alive = (
+            task_service.claim_next(),
+            task_service.claim_next(),
+            task_service.claim_next(),
+        )
+        resumable.save_checkpoint({"done": 10})
+        old = timezone.now() - timedelta(minutes=5)
+        m.Task.objects.filter(id__in=[resumable.id, not_resumable.id]).update(heartbeat_at=old)
+
+        self.assertEqual(task_service.reap_expired_tasks(), (1, 1))
+
+        resumable.refresh_from_db()
+        self.assertEqual(resumable.status, QUEUED)
+        not_resumable.refresh_from_db()
+        self.assertEqual(not_resumable.status, ERRORED)
+        self.assertEqual(not_resumable.result["result"], ERRORED)
+        alive.refresh_from_db()
+        self.assertEqual(alive.status, RUNNING)
+
+        # the requeued task is run again with its checkpoint, but only once more
+        self.assertEqual(task_service.run_all(), 1)
+        resumable.refresh_from_db()
+        self.assertEqual(resumable.status, SUCCESS)
+        self.assertEqual(resumable.attempts, 2)
+        self.assertEqual(resumable.progress_message, "resumed from {'done': 10}")
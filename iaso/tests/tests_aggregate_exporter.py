@@ -1,6 +1,8 @@
 import json
 import logging
+import threading
 from collections import namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 import responses
 from django.core.files.uploadedfile import UploadedFile
@@ -60,6 +62,24 @@ def build_form_mapping_quality():
     }
 
 
+class FakeDHIS2Handler(BaseHTTPRequestHandler):
+    """Minimal DHIS2 accepting all the data values, records the posted paths in server.posted"""
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.posted.append(self.path)
+        body = load_dhis2_fixture("datavalues-ok.json") if self.path.endswith("/dataValueSets") else {}
+        content = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
 def dump_attributes(obj):
     logger.debug("----- " + str(obj.__class__))
     for k in obj.__dict__:
@@ -521,7 +541,8 @@ class DataValueExporterTests(TestCase):
             status=200,
         )
 
-        DataValueExporter().export_instances(export_request, continue_on_error=True, page_size=1)
+        # sequential, the mocked responses are returned in the order of the calls
+        DataValueExporter().export_instances(export_request, continue_on_error=True, page_size=1, concurrency=1)
 
         self.assertTrue(responses.assert_call_count("https://dhis2.com/api/dataValueSets", 2))
 
@@ -601,3 +622,67 @@ class DataValueExporterTests(TestCase):
         )
         instance.refresh_from_db()
         self.assertIsNone(instance.last_export_success_at)
+
+    @responses.activate
+    def test_aggregate_export_handle_dhis2_errors_without_description(self):
+        instance = self.build_instance(self.form)
+        mapping_version = MappingVersion(
+            name="aggregate", json=build_form_mapping(), form_version=self.form_version, mapping=self.mapping
+        )
+        mapping_version.save()
+        body = json.dumps({"httpStatus": "Internal Server Error", "status": "ERROR"})
+        responses.add(responses.POST, "https://dhis2.com/api/dataValueSets", body=body, status=500)
+
+        export_request = ExportRequestBuilder().build_export_request(
+            filters={"period_ids": "201801", "form_id": self.form.id, "org_unit_id": instance.org_unit.id},
+            launcher=self.user,
+        )
+        with self.assertRaises(InstanceExportError) as context:
+            DataValueExporter().export_instances(export_request)
+
+        self.expect_logs(ERRORED)
+        self.assertEqual(context.exception.descriptions, [body])
+        instance.refresh_from_db()
+        self.assertIsNone(instance.last_export_success_at)
+
+    def test_aggregate_export_pipeline_against_fake_dhis2(self):
+        self.setUpFormQuality()
+        server = ThreadingHTTPServer(("127.0.0.1", 0), FakeDHIS2Handler)
+        server.posted = []
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.shutdown)
+        ExternalCredentials.objects.update(url=f"http://127.0.0.1:{server.server_port}")
+
+        MappingVersion.objects.create(
+            name="aggregate", json=build_form_mapping(), form_version=self.form_version, mapping=self.mapping
+        )
+        MappingVersion.objects.create(
+            name="aggregate",
+            json=build_form_mapping_quality(),
+            form_version=self.form_quality_version,
+            mapping=self.mapping_quality,
+        )
+        instance = self.build_instance(self.form)
+        instance_quality = self.build_instance(self.form_quality)
+        export_request = ExportRequestBuilder().build_export_request(
+            filters={
+                "period_ids": ",".join(["201801", "2018Q1"]),
+                "form_ids": ",".join([str(self.form.id), str(self.form_quality.id)]),
+                "org_unit_id": instance.org_unit.id,
+            },
+            launcher=self.user,
+        )
+
+        DataValueExporter().export_instances(export_request, page_size=1, concurrency=2)
+
+        self.expect_logs(EXPORTED)
+        self.assertEqual(server.posted.count("/api/dataValueSets"), 2)
+        self.assertEqual(server.posted.count("/api/completeDataSetRegistrations"), 2)
+        for exported in (instance, instance_quality):
+            exported.refresh_from_db()
+            self.assertIsNotNone(exported.last_export_success_at)
+            self.assertFalse(exported.to_export)
+        export_request.refresh_from_db()
+        self.assertEqual(export_request.exported_count, 2)
+        self.assertEqual(export_request.result["metrics"]["pages"], 2)
+        self.assertEqual(ExportStatus.objects.get(instance=instance).export_logs.count(), 2)
@@ -0,0 +1,64 @@
+from django.test import TestCase
+
+from iaso.dhis2.mapping_plan import MappingPlan, get_mapping_plan
+from iaso.models import Form, FormVersion, MappingVersion
+
+
+def build_form_mapping():
+    return {
+        "data_set_id": "DATASET_DHIS2_ID",
+        "question_mappings": {
+            "question1": {"id": "DE_DHIS2_ID", "valueType": "INTEGER", "categoryOptionCombo": "COC_ID"},
+            "question2": {
+                "type": MappingVersion.QUESTION_MAPPING_MULTIPLE,
+                "values": {"a": {"id": "DE_A", "valueType": "BOOLEAN"}, "b": {"id": "DE_B", "valueType": "BOOLEAN"}},
+            },
+            "question3": {"type": MappingVersion.QUESTION_MAPPING_NEVER_MAPPED},
+            "question4": {"valueType": "TEXT"},
+        },
+    }
+
+
+class MappingPlanTests(TestCase):
+    def test_compile(self):
+        form_mapping = build_form_mapping()
+        plan = MappingPlan(form_mapping)
+
+        self.assertEqual(list(plan.questions), ["question1", "question2", "question4"])
+        question1 = plan.questions["question1"]
+        self.assertEqual(question1.data_element_id, "DE_DHIS2_ID")
+        self.assertEqual(question1.option_combos, {"categoryOptionCombo": "COC_ID"})
+        self.assertEqual(question1.format("25", None), 25)
+        self.assertEqual(question1.data_element["question_key"], "question1")
+        self.assertEqual(
+            [(choice.value, choice.data_element_id) for choice in plan.questions["question2"].choices],
+            [("a", "DE_A"), ("b", "DE_B")],
+        )
+        # the invalid mappings are reported when a value is mapped, not when compiling
+        self.assertIsInstance(plan.questions["question4"].error, KeyError)
+        # the mapping json is not modified
+        self.assertEqual(form_mapping, build_form_mapping())
+
+    def test_compile_invalid_option_set(self):
+        plan = MappingPlan({"question_mappings": {"question1": {"id": "DE_ID", "valueType": "TEXT", "optionSet": {}}}})
+
+        question1 = plan.questions["question1"]
+        self.assertIsInstance(question1.error, KeyError)
+        with self.assertRaises(KeyError):
+            question1.format("value", None)
+
+    def test_get_mapping_plan_cache(self):
+        form = Form.objects.create(name="form")
+        form_version = FormVersion.objects.create(form=form, version_id="1")
+        mapping_version = MappingVersion.objects.create(
+            name="aggregate", json=build_form_mapping(), form_version=form_version
+        )
+
+        plan = get_mapping_plan(mapping_version)
+        self.assertIs(get_mapping_plan(MappingVersion.objects.get(id=mapping_version.id)), plan)
+
+        mapping_version.json["question_mappings"]["question1"]["id"] = "OTHER_DE_ID"
+        mapping_version.save()
+        new_plan = get_mapping_plan(mapping_version)
+        self.assertIsNot(new_plan, plan)
+        self.assertEqual(new_plan.questions["question1"].data_element_id, "OTHER_DE_ID")
@@ -0,0 +1,25 @@
+from unittest import TestCase, mock
+
+from iaso.utils.lru_cache import LRUCache
+
+
+class LRUCacheTestCase(TestCase):
+    def test_get_or_compute(self):
+        cache = LRUCache(max_size=2)
+        compute = mock.Mock(side_effect=lambda: object())
+
+        a = cache.get_or_compute("a", compute)
+        self.assertIs(cache.get_or_compute("a", compute), a)
+        self.assertEqual(compute.call_count, 1)
+
+    def test_least_recently_used_evicted(self):
+        cache = LRUCache(max_size=2)
+        a = cache.get_or_compute("a", object)
+        cache.get_or_compute("b", object)
+        cache.get_or_compute("a", object)  # "b" is now the least recently used
+        cache.get_or_compute("c", object)
+
+        self.assertIs(cache.get_or_compute("a", object), a)
+        compute = mock.Mock(return_value="b")
+        cache.get_or_compute("b", compute)
+        compute.assert_called_once()
@@ -68,6 +68,7 @@ from .api.mobile.reports import MobileReportsViewSet
 from .api.mobile.storage import MobileStoragePasswordViewSet
 from .api.org_unit_change_requests.views import OrgUnitChangeRequestViewSet
 from .api.org_unit_change_requests.views_mobile import MobileOrgUnitChangeRequestViewSet
+from .api.org_unit_tiles import OrgUnitTileView
 from .api.org_unit_types import OrgUnitTypeViewSet
 from .api.org_unit_types.viewsets import OrgUnitTypeViewSetV2
 from .api.org_units import OrgUnitViewSet
@@ -196,6 +197,7 @@ urlpatterns: URLList = [
     path("enketo/formList", view=enketo_form_list, name="enketo-form-list"),
     path("enketo/formDownload/", view=enketo_form_download, name="enketo_form_download"),
     path("enketo/submission", view=EnketoSubmissionAPIView.as_view(), name="enketo-submission"),
+    path("orgunits/tiles/<int:z>/<int:x>/<int:y>.mvt", OrgUnitTileView.as_view(), name="orgunits-tiles"),
     path("logout-iaso", auth.views.LogoutView.as_view(next_page="login"), name="logout-iaso"),
 ]
 
@@ -0,0 +1,35 @@
+import threading
+from collections import OrderedDict
+from typing import Callable, Generic, Hashable, TypeVar
+
+V = TypeVar("V")
+
+
+class LRUCache(Generic[V]):
+    """Thread safe cache keeping the `max_size` most recently used values
+
+    Used to share the values that are expensive to compute, e.g. the plans compiled from a form or mapping version,
+    between the requests and tasks of a worker. The value is computed outside of the lock: two threads missing the
+    same key both compute it, the last one is kept."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._values: "OrderedDict[Hashable, V]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], V]) -> V:
+        with self._lock:
+            value = self._values.get(key)
+            if value is not None:
+                self._values.move_to_end(key)
+                return value
+        value = compute()
+        with self._lock:
+            self._values[key] = value
+            while len(self._values) > self.max_size:
+                self._values.popitem(last=False)
+        return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._values.clear()
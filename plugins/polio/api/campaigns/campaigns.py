@@ -222,6 +222,7 @@ class CampaignSerializer(serializers.ModelSerializer):
                 scope.group.name = name
                 scope.group.save()
 
+            # saved or created above: its updated_at tells the scope changed, see LQASIMZoominMapViewSet
             scope.group.org_units.set(org_units)
 
         if campaign_types:
@@ -256,6 +257,7 @@ class CampaignSerializer(serializers.ModelSerializer):
                     scope.group.name = name
                     scope.group.save()
 
+                # saved or created above: its updated_at tells the scope changed, see LQASIMZoominMapViewSet
                 scope.group.org_units.set(org_units)
 
         campaign.update_geojson_field()
@@ -312,6 +314,7 @@ class CampaignSerializer(serializers.ModelSerializer):
                 scope.group.name = name
                 scope.group.save()
 
+            # saved or created above: its updated_at tells the scope changed, see LQASIMZoominMapViewSet
             scope.group.org_units.set(org_units)
 
         round_instances = []
@@ -375,6 +378,7 @@ class CampaignSerializer(serializers.ModelSerializer):
                     scope.group.name = name
                     scope.group.save()
 
+                # saved or created above: its updated_at tells the scope changed, see LQASIMZoominMapViewSet
                 scope.group.org_units.set(org_units)
 
         # When some rounds need to be deleted, the payload contains only the rounds to keep.
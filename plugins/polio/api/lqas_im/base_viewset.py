@@ -67,8 +67,9 @@ class LqasAfroViewset(ModelViewSet):
                 ]
 
     # constructs the slug for the required datastore, eg lqas_29702. It follows the naming convention adopted in OpenHExa pipeline
-    def get_datastores(self):
+    def get_datastores(self, queryset=None):
         category = self.request.GET.get("category", None)
-        queryset = self.get_queryset()
+        if queryset is None:
+            queryset = self.get_queryset()
         countries = [f"{category}_{org_unit.id}" for org_unit in list(queryset)]
         return JsonDataStore.objects.filter(slug__in=countries)
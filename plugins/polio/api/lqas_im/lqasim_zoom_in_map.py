@@ -1,20 +1,28 @@
 import datetime as dt
+import hashlib
 import json
+from collections import defaultdict
 from datetime import timedelta
 
 from django.contrib.gis.geos import Polygon
-from django.db.models import Q, Subquery
+from django.core.cache import cache
+from django.db.models import Max, Q, Subquery
 from drf_yasg.utils import swagger_auto_schema
 from rest_framework import permissions
 from rest_framework.response import Response
 
 from iaso.api.common import ModelViewSet
 from iaso.models import OrgUnit
-from iaso.models.data_store import JsonDataStore
 from iaso.utils import geojson_queryset
-from plugins.polio.api.common import LQASStatus, RoundSelection, determine_status_for_district, make_safe_bbox
+from plugins.polio.api.common import (
+    CACHE_VERSION,
+    LQASStatus,
+    RoundSelection,
+    determine_status_for_district,
+    make_safe_bbox,
+)
 from plugins.polio.api.lqas_im.base_viewset import LqasAfroViewset
-from plugins.polio.models import Campaign, Round
+from plugins.polio.models import Campaign, CampaignScope, Round, RoundScope
 
 
 def get_latest_active_campaign_and_rounds(org_unit, start_date_after, end_date_before):
@@ -55,15 +63,114 @@ def get_latest_active_campaign_and_rounds(org_unit, start_date_after, end_date_b
     return latest_active_campaign, latest_active_campaign_rounds, round_numbers
 
 
+def get_latest_active_campaigns_and_rounds(country_ids, start_date_after, end_date_before):
+    """Same as `get_latest_active_campaign_and_rounds` for several countries, in a constant number of queries
+
+    Returns {country_id: (latest_active_campaign, latest_active_campaign_rounds, round_numbers)}, the countries
+    without active campaign are left out. The rounds are a list, ordered by descending number."""
+    today = dt.date.today()
+    latest_active_rounds_qs = Round.objects.filter(campaign__country_id__in=country_ids)
+    if start_date_after is not None:
+        latest_active_rounds_qs = latest_active_rounds_qs.filter(started_at__gte=start_date_after)
+    if end_date_before is not None:
+        latest_active_rounds_qs = latest_active_rounds_qs.filter(ended_at__lte=end_date_before)
+
+    buffer = today - timedelta(days=10)
+    # latest round of each country
+    latest_active_rounds_qs = (
+        latest_active_rounds_qs.filter(
+            Q(lqas_ended_at__lte=today) | (Q(lqas_ended_at__isnull=True) & Q(ended_at__lte=buffer))
+        )
+        .filter(campaign__deleted_at__isnull=True)
+        .exclude(campaign__is_test=True)
+        .order_by("campaign__country_id", "-started_at")
+        .distinct("campaign__country_id")
+        .select_related("campaign")
+    )
+    campaigns = {round.campaign.country_id: round.campaign for round in latest_active_rounds_qs}
+
+    rounds_per_campaign = defaultdict(list)
+    latest_active_campaigns_rounds = (
+        Round.objects.filter(campaign__in=campaigns.values())
+        .filter(ended_at__lte=today)
+        .filter((Q(lqas_ended_at__lte=today)) | (Q(lqas_ended_at__isnull=True) & Q(ended_at__lte=buffer)))
+        .order_by("-number")
+    )
+    for round in latest_active_campaigns_rounds:
+        rounds_per_campaign[round.campaign_id].append(round)
+
+    result = {}
+    for country_id, campaign in campaigns.items():
+        rounds = rounds_per_campaign[campaign.id]
+        result[country_id] = (campaign, rounds, [round.number for round in rounds])
+    return result
+
+
+def select_round_number(rounds, round_numbers, requested_round):
+    if requested_round == RoundSelection.Latest:
+        return rounds[0].number if len(rounds) > 0 else None
+    if requested_round == RoundSelection.Penultimate:
+        return rounds[1].number if len(rounds) > 1 else None
+    round_number = int(requested_round)
+    return round_number if round_number in round_numbers else None
+
+
+def get_scopes(campaigns_and_round_numbers):
+    """Ids of the org units in scope of each (campaign, round number), as {(campaign_id, round_number): {ids}}"""
+    campaigns = {campaign.id: campaign for campaign, _round_number in campaigns_and_round_numbers}
+    round_numbers_per_campaign = defaultdict(set)
+    for campaign, round_number in campaigns_and_round_numbers:
+        round_numbers_per_campaign[campaign.id].add(round_number)
+
+    scopes = defaultdict(set)
+    round_scopes = RoundScope.objects.filter(
+        round__campaign__in=[c for c in campaigns.values() if c.separate_scopes_per_round]
+    ).values_list("round__campaign_id", "round__number", "group__org_units")
+    for campaign_id, round_number, org_unit_id in round_scopes:
+        if org_unit_id is not None:
+            scopes[(campaign_id, round_number)].add(org_unit_id)
+
+    # the scope is the same for all the rounds
+    campaign_scopes = CampaignScope.objects.filter(
+        campaign__in=[c for c in campaigns.values() if not c.separate_scopes_per_round]
+    ).values_list("campaign_id", "group__org_units")
+    for campaign_id, org_unit_id in campaign_scopes:
+        if org_unit_id is not None:
+            for round_number in round_numbers_per_campaign[campaign_id]:
+                scopes[(campaign_id, round_number)].add(org_unit_id)
+    return scopes
+
+
+def get_stats_per_district(data_store, campaign, round_number):
+    """{district_id: stats} for the round of the campaign in the content of the data store"""
+    stats = data_store.content.get("stats", None)
+    if stats:
+        stats = stats.get(campaign.obr_name, None)
+    if not stats:
+        return {}
+    round_stats = next((round for round in stats["rounds"] if round["number"] == round_number), None)
+    if not round_stats:
+        return {}
+    return {
+        data_for_district["district"]: data_for_district for data_for_district in round_stats.get("data", {}).values()
+    }
+
+
 @swagger_auto_schema(tags=["lqaszoomin"])
 class LQASIMZoominMapViewSet(LqasAfroViewset):
+    """Districts in scope of the latest active campaign of each country in the bounds, with their LQAS/IM stats
+
+    The results are cached per user, filters and bounds. The key includes the last update of the data stores and
+    campaigns of the countries, so a new upload of the stats or an edited campaign is served right away.
+    """
+
     http_method_names = ["get"]
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
     results_key = "results"
 
-    def get_queryset(self):
+    def get_bounds_as_polygon(self):
         bounds = json.loads(self.request.GET.get("bounds", None))
-        bounds_as_polygon = Polygon(
+        return Polygon(
             make_safe_bbox(
                 bounds["_southWest"]["lng"],
                 bounds["_southWest"]["lat"],
@@ -71,133 +178,145 @@ class LQASIMZoominMapViewSet(LqasAfroViewset):
                 bounds["_northEast"]["lat"],
             ),
         )
+
+    def get_queryset(self):
         # TODO see if we need to filter per user as with Campaign
         return (
             OrgUnit.objects.filter(org_unit_type__category="COUNTRY")
             .exclude(simplified_geom__isnull=True)
-            .filter(simplified_geom__intersects=bounds_as_polygon)
+            .filter(simplified_geom__intersects=self.get_bounds_as_polygon())
         )
 
     def list(self, request):
-        results = []
         requested_round = self.request.GET.get("round", RoundSelection.Latest)
-        queryset = self.get_queryset()
-        bounds = json.loads(request.GET.get("bounds", None))
-        bounds_as_polygon = Polygon(
-            make_safe_bbox(
-                bounds["_southWest"]["lng"],
-                bounds["_southWest"]["lat"],
-                bounds["_northEast"]["lng"],
-                bounds["_northEast"]["lat"],
-            )
+        start_date_after, end_date_before = self.compute_reference_dates()
+        countries = {country.id: country for country in self.get_queryset().only("id", "name")}
+        data_stores = self.get_datastores(countries.values()).defer("content")
+        # The rounds and scopes are edited with the campaign, but can be saved without it. The scope groups are saved
+        # when their org units are set, see CampaignSerializer. Each is aggregated on its own: joining them all to the
+        # campaigns would multiply the rows by the number of rounds and scopes.
+        campaigns = Campaign.objects.filter(country_id__in=countries)
+        latest_updates = {
+            "campaign": campaigns.aggregate(latest=Max("updated_at"))["latest"],
+            "campaign_scopes": CampaignScope.objects.filter(campaign__in=campaigns).aggregate(
+                latest=Max("group__updated_at")
+            )["latest"],
+            "rounds": Round.objects.filter(campaign__in=campaigns).aggregate(latest=Max("updated_at"))["latest"],
+            "round_scopes": RoundScope.objects.filter(round__campaign__in=campaigns).aggregate(
+                latest=Max("group__updated_at")
+            )["latest"],
+        }
+
+        cache_key = self.get_cache_key(
+            requested_round,
+            start_date_after,
+            end_date_before,
+            sorted((data_store.id, data_store.updated_at.isoformat()) for data_store in data_stores),
+            sorted(latest_updates.items()),
         )
-        data_stores = self.get_datastores()
-        for org_unit in queryset:
-            start_date_after, end_date_before = self.compute_reference_dates()
-            country_id = org_unit.id
-            try:
-                data_store = data_stores.get(slug__contains=str(country_id))
-            except JsonDataStore.DoesNotExist:
-                continue
-
-            (
-                latest_active_campaign,
-                latest_active_campaign_rounds,
-                round_numbers,
-            ) = get_latest_active_campaign_and_rounds(org_unit, start_date_after, end_date_before)
-
-            if latest_active_campaign is None:
-                continue
-            if requested_round == RoundSelection.Latest:
-                round_number = (
-                    latest_active_campaign_rounds[0].number if latest_active_campaign_rounds.count() > 0 else None
-                )
-            elif requested_round == RoundSelection.Penultimate:
-                round_number = (
-                    latest_active_campaign_rounds[1].number if latest_active_campaign_rounds.count() > 1 else None
-                )
-            else:
-                round_number = int(requested_round)
-                if round_number not in round_numbers:
-                    round_number = None
-            if round_number is None:
-                continue
-            if latest_active_campaign.separate_scopes_per_round:
-                scope = latest_active_campaign.get_districts_for_round_number(round_number)
-            else:
-                scope = latest_active_campaign.get_all_districts()
-            # Visible districts in scope
-            scope_qs = OrgUnit.objects.filter(id__in=[ou.id for ou in scope])
-            # Visible districts in scope
-            # Either distrcits with a shape that intersects the bounds or districts without shape (these will appear in the list view in the front-end)
-            filter_query = (Q(simplified_geom__isnull=False) & Q(simplified_geom__intersects=bounds_as_polygon)) | Q(
-                simplified_geom__isnull=True
-            )
-            districts = (
-                scope_qs.filter(org_unit_type__category="DISTRICT")
-                .filter(parent__parent=org_unit.id)
-                .filter(filter_query)
-            )
-            data_for_country = data_store.content
-            stats = data_for_country.get("stats", None)
-            if stats:
-                stats = stats.get(latest_active_campaign.obr_name, None)
-            for district in districts:
-                result = None
-                district_stats = dict(stats) if stats else None
-
-                if district_stats:
-                    district_stats = next(
-                        (round for round in district_stats["rounds"] if round["number"] == round_number), None
-                    )
-                if district_stats:
-                    district_stats = next(
-                        (
-                            data_for_district
-                            for data_for_district in district_stats.get("data", {}).values()
-                            if data_for_district["district"] == district.id
-                        ),
-                        None,
-                    )
-                    if district_stats:
-                        district_stats["district_name"] = district.name
-                shape_queryset = OrgUnit.objects.filter_for_user_and_app_id(
-                    request.user, request.query_params.get("app_id", None)
-                ).filter(id=district.id)
-
-                shapes = geojson_queryset(shape_queryset, geometry_field="simplified_geom")
-
-                if district_stats:
-                    result = {
-                        "id": district.id,
-                        "data": {
-                            "campaign": latest_active_campaign.obr_name,
-                            **district_stats,
-                            "district_name": district.name,
-                            "round_number": round_number,
-                        },
-                        "geo_json": shapes,
-                        "status": determine_status_for_district(district_stats),
-                        "country_id": country_id,
-                        "country_name": org_unit.name,
-                    }
-
-                else:
-                    result = {
-                        "id": district.id,
-                        "data": {
-                            "campaign": latest_active_campaign.obr_name,
-                            "district_name": district.name,
-                            "region_name": district.parent.name,
-                        },
-                        "geo_json": shapes,
-                        "status": LQASStatus.InScope,
-                        "country_id": country_id,
-                        "country_name": org_unit.name,
-                    }
-                results.append(result)
+        results = cache.get(cache_key, version=CACHE_VERSION)
+        if results is None:
+            data_stores = {data_store.slug: data_store for data_store in data_stores.defer(None)}
+            results = self.compute_results(countries, data_stores, requested_round, start_date_after, end_date_before)
+            cache.set(cache_key, results, 3600, version=CACHE_VERSION)
         return Response({"results": results})
 
+    def get_cache_key(self, *params):
+        request = self.request
+        user = request.user.id if request.user.is_authenticated else request.query_params.get("app_id", None)
+        bounds = self.get_bounds_as_polygon().extent
+        params = [request.GET.get("category", None), bounds, dt.date.today(), *params]
+        return f"{user}-lqasim-zoomin-{hashlib.sha1(str(params).encode()).hexdigest()}"
+
+    def compute_results(self, countries, data_stores, requested_round, start_date_after, end_date_before):
+        category = self.request.GET.get("category", None)
+        selected_rounds = {}
+        latest_active_campaigns = get_latest_active_campaigns_and_rounds(
+            [country_id for country_id in countries if f"{category}_{country_id}" in data_stores],
+            start_date_after,
+            end_date_before,
+        )
+        for country_id, (campaign, rounds, round_numbers) in latest_active_campaigns.items():
+            round_number = select_round_number(rounds, round_numbers, requested_round)
+            if round_number is not None:
+                selected_rounds[country_id] = (campaign, round_number)
+        if not selected_rounds:
+            return []
+
+        scopes = get_scopes(selected_rounds.values())
+        # Visible districts in scope
+        # Either distrcits with a shape that intersects the bounds or districts without shape (these will appear in the list view in the front-end)
+        bounds_as_polygon = self.get_bounds_as_polygon()
+        filter_query = (Q(simplified_geom__isnull=False) & Q(simplified_geom__intersects=bounds_as_polygon)) | Q(
+            simplified_geom__isnull=True
+        )
+        districts = (
+            OrgUnit.objects.filter(id__in=set().union(*scopes.values()))
+            .filter(org_unit_type__category="DISTRICT")
+            .filter(parent__parent__in=list(selected_rounds))
+            .filter(filter_query)
+            .values("id", "name", "parent__name", "parent__parent_id")
+        )
+        in_scope_districts = []
+        for district in districts:
+            campaign, round_number = selected_rounds[district["parent__parent_id"]]
+            if district["id"] in scopes[(campaign.id, round_number)]:
+                in_scope_districts.append(district)
+        districts = in_scope_districts
+
+        shapes = self.get_shapes([district["id"] for district in districts])
+        stats_per_country = {
+            country_id: get_stats_per_district(data_stores[f"{category}_{country_id}"], campaign, round_number)
+            for country_id, (campaign, round_number) in selected_rounds.items()
+        }
+
+        results = []
+        for district in districts:
+            country_id = district["parent__parent_id"]
+            campaign, round_number = selected_rounds[country_id]
+            district_stats = stats_per_country[country_id].get(district["id"], None)
+            if district_stats:
+                result = {
+                    "id": district["id"],
+                    "data": {
+                        "campaign": campaign.obr_name,
+                        **district_stats,
+                        "district_name": district["name"],
+                        "round_number": round_number,
+                    },
+                    "geo_json": shapes[district["id"]],
+                    "status": determine_status_for_district(district_stats),
+                    "country_id": country_id,
+                    "country_name": countries[country_id].name,
+                }
+            else:
+                result = {
+                    "id": district["id"],
+                    "data": {
+                        "campaign": campaign.obr_name,
+                        "district_name": district["name"],
+                        "region_name": district["parent__name"],
+                    },
+                    "geo_json": shapes[district["id"]],
+                    "status": LQASStatus.InScope,
+                    "country_id": country_id,
+                    "country_name": countries[country_id].name,
+                }
+            results.append(result)
+        return results
+
+    def get_shapes(self, district_ids):
+        """Shape of each district, as a FeatureCollection that is empty if the user can't see the district"""
+        shape_queryset = OrgUnit.objects.filter_for_user_and_app_id(
+            self.request.user, self.request.query_params.get("app_id", None)
+        ).filter(id__in=district_ids)
+        collection = geojson_queryset(shape_queryset, geometry_field="simplified_geom")
+        features = collection.pop("features")
+        shapes = defaultdict(lambda: {**collection, "features": []})
+        for feature in features:
+            shapes[feature["id"]] = {**collection, "features": [feature]}
+        return shapes
+
 
 @swagger_auto_schema(tags=["lqaszoominbackground"])
 class LQASIMZoominMapBackgroundViewSet(ModelViewSet):
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.11 on 2026-10-18 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("polio", "0177_migrate_budget_data"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="round",
+            name="updated_at",
+            field=models.DateTimeField(auto_now=True, null=True),
+        ),
+    ]
@@ -289,6 +289,8 @@ class Round(models.Model):
     forma_comment = models.TextField(blank=True, null=True)
     percentage_covered_target_population = models.IntegerField(null=True, blank=True)
     # End of vaccine management
+    # null for the rounds not saved since the field was added
+    updated_at = models.DateTimeField(auto_now=True, null=True)
 
     objects = models.Manager.from_queryset(RoundQuerySet)()
 
@@ -1,5 +1,6 @@
 import json
 from datetime import date, datetime, timedelta
+from unittest import mock
 
 from django.contrib.auth.models import User
 from django.contrib.gis.geos import MultiPolygon, Polygon
@@ -18,6 +19,7 @@ from plugins.polio.api.common import (
     get_data_for_round,
     reduce_to_country_status,
 )
+from plugins.polio.api.lqas_im.lqasim_zoom_in_map import LQASIMZoominMapViewSet
 from plugins.polio.models import Campaign, CampaignScope, Round, RoundScope
 
 
@@ -760,3 +762,50 @@ class PolioLqasAfroMapTestCase(APITestCase):
         content = json.loads(response.content)
         results = content["results"]
         self.assertEqual(len(results), 0)
+
+    def test_lqas_zoomin_cache_invalidated_by_datastore_update(self):
+        c = APIClient()
+        c.force_authenticate(user=self.authorized_user)
+        url = f"/api/polio/lqasmap/zoomin/?category=lqas&round=1&bounds={self.url_bounds}"
+
+        response = c.get(url, accept="application/json")
+        results = {district_data["id"]: district_data for district_data in response.json()["results"]}
+        self.assertEqual(results[self.district_org_unit_1.id]["status"], LQASStatus.Pass)
+
+        # served from the cache
+        with mock.patch.object(LQASIMZoominMapViewSet, "compute_results") as compute_results:
+            response = c.get(url, accept="application/json")
+        compute_results.assert_not_called()
+        self.assertEqual(len(response.json()["results"]), 3)
+
+        round_1_data = self.country1_data_store_content["stats"][self.campaign_1.obr_name]["rounds"][0]["data"]
+        round_1_data[self.district_org_unit_1.name]["total_child_fmd"] = 40
+        self.datastore_country1.content = self.country1_data_store_content
+        self.datastore_country1.save()
+
+        response = c.get(url, accept="application/json")
+        results = {district_data["id"]: district_data for district_data in response.json()["results"]}
+        self.assertEqual(results[self.district_org_unit_1.id]["status"], LQASStatus.Fail)
+
+    def test_lqas_zoomin_cache_invalidated_by_round_and_scope_update(self):
+        c = APIClient()
+        c.force_authenticate(user=self.authorized_user)
+        url = f"/api/polio/lqasmap/zoomin/?category=lqas&round=1&bounds={self.url_bounds}"
+
+        response = c.get(url, accept="application/json")
+        self.assertIn(
+            self.district_org_unit_2.id, [district_data["id"] for district_data in response.json()["results"]]
+        )
+
+        self.campaign1_round1.save()
+        with mock.patch.object(LQASIMZoominMapViewSet, "compute_results", return_value=[]) as compute_results:
+            c.get(url, accept="application/json")
+        compute_results.assert_called_once()
+
+        # as done by CampaignSerializer, the m2m changes alone don't update the group
+        self.campaign1_scope_group.save()
+        self.campaign1_scope_group.org_units.remove(self.district_org_unit_2)
+        response = c.get(url, accept="application/json")
+        self.assertNotIn(
+            self.district_org_unit_2.id, [district_data["id"] for district_data in response.json()["results"]]
+        )